@@ -0,0 +1,65 @@
+"""Decryption of the binary encoding (`binary=True`) against the text one.
+
+In SQL, the decrypted bytes of the binary encoding are read as an integer
+through their hex text and a bit string (see `pgcrypto.binary`), while the text
+encoding parses the decrypted text. Both sides decrypt the same values from a
+temporary table, so the difference is the decoding and the message sizes.
+"""
+import pytest
+from django.db import connection
+from tests.models import EncryptedBinaryModel
+
+from pgcrypto.keys import generate_key
+
+pytestmark = pytest.mark.django_db
+
+ROWS = 10000
+VALUES = {
+    'integer': 'i',
+    'date': "date '2000-01-01' + i",
+    'datetime': "timestamp '2000-01-01' + i * interval '1 second'",
+    'decimal': 'i * 0.01',
+}
+
+CREATE_SQL = (
+    'CREATE TEMPORARY TABLE binary_benchmark AS SELECT '
+    'pgp_sym_encrypt(v::text, %s) AS text_message, '
+    'pgp_sym_encrypt_bytea({encode}, %s) AS binary_message '
+    'FROM (SELECT {value} AS v FROM generate_series(1, %s) i) plaintexts'
+)
+TEXT_SQL = 'SELECT count(pgp_sym_decrypt(text_message, %s)::{cast}) FROM binary_benchmark'
+BINARY_SQL = 'SELECT count({decode}::{cast}) FROM binary_benchmark'
+
+
+def run(sql, params):
+    """Return the row selected by `sql`."""
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchone()
+
+
+@pytest.fixture(params=sorted(VALUES))
+def encrypted(request):
+    """`ROWS` values of a field encrypted in both encodings, and their key."""
+    field = EncryptedBinaryModel._meta.get_field(request.param)
+    key = generate_key()
+    with connection.cursor() as cursor:
+        cursor.execute(CREATE_SQL.format(
+            encode=field.codec.get_encode_sql() % 'v', value=VALUES[request.param],
+        ), [key, key, ROWS])
+    yield field, key
+    with connection.cursor() as cursor:
+        cursor.execute('DROP TABLE binary_benchmark')
+
+
+def test_decrypt_text(benchmark, encrypted):
+    """Decrypt `ROWS` values of the text encoding and cast them."""
+    field, key = encrypted
+    benchmark(run, TEXT_SQL.format(cast=field.get_cast_sql()), [key])
+
+
+def test_decrypt_binary(benchmark, encrypted):
+    """Decrypt `ROWS` values of the binary encoding and decode them."""
+    field, key = encrypted
+    decode = field.codec.get_decode_sql('pgp_sym_decrypt_bytea(binary_message, %s)')
+    benchmark(run, BINARY_SQL.format(decode=decode, cast=field.get_cast_sql()), [key])
@@ -0,0 +1,192 @@
+"""Benchmarks of the PGP symmetric key fields against the local database."""
+import pytest
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Sum
+from django.db.models.sql.subqueries import InsertQuery
+from tests.factories import EncryptedFKModelFactory, EncryptedModelFactory
+from tests.models import EncryptedDateTime, EncryptedModel, RelatedDateTime
+
+from pgcrypto.bulk import copy_load
+
+pytestmark = pytest.mark.django_db
+
+BULK_SIZES = (10, 100, 1000)
+
+
+@pytest.fixture
+def populated():
+    """1000 rows with a related `EncryptedFKModel` each."""
+    return EncryptedModelFactory.create_batch(1000)
+
+
+def test_insert(benchmark):
+    """One `INSERT`, paying for a new key and eight `pgp_sym_encrypt` calls."""
+    benchmark(EncryptedModelFactory.create, fk_model=None)
+
+
+@pytest.mark.parametrize('size', BULK_SIZES)
+def test_bulk_insert(benchmark, size):
+    """`bulk_create` of `size` rows."""
+    def setup():
+        return ([EncryptedModelFactory.build(fk_model=None) for _ in range(size)],), {}
+
+    benchmark.pedantic(EncryptedModel.objects.bulk_create, setup=setup, rounds=5)
+
+
+@pytest.mark.parametrize('workers', (None, 4))
+def test_bulk_insert_encrypt_in_python(benchmark, settings, workers):
+    """`bulk_create` of 1000 rows encrypted on the client, see `test_bulk_insert`."""
+    settings.PGCRYPTO_ENCRYPT_IN_PYTHON = True
+
+    def setup():
+        return ([EncryptedModelFactory.build(fk_model=None) for _ in range(1000)],), {
+            'workers': workers}
+
+    benchmark.pedantic(EncryptedModel.objects.bulk_create, setup=setup, rounds=5)
+
+
+def test_copy_load(benchmark):
+    """`pgcrypto.bulk.copy_load` of 1000 rows, see `test_bulk_insert`."""
+    def setup():
+        rows = [EncryptedModelFactory.build(fk_model=None) for _ in range(1000)]
+        return (EncryptedModel, rows), {}
+
+    benchmark.pedantic(copy_load, setup=setup, rounds=5)
+
+
+def test_update(benchmark):
+    """`save()` of an existing row, the key comes from the in-process cache."""
+    instance = EncryptedModelFactory.create(fk_model=None)
+
+    def update():
+        instance.pgp_sym_field = 'updated'
+        instance.save()
+
+    benchmark(update)
+
+
+def test_select(benchmark, populated):
+    """Fetch and decrypt one row by primary key."""
+    pk = populated[0].pk
+    benchmark(EncryptedModel.objects.get, pk=pk)
+
+
+@pytest.mark.parametrize('size', BULK_SIZES)
+def test_bulk_select(benchmark, populated, size):
+    """Fetch and decrypt `size` rows."""
+    benchmark(lambda: list(EncryptedModel.objects.all()[:size]))
+
+
+@pytest.mark.parametrize('workers', (None, 4))
+@pytest.mark.parametrize('size', BULK_SIZES)
+def test_bulk_select_decrypt_in_python(benchmark, populated, size, workers):
+    """Fetch `size` rows and decrypt them on the client, see `test_bulk_select`."""
+    queryset = EncryptedModel.objects.decrypt_in_python(workers=workers)
+    benchmark(lambda: list(queryset[:size]))
+
+
+def test_filter_on_encrypted_field(benchmark, populated):
+    """A filter on a decrypted column, i.e. a full scan with per row decryption."""
+    value = populated[500].pgp_sym_field
+    benchmark(lambda: list(EncryptedModel.objects.filter(pgp_sym_field=value)))
+
+
+def test_fk_decryption(benchmark, populated):
+    """Decrypt the columns of a `select_related` join as well."""
+    benchmark(lambda: list(EncryptedModel.objects.select_related('fk_model')[:100]))
+
+
+def test_related_datetime(benchmark):
+    """Two joined aliases of the same encrypted table."""
+    for _ in range(100):
+        RelatedDateTime.objects.create(
+            related=EncryptedDateTime.objects.create(value='2019-01-01 10:00'),
+            related_again=EncryptedDateTime.objects.create(value='2019-01-01 11:00'),
+        )
+    queryset = RelatedDateTime.objects.select_related('related', 'related_again')
+    benchmark(lambda: list(queryset))
+
+
+@pytest.mark.parametrize('local_keys', (False, True))
+def test_parallel_aggregate(benchmark, populated, settings, local_keys):
+    """`Sum` of a decrypted column, with the `key_store` or the local keys.
+
+    Parallel plans are made free so that postgres uses workers for the 1000
+    rows whenever the query allows it, i.e. with `PGCRYPTO_LOCAL_KEYS`.
+    """
+    settings.PGCRYPTO_LOCAL_KEYS = local_keys
+    if local_keys:
+        call_command('pgcrypto_sync_local_keys')
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SET LOCAL parallel_setup_cost = 0; SET LOCAL parallel_tuple_cost = 0; '
+            'SET LOCAL min_parallel_table_scan_size = 0')
+
+    benchmark(
+        lambda: EncryptedModel.objects.aggregate(total=Sum('integer_pgp_sym_field')))
+
+
+def test_raw_columns(benchmark, populated):
+    """Baseline: the same rows without any decryption."""
+    table = EncryptedModel._meta.db_table
+
+    def select():
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT * FROM {}'.format(table))
+            return cursor.fetchall()
+
+    benchmark(select)
+
+
+def test_key_store_subquery(benchmark, populated):
+    """The per row `key_store` lookup done by `PGP_SYM_DECRYPT_SQL`, on its own."""
+    table = EncryptedModel._meta.db_table
+
+    def select():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT (SELECT key FROM key_store WHERE id = {0}.id::text LIMIT 1) '
+                'FROM {0}'.format(table))
+            return cursor.fetchall()
+
+    benchmark(select)
+
+
+def test_compile_decrypted_cols(benchmark):
+    """Python side cost of compiling the `DecryptedCol` expressions."""
+    queryset = EncryptedModel.objects.select_related('fk_model')
+    benchmark(lambda: queryset.query.get_compiler('default').as_sql())
+
+
+def insert_compiler():
+    """Return an insert compiler for one unsaved `EncryptedModel`."""
+    instance = EncryptedModelFactory.build(fk_model=None)
+    query = InsertQuery(EncryptedModel)
+    query.insert_values(EncryptedModel._meta.concrete_fields, [instance])
+    return query.get_compiler('default')
+
+
+def test_get_placeholder_cached(benchmark):
+    """Key lookup in `get_placeholder` with a warm key cache."""
+    field = EncryptedModel._meta.get_field('pgp_sym_field')
+    compiler = insert_compiler()
+    field.get_placeholder('value', compiler, connection)
+    benchmark(field.get_placeholder, 'value', compiler, connection)
+
+
+def test_get_placeholder_uncached(benchmark, clear_key_cache):
+    """Key lookup in `get_placeholder` going to the key store every time."""
+    field = EncryptedModel._meta.get_field('pgp_sym_field')
+    compiler = insert_compiler()
+
+    def setup():
+        clear_key_cache()
+        return ('value', compiler, connection), {}
+
+    benchmark.pedantic(field.get_placeholder, setup=setup, rounds=100)
+
+
+def test_fk_model_factory(benchmark):
+    """Reference point: creating the smallest encrypted model."""
+    benchmark(EncryptedFKModelFactory.create)
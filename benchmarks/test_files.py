@@ -0,0 +1,57 @@
+"""Benchmarks of the encrypted file fields and `FetchView`."""
+import os
+
+import pytest
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.test import RequestFactory
+from tests.models import EncryptedFileModel
+
+from pgcrypto.crypt import Cryptographer
+from pgcrypto.views import FetchView
+
+SIZES = (1024, 1024 ** 2, 16 * 1024 ** 2)
+
+
+def test_key_derivation(benchmark):
+    """PBKDF2 done for every file read and write."""
+    benchmark(Cryptographer.fernet_generator, b'password')
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_encrypt(benchmark, size):
+    """Fernet encryption, key derivation included."""
+    benchmark(Cryptographer.encrypted, b'password', os.urandom(size))
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_decrypt(benchmark, size):
+    """Fernet decryption, key derivation included."""
+    content = Cryptographer.encrypted(b'password', os.urandom(size))
+    benchmark(Cryptographer.decrypted, b'password', content)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('size', SIZES)
+def test_upload(benchmark, size):
+    """Save a file through `EncryptedFileField`."""
+    content = os.urandom(size)
+
+    def upload():
+        instance = EncryptedFileModel()
+        instance.attachment.save('upload.bin', ContentFile(content))
+
+    benchmark.pedantic(upload, rounds=5)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('size', SIZES)
+def test_download(benchmark, size):
+    """Serve a file through `FetchView`."""
+    instance = EncryptedFileModel()
+    instance.attachment.save('download.bin', ContentFile(os.urandom(size)))
+    view = FetchView.as_view()
+    path = settings.MEDIA_URL + instance.attachment.name
+    request = RequestFactory().get('/fetch/', {'id': str(instance.pk)})
+
+    benchmark.pedantic(view, args=(request,), kwargs={'path': path}, rounds=5)
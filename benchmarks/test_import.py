@@ -0,0 +1,51 @@
+"""Cost of `import pgcrypto.fields` in a fresh interpreter.
+
+Management commands and workers import the models, and so the fields, without
+necessarily encrypting anything: redis, cryptography, python-magic, Pillow and
+requests are only loaded on first use.
+"""
+import json
+import os
+import subprocess
+import sys
+
+BASEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules `import pgcrypto.fields` must not load.
+HEAVY_MODULES = ('PIL', 'asyncio', 'cryptography', 'magic', 'redis', 'requests')
+
+SCRIPT = """
+import json, sys, time
+import django
+from django.conf import settings
+
+settings.configure(INSTALLED_APPS=['pgcrypto'])
+django.setup()
+before = set(sys.modules)
+start = time.perf_counter()
+import pgcrypto.fields
+print(json.dumps({
+    'seconds': time.perf_counter() - start,
+    'modules': sorted(set(sys.modules) - before),
+}))
+"""
+
+
+def import_fields():
+    """Import `pgcrypto.fields` in a new interpreter, without any DEFF_ setting."""
+    env = {
+        name: value for name, value in os.environ.items()
+        if not name.startswith('DEFF_')
+    }
+    env['PYTHONPATH'] = BASEDIR
+    output = subprocess.check_output([sys.executable, '-c', SCRIPT], env=env, cwd=BASEDIR)
+    return json.loads(output.decode('utf-8'))
+
+
+def test_import_fields(benchmark):
+    """Time the import, loaded modules are checked once."""
+    result = benchmark.pedantic(import_fields, rounds=5)
+
+    benchmark.extra_info['import_seconds'] = result['seconds']
+    loaded = {module.split('.')[0] for module in result['modules']}
+    assert not loaded.intersection(HEAVY_MODULES), sorted(loaded)
@@ -0,0 +1,48 @@
+"""Throughput of `pgp_sym_encrypt`/`pgp_sym_decrypt` per pgcrypto option string.
+
+Row keys are random 256 bit values, so iterated S2K stretching and trying to
+compress short values are pure overhead.
+"""
+import pytest
+from django.db import connection
+
+from pgcrypto.keys import generate_key
+
+pytestmark = pytest.mark.django_db
+
+ROWS = 10000
+OPTIONS = (
+    '',
+    's2k-mode=1',
+    's2k-mode=1, compress-algo=0',
+    's2k-mode=3, s2k-count=1024, compress-algo=0',
+)
+
+ENCRYPT_SQL = (
+    "SELECT count(pgp_sym_encrypt('value ' || i, %s, %s)) FROM generate_series(1, %s) i"
+)
+DECRYPT_SQL = (
+    "SELECT count(pgp_sym_decrypt(c, %s)) FROM ("
+    "SELECT pgp_sym_encrypt('value ' || i, %s, %s) c FROM generate_series(1, %s) i"
+    ") encrypted"
+)
+
+
+def run(sql, params):
+    """Return the row selected by `sql`."""
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchone()
+
+
+@pytest.mark.parametrize('options', OPTIONS)
+def test_encrypt(benchmark, options):
+    """Encrypt `ROWS` short values."""
+    benchmark(run, ENCRYPT_SQL, [generate_key(), options, ROWS])
+
+
+@pytest.mark.parametrize('options', OPTIONS)
+def test_encrypt_decrypt(benchmark, options):
+    """Encrypt and decrypt `ROWS` short values; subtract `test_encrypt` for decryption."""
+    key = generate_key()
+    benchmark(run, DECRYPT_SQL, [key, key, options, ROWS])
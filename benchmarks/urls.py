@@ -0,0 +1,7 @@
+from django.conf.urls import url
+
+from pgcrypto.views import FetchView
+
+urlpatterns = [
+    url(r'^fetch/(?P<path>.+)$', FetchView.as_view(), name='fetch'),
+]
@@ -1,3 +1,5 @@
+default_app_config = 'pgcrypto.apps.PGCryptoConfig'
+
 DIGEST_SQL = "digest(%s, 'sha512')"
 HMAC_SQL = "hmac(%s, '{}', 'sha512')"
 
@@ -7,5 +9,76 @@ PGP_SYM_ENCRYPT_SQL_WITH_NULLIF = "pgp_sym_encrypt(nullif(%s, NULL)::text, '{}')
 PGP_PUB_ENCRYPT_SQL = "pgp_pub_encrypt(%s, dearmor('{}'))"
 PGP_SYM_ENCRYPT_SQL = "pgp_sym_encrypt(%s, '{}')"
 
+PGP_SYM_ENCRYPT_SQL_WITH_NULLIF_AND_OPTIONS = (
+    "pgp_sym_encrypt(nullif(%s, NULL)::text, '{}', '{}')"
+)
+PGP_SYM_ENCRYPT_SQL_WITH_OPTIONS = "pgp_sym_encrypt(%s, '{}', '{}')"
+
 PGP_PUB_DECRYPT_SQL = "pgp_pub_decrypt(%s, dearmor('{}'))::%s"
 PGP_SYM_DECRYPT_SQL = "pgp_sym_decrypt(%s, (select key from key_store where id = %s.id::text limit 1))::%s"
+PGP_SYM_DECRYPT_SQL_WITH_OPTIONS = (
+    "pgp_sym_decrypt(%s, (select key from key_store where id = %s.id::text limit 1), "
+    "'{}')::%s"
+)
+
+# `binary=True` fields: the encoded value is encrypted as bytea, see `pgcrypto.binary`.
+PGP_SYM_DECRYPT_BYTEA_SQL = (
+    "pgp_sym_decrypt_bytea("
+    "%s, (select key from key_store where id = %s.id::text limit 1))"
+)
+PGP_SYM_DECRYPT_BYTEA_SQL_WITH_OPTIONS = (
+    "pgp_sym_decrypt_bytea("
+    "%s, (select key from key_store where id = %s.id::text limit 1), '{}')"
+)
+
+AES_ENCRYPT_SQL = "pgcrypto_aes_encrypt(convert_to(%s::text, 'utf8'), '{}')"
+AES_DECRYPT_SQL = (
+    "convert_from(pgcrypto_aes_decrypt("
+    "%s, (select key from key_store where id = %s.id::text limit 1)), 'utf8')::%s"
+)
+
+# Key lookup of the decrypt templates and its parallel safe replacement reading
+# the local copy of the keys, see `PGCRYPTO_LOCAL_KEYS`.
+KEY_STORE_KEY_SQL = '(select key from key_store where id = %s.id::text limit 1)'
+LOCAL_KEY_SQL = 'pgcrypto_row_key(%s.id::text)'
+
+# Key of the row being written, for statements updating several rows.
+ROW_KEY_SQL = '(select key from key_store where id = {table}.{pk}::text limit 1)'
+
+# Encryption of text with a key given by the query, e.g. `ROW_KEY_SQL`.
+PGP_SYM_ENCRYPT_WITH_KEY_SQL = 'pgp_sym_encrypt({value}, {key})'
+PGP_SYM_ENCRYPT_WITH_KEY_SQL_WITH_OPTIONS = "pgp_sym_encrypt({value}, {key}, '{options}')"
+AES_ENCRYPT_WITH_KEY_SQL = "pgcrypto_aes_encrypt(convert_to({value}, 'utf8'), {key})"
+PGP_SYM_ENCRYPT_BYTEA_WITH_KEY_SQL = 'pgp_sym_encrypt_bytea({value}, {key})'
+PGP_SYM_ENCRYPT_BYTEA_WITH_KEY_SQL_WITH_OPTIONS = (
+    "pgp_sym_encrypt_bytea({value}, {key}, '{options}')"
+)
+
+# Decryption to text with a key given by the query rather than the `key_store`.
+PGP_SYM_DECRYPT_WITH_KEY_SQL = 'pgp_sym_decrypt({value}, {key})'
+PGP_SYM_DECRYPT_WITH_KEY_SQL_WITH_OPTIONS = "pgp_sym_decrypt({value}, {key}, '{options}')"
+AES_DECRYPT_WITH_KEY_SQL = "convert_from(pgcrypto_aes_decrypt({value}, {key}), 'utf8')"
+PGP_SYM_DECRYPT_BYTEA_WITH_KEY_SQL = 'pgp_sym_decrypt_bytea({value}, {key})'
+PGP_SYM_DECRYPT_BYTEA_WITH_KEY_SQL_WITH_OPTIONS = (
+    "pgp_sym_decrypt_bytea({value}, {key}, '{options}')"
+)
+
+# Re-encryption from one key to another, used for key rotation.
+PGP_SYM_REENCRYPT_SQL = (
+    'pgp_sym_encrypt(pgp_sym_decrypt({column}, {old_key}), {new_key}, %s)'
+)
+PGP_SYM_REENCRYPT_BYTEA_SQL = (
+    'pgp_sym_encrypt_bytea(pgp_sym_decrypt_bytea({column}, {old_key}), {new_key}, %s)'
+)
+AES_REENCRYPT_SQL = (
+    'pgcrypto_aes_encrypt(pgcrypto_aes_decrypt({column}, {old_key}), {new_key})'
+)
+
+# Functions decrypting in the database.
+DECRYPT_FUNCTIONS = (
+    'pgp_sym_decrypt(', 'pgp_sym_decrypt_bytea(', 'pgcrypto_aes_decrypt(',
+)
+
+# Alias of the lateral projection holding the decrypted columns of a table
+# alias referenced several times by a query, see `managers.DecryptOnceMixin`.
+DECRYPTED_ALIAS = '{}__decrypted'
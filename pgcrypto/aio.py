@@ -0,0 +1,174 @@
+"""Resolve the keys of async saves without blocking the event loop.
+
+The ORM of the supported Django versions is synchronous: `asave`,
+`PGPQuerySet.acreate` and `PGPQuerySet.abulk_create` first resolve the keys
+of the rows with the asyncio redis client, one `MGET` per node awaited
+concurrently, into the key cache. The save itself then runs through asgiref's
+`sync_to_async` without looking any key up.
+
+Needs `redis>=4.2` and `asgiref>=3.3` (so python 3.6+).
+"""
+import asyncio
+import weakref
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import router
+
+from pgcrypto import instrumentation, invalidation, keys, sharding
+from pgcrypto.constants import get_redis_host, get_redis_port
+
+# Pooled asyncio clients by event loop then node: they can't be shared by loops.
+_clients = weakref.WeakKeyDictionary()
+
+# The loop of the running coroutine, `get_running_loop` being new in python 3.7.
+_get_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+
+def async_redis_available():
+    """Return whether the installed redis has the asyncio client."""
+    try:
+        from redis import asyncio as aioredis  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def get_async_redis(node=None):
+    """Return the asyncio redis client of the running loop for `node`."""
+    try:
+        from redis import asyncio as aioredis
+    except ImportError:
+        raise ImproperlyConfigured('The async key store needs redis>=4.2.')
+
+    clients = _clients.setdefault(_get_running_loop(), {})
+    if node not in clients:
+        if node is None:
+            host, port = get_redis_host(), get_redis_port()
+        else:
+            host, port = sharding.parse_node(node)
+        clients[node] = aioredis.Redis(host=host, port=port)
+    return clients[node]
+
+
+def sync_to_async(func):
+    """Wrap `func` with asgiref's `sync_to_async`, in the thread of the caller.
+
+    Under an `async_to_sync` the ORM then runs on the connection, transaction
+    and instrumentation counters of the calling thread; asgiref before 3.3
+    defaulted to a thread of its own.
+    """
+    try:
+        from asgiref.sync import sync_to_async
+    except ImportError:
+        raise ImproperlyConfigured('The async ORM helpers need asgiref.')
+    return sync_to_async(func, thread_sensitive=True)
+
+
+async def _mget(node, key_ids):
+    instrumentation.record(instrumentation.REDIS_CALLS)
+    values = await get_async_redis(node).mget(key_ids)
+    return {
+        key_id: value.decode('utf-8')
+        for key_id, value in zip(key_ids, values)
+        if value is not None
+    }
+
+
+async def afetch_keys_from(key_ids_by_node):
+    """Fetch the keys of ids grouped by node, the `MGET`s of the nodes concurrently."""
+    found = {}
+    for fetched in await asyncio.gather(*(
+        _mget(node, key_ids) for node, key_ids in key_ids_by_node.items()
+    )):
+        found.update(fetched)
+    return found
+
+
+async def afetch_keys(key_ids):
+    """Async `keys.fetch_keys`."""
+    key_ids = [str(key_id) for key_id in key_ids]
+    if not key_ids:
+        return {}
+
+    found = await afetch_keys_from(keys.group_by_node(key_ids))
+    missing = [key_id for key_id in key_ids if key_id not in found]
+    if missing:
+        found.update(await afetch_keys_from(keys.moved_key_ids(missing)))
+    return found
+
+
+async def _create(node, key_ids, moved):
+    pipe = get_async_redis(node).pipeline(transaction=False)
+    for key_id in key_ids:
+        pipe.set(key_id, moved.get(key_id) or keys.generate_key(), nx=True)
+    pipe.mget(key_ids)
+    instrumentation.record(instrumentation.REDIS_CALLS)
+    values = (await pipe.execute())[-1]
+    return {key_id: value.decode('utf-8') for key_id, value in zip(key_ids, values)}
+
+
+async def acreate_keys(key_ids, using=None):
+    """Async `keys.create_keys`, the pipelines of the nodes sent concurrently."""
+    key_ids = [str(key_id) for key_id in key_ids]
+    if not key_ids:
+        return {}
+
+    moved = await afetch_keys_from(keys.moved_key_ids(key_ids))
+    created = {}
+    for node_keys in await asyncio.gather(*(
+        _create(node, node_ids, moved)
+        for node, node_ids in keys.group_by_node(key_ids).items()
+    )):
+        created.update(node_keys)
+    if keys.local_keys_enabled():
+        await sync_to_async(keys.store_local_keys)(created, using=using)
+    return created
+
+
+async def aget_row_keys(objs, using=None):
+    """Async `managers.get_row_keys`: resolve and cache the keys of `objs`."""
+    token = invalidation.start_read()
+    cache = keys.get_cache(using)
+    key_ids = {str(obj.pk) for obj in objs if obj.pk is not None}
+    row_keys = {key_id: cache[key_id] for key_id in key_ids if key_id in cache}
+    if row_keys:
+        instrumentation.record(instrumentation.KEY_CACHE_HITS, len(row_keys))
+    missing = key_ids - set(row_keys)
+    if not missing:
+        return row_keys
+
+    instrumentation.record(instrumentation.KEY_CACHE_MISSES, len(missing))
+    fetched = await afetch_keys(missing)
+    created = await acreate_keys(missing - set(fetched), using=using)
+    keys.cache_keys(fetched, token, using)
+    keys.cache_keys(created, token, using)
+    row_keys.update(fetched)
+    row_keys.update(created)
+    return row_keys
+
+
+def _file_fields(model):
+    from pgcrypto.fields import EncryptedFileField, EncryptedImageField
+    return [
+        field for field in model._meta.concrete_fields
+        if isinstance(field, (EncryptedFileField, EncryptedImageField))
+    ]
+
+
+async def asave(obj, *args, using=None, **kwargs):
+    """Save `obj` in a thread once its key was resolved without blocking.
+
+    The key of an instance with a primary key is cached for its encrypted
+    fields and handed to its files to encrypt; other instances are saved as
+    with `save()`.
+    """
+    from pgcrypto.managers import has_row_keys
+
+    if obj.pk is not None and has_row_keys(type(obj)):
+        using = using or router.db_for_write(type(obj), instance=obj)
+        key = (await aget_row_keys([obj], using=using)).get(str(obj.pk))
+        for field in _file_fields(type(obj)):
+            file = getattr(obj, field.attname)
+            if file and not file._committed:
+                file.key = key
+    await sync_to_async(obj.save)(*args, using=using, **kwargs)
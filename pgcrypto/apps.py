@@ -0,0 +1,12 @@
+from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+
+
+class PGCryptoConfig(AppConfig):
+    name = 'pgcrypto'
+    verbose_name = 'pgcrypto'
+
+    def ready(self):
+        """Connect the debug checks."""
+        from .explain import install_checker
+        connection_created.connect(install_checker, dispatch_uid='pgcrypto_explain')
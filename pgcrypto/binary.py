@@ -0,0 +1,133 @@
+"""Fixed width binary encodings of encrypted integers, dates and decimals.
+
+Fields created with `binary=True` encrypt these bytes with
+`pgp_sym_encrypt_bytea` instead of the value's text, and decode them after
+`pgp_sym_decrypt_bytea` (in SQL through their hex text and a bit string, see
+`benchmarks/test_binary.py`):
+
+* integers: 4 bytes, big-endian two's complement (`int4send`);
+* dates: 4 bytes, days since 2000-01-01 (`date_send`);
+* timestamps: 8 bytes, microseconds since 2000-01-01 (`timestamp_send`);
+* decimals: 8 bytes, the value times 10 ** `decimal_places` (up to 18 digits).
+
+Each codec has the SQL encoding its `%s` parameter and decoding a bytea
+expression, and the same conversions in python for the values encrypted or
+decrypted on the application servers.
+"""
+import struct
+from datetime import date, datetime, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.core.exceptions import ImproperlyConfigured
+
+EPOCH_DATE = date(2000, 1, 1)
+EPOCH = datetime(2000, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+# Reads big-endian two's complement bytes as an integer of `bits` bits.
+BITS_SQL = "('x' || encode({value}, 'hex'))::bit({bits})"
+
+
+class Codec:
+    """Encoding of the values of `field` as a big-endian integer."""
+    encode_sql = None  # Set in implementation class
+    decode_sql = None  # Set in implementation class, {} being the integer
+    format = '>i'
+    bits = 32
+
+    def __init__(self, field):
+        """Encode the values of `field`."""
+        self.field = field
+
+    def get_encode_sql(self):
+        """Return the SQL encoding the `%s` parameter to bytea."""
+        return self.encode_sql
+
+    def get_decode_sql(self, value):
+        """Return the SQL decoding the bytea `value` expression."""
+        integer = BITS_SQL.format(value=value, bits=self.bits)
+        return self.decode_sql.format('{}::int{}'.format(integer, self.bits // 8))
+
+    def encode(self, value):
+        """Return the bytes of `value`."""
+        return struct.pack(self.format, self.to_integer(value))
+
+    def decode(self, data):
+        """Return the value of the bytes `data`."""
+        return self.from_integer(struct.unpack(self.format, bytes(data))[0])
+
+    def to_integer(self, value):
+        """Return the integer encoding `value`."""
+        return int(value)
+
+    def from_integer(self, integer):
+        """Return the value encoded by `integer`."""
+        return integer
+
+
+class IntegerCodec(Codec):
+    encode_sql = 'int4send(%s::int4)'
+    decode_sql = '{}'
+
+
+class DateCodec(Codec):
+    encode_sql = 'date_send(%s::date)'
+    decode_sql = "(date '2000-01-01' + {})"
+
+    def to_integer(self, value):
+        """Return the days since 2000-01-01."""
+        return (value - EPOCH_DATE).days
+
+    def from_integer(self, integer):
+        """Return the date `integer` days after 2000-01-01."""
+        return EPOCH_DATE + timedelta(days=integer)
+
+
+class DateTimeCodec(Codec):
+    """Naive timestamps, aware ones being in the connection's time zone first."""
+    encode_sql = 'timestamp_send(%s::timestamp)'
+    decode_sql = "(timestamp '2000-01-01' + {} * interval '1 microsecond')"
+    format = '>q'
+    bits = 64
+
+    def to_integer(self, value):
+        """Return the microseconds since 2000-01-01."""
+        return (value - EPOCH) // MICROSECOND
+
+    def from_integer(self, integer):
+        """Return the timestamp `integer` microseconds after 2000-01-01."""
+        return EPOCH + integer * MICROSECOND
+
+
+class DecimalCodec(Codec):
+    """Decimals scaled to integers by their field's `decimal_places`."""
+    format = '>q'
+    bits = 64
+    max_digits = 18
+
+    def __init__(self, field):
+        """Check the digits of `field` fit in 8 bytes."""
+        super().__init__(field)
+        if field.max_digits is None or field.max_digits > self.max_digits:
+            raise ImproperlyConfigured(
+                '{}: binary decimals have at most {} digits.'.format(
+                    field, self.max_digits))
+
+    def get_encode_sql(self):
+        """Return the SQL encoding the scaled `%s` parameter."""
+        return 'int8send(round(%s::numeric * 1e{})::int8)'.format(
+            self.field.decimal_places)
+
+    def get_decode_sql(self, value):
+        """Return the SQL of the exact numeric of the bytea `value` expression."""
+        return '({}::int8 * 1e-{})'.format(
+            BITS_SQL.format(value=value, bits=self.bits), self.field.decimal_places)
+
+    def to_integer(self, value):
+        """Return `value` scaled by the decimal places, rounded like postgres."""
+        return int(Decimal(value).scaleb(self.field.decimal_places).quantize(
+            1, rounding=ROUND_HALF_UP))
+
+    def from_integer(self, integer):
+        """Return the decimal of the scaled `integer`."""
+        return Decimal(integer).scaleb(-self.field.decimal_places)
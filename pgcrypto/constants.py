@@ -1,14 +1,32 @@
+"""The `DEFF_*` settings, read from the environment or the Django settings.
+
+They are resolved on first use and cached, so that importing pgcrypto doesn't
+need configured settings; the cache is cleared when a setting is overridden.
+"""
 import os
+import sys
+import types
+from functools import lru_cache
 
 from django.conf import settings
+from django.core.signals import setting_changed
 from django.utils import six
 
 
+@lru_cache(maxsize=None)
 def _get_setting(name):
     setting_name = "DEFF_{}".format(name)
     return os.getenv(setting_name, getattr(settings, setting_name, None))
 
 
+def _clear_settings(setting, **kwargs):
+    if setting.startswith('DEFF_'):
+        _get_setting.cache_clear()
+
+
+setting_changed.connect(_clear_settings)
+
+
 def get_bytes(v):
     if isinstance(v, six.string_types):
         return bytes(v.encode("utf-8"))
@@ -22,7 +40,63 @@ def get_bytes(v):
     )
 
 
-SALT = get_bytes(_get_setting("SALT"))
-FETCH_URL_NAME = _get_setting("FETCH_URL_NAME")
-REDIS_HOST = _get_setting("REDIS_HOST")
-REDIS_PORT = _get_setting("REDIS_PORT")
+def get_salt():
+    """Return `DEFF_SALT`, the salt of the file encryption keys, as bytes."""
+    return get_bytes(_get_setting("SALT"))
+
+
+def get_fetch_url_name():
+    """Return `DEFF_FETCH_URL_NAME`, the url name of the `FetchView`."""
+    return _get_setting("FETCH_URL_NAME")
+
+
+def get_redis_host():
+    """Return `DEFF_REDIS_HOST`."""
+    return _get_setting("REDIS_HOST")
+
+
+def get_redis_port():
+    """Return `DEFF_REDIS_PORT`."""
+    return _get_setting("REDIS_PORT")
+
+
+def get_redis_staging_db():
+    """Return the redis db of the keys that must not show up in the `key_store` table."""
+    return int(_get_setting("REDIS_STAGING_DB") or 1)
+
+
+def get_redis_nodes(name='REDIS_NODES'):
+    """Return the `DEFF_<name>` nodes of a sharded key store as `host:port` strings."""
+    nodes = _get_setting(name)
+    if not nodes:
+        return ()
+    if isinstance(nodes, six.string_types):
+        nodes = nodes.split(',')
+    return tuple(node.strip() for node in nodes if node.strip())
+
+
+_LAZY_CONSTANTS = {
+    'SALT': get_salt,
+    'FETCH_URL_NAME': get_fetch_url_name,
+    'REDIS_HOST': get_redis_host,
+    'REDIS_PORT': get_redis_port,
+    'REDIS_STAGING_DB': get_redis_staging_db,
+}
+
+
+class _ConstantsModule(types.ModuleType):
+    """Resolve the former module level constants on access.
+
+    A module `__getattr__` needs python 3.7, module classes can be replaced
+    since python 3.5.
+    """
+
+    def __getattr__(self, name):
+        try:
+            return _LAZY_CONSTANTS[name]()
+        except KeyError:
+            raise AttributeError("module {!r} has no attribute {!r}".format(
+                self.__name__, name))
+
+
+sys.modules[__name__].__class__ = _ConstantsModule
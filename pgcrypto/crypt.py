@@ -1,29 +1,100 @@
 import base64
+import hashlib
+import hmac
+from os import urandom
 
 from cryptography.fernet import Fernet
 from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import hashes, padding
+from cryptography.hazmat.primitives.ciphers import algorithms, Cipher, modes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 
-from .constants import SALT
+from . import instrumentation
+from .constants import get_salt
 
 
 class Cryptographer(object):
+    iterations = 100000
 
     @classmethod
-    def fernet_generator(cls, password):
+    def fernet_generator(cls, password, salt=None, iterations=None):
+        """Return the `Fernet` of `password`, salted with `DEFF_SALT` by default."""
         return Fernet(base64.urlsafe_b64encode(PBKDF2HMAC(
             algorithm=hashes.SHA256(),
             length=32,
-            salt=SALT,
-            iterations=100000,
+            salt=get_salt() if salt is None else salt,
+            iterations=cls.iterations if iterations is None else iterations,
             backend=default_backend()
         ).derive(password)))
 
     @classmethod
     def encrypted(cls, password, content):
+        """Return `content` encrypted with `password`."""
         return cls.fernet_generator(password).encrypt(content)
 
     @classmethod
-    def decrypted(cls, password, content):
-        return cls.fernet_generator(password).decrypt(content)
+    def decrypted(cls, password, content, salt=None, iterations=None):
+        """Return `content` decrypted, optionally written with another salt."""
+        with instrumentation.timed(instrumentation.DECRYPT_TIME):
+            content = cls.fernet_generator(password, salt, iterations).decrypt(content)
+        instrumentation.record(instrumentation.DECRYPTED_BYTES, len(content))
+        return content
+
+    @classmethod
+    def reencrypted(cls, old_password, new_password, content, salt=None, iterations=None):
+        """Decrypt `content` written with the given format and encrypt it again."""
+        return cls.encrypted(
+            new_password,
+            cls.decrypted(old_password, content, salt=salt, iterations=iterations),
+        )
+
+
+class AESCryptographer(object):
+    """Python side of the `pgcrypto_aes_encrypt` and `pgcrypto_aes_decrypt` functions.
+
+    See `migrations/0003_aes_functions.py` for the format.
+    """
+    iv_size = 16
+    tag_size = 16
+
+    @classmethod
+    def derived_keys(cls, key):
+        """Return the encryption and MAC keys derived from a row key."""
+        raw_key = base64.b64decode(key)
+        return (
+            hmac.new(raw_key, b'enc', hashlib.sha256).digest(),
+            hmac.new(raw_key, b'mac', hashlib.sha256).digest(),
+        )
+
+    @classmethod
+    def encrypted(cls, key, content):
+        """Return `content` encrypted and authenticated with the keys of `key`."""
+        encryption_key, mac_key = cls.derived_keys(key)
+        iv = urandom(cls.iv_size)
+        padder = padding.PKCS7(algorithms.AES.block_size).padder()
+        encryptor = Cipher(
+            algorithms.AES(encryption_key), modes.CBC(iv), backend=default_backend()
+        ).encryptor()
+        padded = padder.update(content) + padder.finalize()
+        signed = iv + encryptor.update(padded) + encryptor.finalize()
+        return signed + hmac.new(mac_key, signed, hashlib.sha256).digest()[:cls.tag_size]
+
+    @classmethod
+    def decrypted(cls, key, content):
+        """Return the plaintext of `content` after checking its HMAC."""
+        content = bytes(content)
+        if len(content) < 2 * cls.iv_size + cls.tag_size:
+            raise ValueError('Wrong key or corrupt data')
+        encryption_key, mac_key = cls.derived_keys(key)
+        signed, tag = content[:-cls.tag_size], content[-cls.tag_size:]
+        expected = hmac.new(mac_key, signed, hashlib.sha256).digest()[:cls.tag_size]
+        if not hmac.compare_digest(tag, expected):
+            raise ValueError('Wrong key or corrupt data')
+
+        iv, encrypted = signed[:cls.iv_size], signed[cls.iv_size:]
+        decryptor = Cipher(
+            algorithms.AES(encryption_key), modes.CBC(iv), backend=default_backend()
+        ).decryptor()
+        unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+        padded = decryptor.update(encrypted) + decryptor.finalize()
+        return unpadder.update(padded) + unpadder.finalize()
@@ -0,0 +1,154 @@
+"""Catch queries that decrypt a whole table to filter, group or sort it.
+
+`pgp_sym_decrypt(...)` or `pgcrypto_aes_decrypt(...)` (or a column of their
+lateral projection) in a WHERE, GROUP BY, HAVING, ORDER BY or DISTINCT ON
+clause can't use an index: every row is decrypted to evaluate it. With
+`DEBUG` on and `PGCRYPTO_DECRYPTED_SCAN_CHECK` set to `'log'` or `'raise'`,
+such queries are `EXPLAIN`ed before they run and reported when the planner
+expects to decrypt at least `PGCRYPTO_DECRYPTED_SCAN_ROWS` rows.
+"""
+import json
+import logging
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import connections
+
+from pgcrypto import DECRYPT_FUNCTIONS, DECRYPTED_ALIAS
+
+logger = logging.getLogger(__name__)
+
+CLAUSES = ('DISTINCT ON', 'WHERE', 'GROUP BY', 'HAVING', 'ORDER BY')
+END_OF_DISTINCT_ON = ' FROM '
+PLAN_KEYS = ('Filter', 'Join Filter', 'Sort Key', 'Group Key', 'Hash Cond', 'Merge Cond')
+# Columns of `DecryptOnceMixin`'s lateral projections are decrypted too.
+DECRYPTED_SUFFIX = DECRYPTED_ALIAS.format('')
+RELTUPLES_SQL = 'SELECT reltuples::bigint FROM pg_class WHERE relname = %s'
+DEFAULT_ROWS = 1000
+
+
+class DecryptedScanError(Exception):
+    """A query decrypts too many rows to filter, group or sort them."""
+
+
+DecryptedScan = namedtuple('DecryptedScan', ['clauses', 'rows', 'sql'])
+
+
+def decrypts(sql):
+    """Tell whether `sql` calls a decryption function or reads a decrypted column."""
+    return DECRYPTED_SUFFIX in sql or any(
+        function in sql for function in DECRYPT_FUNCTIONS)
+
+
+def decrypted_clauses(sql):
+    """Return the clauses of `sql` that decrypt a column, in query order."""
+    positions = sorted(
+        (sql.find(' {} '.format(clause)), clause)
+        for clause in CLAUSES
+        if ' {} '.format(clause) in sql
+    )
+    clauses = []
+    for i, (start, clause) in enumerate(positions):
+        if clause == 'DISTINCT ON':
+            end = sql.find(END_OF_DISTINCT_ON, start)
+        else:
+            end = positions[i + 1][0] if i + 1 < len(positions) else len(sql)
+        if decrypts(sql[start:end]):
+            clauses.append(clause)
+    return clauses
+
+
+def _nodes(plan, parent=None):
+    yield plan, parent
+    for child in plan.get('Plans', []):
+        yield from _nodes(child, plan)
+
+
+def estimate_decrypted_rows(connection, sql, params):
+    """Estimate how many rows the plan of `sql` decrypts in its conditions and keys."""
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+
+        rows = 0
+        for node, parent in _nodes(plan[0]['Plan']):
+            if not any(decrypts(str(node.get(key, ''))) for key in PLAN_KEYS):
+                continue
+            if 'Relation Name' in node:
+                # A scan's filter sees the whole relation, not its estimated output.
+                cursor.execute(RELTUPLES_SQL, [node['Relation Name']])
+                row = cursor.fetchone()
+                node_rows = max(row[0] if row else 0, node['Plan Rows'])
+            elif parent is not None and node.get('Parent Relationship') == 'Inner':
+                # A lateral projection runs once per row of the outer side.
+                node_rows = sum(
+                    child['Plan Rows'] for child in parent['Plans']
+                    if child.get('Parent Relationship') == 'Outer')
+            else:
+                node_rows = sum(child['Plan Rows'] for child in node.get('Plans', []))
+            rows = max(rows, node_rows)
+    return rows
+
+
+def check_sql(connection, sql, params, threshold=0):
+    """Return a `DecryptedScan` when `sql` decrypts at least `threshold` rows."""
+    clauses = decrypted_clauses(sql)
+    if not clauses:
+        return None
+
+    rows = estimate_decrypted_rows(connection, sql, params)
+    if rows < threshold:
+        return None
+    return DecryptedScan(clauses, rows, sql)
+
+
+def check_queryset(queryset, threshold=0):
+    """Check the query of `queryset`, e.g. from a test or the shell."""
+    connection = connections[queryset.db]
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    return check_sql(connection, sql, params, threshold)
+
+
+class DecryptedScanChecker(object):
+    """`execute_wrapper` reporting decrypted scans before running them."""
+
+    def __init__(self, connection, mode, threshold):
+        """Report with `mode` ('log' or 'raise') from `threshold` rows on."""
+        self.connection = connection
+        self.mode = mode
+        self.threshold = threshold
+        self.checking = False
+
+    def __call__(self, execute, sql, params, many, context):
+        """Check `sql` unless it is the checker's own query."""
+        if not many and not self.checking and decrypts(sql):
+            self.checking = True
+            try:
+                scan = check_sql(self.connection, sql, params, self.threshold)
+            finally:
+                self.checking = False
+            if scan is not None:
+                self.report(scan)
+        return execute(sql, params, many, context)
+
+    def report(self, scan):
+        """Log or raise about `scan`."""
+        message = 'Query decrypts ~{} rows in {}: {}'.format(
+            scan.rows, ', '.join(scan.clauses), scan.sql)
+        if self.mode == 'raise':
+            raise DecryptedScanError(message)
+        logger.warning(message)
+
+
+def install_checker(sender, connection, **kwargs):
+    """`connection_created` receiver adding the checker in debug mode."""
+    mode = getattr(settings, 'PGCRYPTO_DECRYPTED_SCAN_CHECK', None)
+    if not settings.DEBUG or not mode or not hasattr(connection, 'execute_wrappers'):
+        return
+    if any(isinstance(w, DecryptedScanChecker) for w in connection.execute_wrappers):
+        return
+
+    threshold = getattr(settings, 'PGCRYPTO_DECRYPTED_SCAN_ROWS', DEFAULT_ROWS)
+    connection.execute_wrappers.append(DecryptedScanChecker(connection, mode, threshold))
@@ -1,24 +1,34 @@
+import os
+import re
 from io import BytesIO
 
-import redis
-from django.db import models
+from django.contrib.postgres.fields import ArrayField
+from django.core.files.base import ContentFile
+from django.db import connections, models, router
 from django.db.models.fields.files import (
     FieldFile,
     FileField,
     ImageField,
     ImageFieldFile
 )
-from django.urls import reverse
 
 from pgcrypto import (
+    binary,
+    keys,
     PGP_SYM_ENCRYPT_SQL_WITH_NULLIF,
+    PGP_SYM_ENCRYPT_SQL_WITH_NULLIF_AND_OPTIONS,
+    search,
 )
 from pgcrypto.mixins import (
+    AESFieldMixin,
+    Ciphertext,
     DecimalPGPFieldMixin,
     PGPSymmetricKeyFieldMixin,
-    Encryption)
-from .constants import FETCH_URL_NAME, REDIS_HOST, REDIS_PORT
-from .crypt import Cryptographer
+)
+from .constants import get_fetch_url_name
+
+# Names of the image variants, also used in their storage names and URLs.
+VARIANT_NAME_RE = re.compile(r'^\w+$')
 
 
 class EmailPGPSymmetricKeyField(PGPSymmetricKeyFieldMixin, models.EmailField):
@@ -28,7 +38,9 @@ class EmailPGPSymmetricKeyField(PGPSymmetricKeyFieldMixin, models.EmailField):
 class IntegerPGPSymmetricKeyField(PGPSymmetricKeyFieldMixin, models.IntegerField):
     """Integer PGP symmetric key encrypted field."""
     encrypt_sql = PGP_SYM_ENCRYPT_SQL_WITH_NULLIF
+    encrypt_sql_with_options = PGP_SYM_ENCRYPT_SQL_WITH_NULLIF_AND_OPTIONS
     cast_type = 'INT4'
+    binary_codec = binary.IntegerCodec
 
 
 class TextPGPSymmetricKeyField(PGPSymmetricKeyFieldMixin, models.TextField):
@@ -42,34 +54,133 @@ class CharPGPSymmetricKeyField(PGPSymmetricKeyFieldMixin, models.CharField):
 class DatePGPSymmetricKeyField(PGPSymmetricKeyFieldMixin, models.DateField):
     """Date PGP symmetric key encrypted field for postgres."""
     encrypt_sql = PGP_SYM_ENCRYPT_SQL_WITH_NULLIF
+    encrypt_sql_with_options = PGP_SYM_ENCRYPT_SQL_WITH_NULLIF_AND_OPTIONS
     cast_type = 'DATE'
+    binary_codec = binary.DateCodec
 
 
 class DateTimePGPSymmetricKeyField(PGPSymmetricKeyFieldMixin, models.DateTimeField):
     """DateTime PGP symmetric key encrypted field for postgres."""
     encrypt_sql = PGP_SYM_ENCRYPT_SQL_WITH_NULLIF
+    encrypt_sql_with_options = PGP_SYM_ENCRYPT_SQL_WITH_NULLIF_AND_OPTIONS
     cast_type = 'TIMESTAMP'
+    binary_codec = binary.DateTimeCodec
 
 
 class DecimalPGPSymmetricKeyField(DecimalPGPFieldMixin,
                                   PGPSymmetricKeyFieldMixin, models.DecimalField):
     """Decimal PGP symmetric key encrypted field for postgres."""
+    binary_codec = binary.DecimalCodec
 
 
 class FloatPGPSymmetricKeyField(PGPSymmetricKeyFieldMixin, models.FloatField):
     """Float PGP symmetric key encrypted field for postgres."""
     encrypt_sql = PGP_SYM_ENCRYPT_SQL_WITH_NULLIF
+    encrypt_sql_with_options = PGP_SYM_ENCRYPT_SQL_WITH_NULLIF_AND_OPTIONS
     cast_type = 'DOUBLE PRECISION'
 
 
 class TimePGPSymmetricKeyField(PGPSymmetricKeyFieldMixin, models.TimeField):
     """Float PGP symmetric key encrypted field for postgres."""
     encrypt_sql = PGP_SYM_ENCRYPT_SQL_WITH_NULLIF
+    encrypt_sql_with_options = PGP_SYM_ENCRYPT_SQL_WITH_NULLIF_AND_OPTIONS
     cast_type = 'TIME'
 
 
+class EmailAESField(AESFieldMixin, models.EmailField):
+    """Email AES encrypted field for postgres."""
+
+
+class IntegerAESField(AESFieldMixin, models.IntegerField):
+    """Integer AES encrypted field for postgres."""
+    cast_type = 'INT4'
+
+
+class TextAESField(AESFieldMixin, models.TextField):
+    """Text AES encrypted field for postgres."""
+
+
+class CharAESField(AESFieldMixin, models.CharField):
+    """Char AES encrypted field for postgres."""
+
+
+class DateAESField(AESFieldMixin, models.DateField):
+    """Date AES encrypted field for postgres."""
+    cast_type = 'DATE'
+
+
+class DateTimeAESField(AESFieldMixin, models.DateTimeField):
+    """DateTime AES encrypted field for postgres."""
+    cast_type = 'TIMESTAMP'
+
+
+class DecimalAESField(DecimalPGPFieldMixin, AESFieldMixin, models.DecimalField):
+    """Decimal AES encrypted field for postgres."""
+
+
+class FloatAESField(AESFieldMixin, models.FloatField):
+    """Float AES encrypted field for postgres."""
+    cast_type = 'DOUBLE PRECISION'
+
+
+class TimeAESField(AESFieldMixin, models.TimeField):
+    """Time AES encrypted field for postgres."""
+    cast_type = 'TIME'
+
+
+class SearchTokensField(ArrayField):
+    """Search tokens of the encrypted field `source`, see `pgcrypto.search`.
+
+    Holds keyed hashes of the lowercased prefixes (up to `prefix_length`
+    characters) and `ngram_size` n-grams of the value, set on save. Index it
+    with a `GinIndex` for `__istartswith` and `__icontains` on `source` to
+    only decrypt the candidate rows.
+    """
+
+    def __init__(self, source, ngram_size=3, prefix_length=20, **kwargs):
+        """Index the field named `source`."""
+        self.source = source
+        self.ngram_size = ngram_size
+        self.prefix_length = prefix_length
+        kwargs.setdefault('default', list)
+        kwargs.setdefault('blank', True)
+        kwargs['editable'] = False
+        kwargs.pop('base_field', None)
+        super().__init__(models.TextField(), **kwargs)
+
+    def deconstruct(self):
+        """Replace the base field by the token options."""
+        name, path, args, kwargs = super().deconstruct()
+        del kwargs['base_field']
+        kwargs.pop('editable', None)
+        kwargs['source'] = self.source
+        if self.ngram_size != 3:
+            kwargs['ngram_size'] = self.ngram_size
+        if self.prefix_length != 20:
+            kwargs['prefix_length'] = self.prefix_length
+        return name, path, args, kwargs
+
+    def pre_save(self, model_instance, add):
+        """Compute the tokens of the current `source` value."""
+        if isinstance(getattr(model_instance, self.source), Ciphertext):
+            # Encrypted in python by a bulk operation, which set the tokens first.
+            return getattr(model_instance, self.attname)
+        using = model_instance._state.db or router.db_for_write(
+            type(model_instance), instance=model_instance)
+        tokens = search.value_tokens(
+            getattr(model_instance, self.source),
+            search.get_search_key(connections[using]),
+            self.ngram_size,
+            self.prefix_length,
+        )
+        setattr(model_instance, self.attname, tokens)
+        return tokens
+
+
 class EncryptedFile(BytesIO):
     def __init__(self, content, password):
+        from .crypt import Cryptographer
+
         self.size = content.size
         BytesIO.__init__(self, Cryptographer.encrypted(password, content.file.read()))
 
@@ -79,38 +190,22 @@ class FileEncryptionMixin(object):
         super().__init__(*args, **kwargs)
         self.key = None  # todo: perhaps default key?
 
+    @staticmethod
+    def get_instance_key(instance):
+        """Return the key of `instance` from the database it is saved to."""
+        using = instance._state.db or router.db_for_write(
+            type(instance), instance=instance)
+        return keys.get_key(getattr(instance, "pk"), using=using)
+
     def pre_save(self, model_instance, add):
         """Save the original_value."""
-        key_id = getattr(model_instance, "pk")
-
-        from django.db import connection
-        with connection.cursor() as cursor:
-            cursor.execute("select key from key_store where id = %s::text", (key_id,))
-            row = cursor.fetchone()
-            if row is None:
-                self.key = Encryption.generate_key()
-                r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0)
-                r.set(str(key_id), self.key, nx=True)
-                self.key = r.get(str(key_id)).decode('utf-8')
-            else:
-                self.key = row[0]
+        self.key = self.get_instance_key(model_instance)
 
         return super(FileEncryptionMixin, self).pre_save(model_instance, add)
 
     def save(self, name, content, save=True):
         if self.key is None:
-            key_id = getattr(self.instance, "pk")
-
-            from django.db import connection
-            with connection.cursor() as cursor:
-                cursor.execute("select key from key_store where id = %s::text", (key_id,))
-                row = cursor.fetchone()
-                if row is None:
-                    self.key = Encryption.generate_key()
-                    r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0)
-                    r.set(str(key_id), self.key, nx=True)
-                else:
-                    self.key = row[0]
+            self.key = self.get_instance_key(self.instance)
 
         return FieldFile.save(
             self,
@@ -122,19 +217,119 @@ class FileEncryptionMixin(object):
     save.alters_data = True
 
     def _get_url(self):
-        return "%s?id=%s" % (reverse(FETCH_URL_NAME, kwargs={
+        from django.urls import reverse
+
+        return "%s?id=%s" % (reverse(get_fetch_url_name(), kwargs={
             "path": super(FileEncryptionMixin, self).url,
         }), str(self.instance.pk))
 
     url = property(_get_url)
 
 
+def variant_name(name, variant):
+    """Return the storage name of the `variant` derivative of the file `name`.
+
+    Uploaded file names never contain `~` (see `get_valid_filename`), so a
+    variant name can't be the name of another upload.
+    """
+    root, ext = os.path.splitext(name)
+    return '{}~{}{}'.format(root, variant, ext)
+
+
+def make_variants(content, sizes):
+    """Return the images of `content` resized to fit `sizes`, by variant name.
+
+    `sizes` maps the variant names to (width, height) boxes, the aspect ratio
+    being kept; the variants have the format of the original image.
+    """
+    from PIL import Image
+
+    original = Image.open(BytesIO(content))
+    original.load()
+    variants = {}
+    for variant, size in sizes.items():
+        image = original.copy()
+        image.thumbnail(size)
+        output = BytesIO()
+        image.save(output, format=original.format)
+        variants[variant] = output.getvalue()
+    return variants
+
+
 class EncryptedFieldFile(FileEncryptionMixin, FieldFile):
     pass
 
 
 class EncryptedImageFieldFile(FileEncryptionMixin, ImageFieldFile):
-    pass
+    def save(self, name, content, save=True):
+        """Encrypt the image and its variants with the row key.
+
+        The dimensions are read from the plaintext into the width and height
+        fields, and the variants are resized from it, as neither can be read
+        from the stored ciphertext.
+        """
+        from django.core.files.images import get_image_dimensions
+
+        if self.key is None:
+            self.key = self.get_instance_key(self.instance)
+
+        self._dimensions_cache = get_image_dimensions(content)
+        width, height = self._dimensions_cache
+        if self.field.width_field:
+            setattr(self.instance, self.field.width_field, width)
+        if self.field.height_field:
+            setattr(self.instance, self.field.height_field, height)
+
+        variants = {}
+        if self.field.variants:
+            content.seek(0)
+            variants = make_variants(content.read(), self.field.variants)
+            content.seek(0)
+
+        super().save(name, content, save=False)
+        password = self.key.encode('utf-8')
+        for variant, data in variants.items():
+            variant_path = variant_name(self.name, variant)
+            # The name of the image is new: a file there can only be a variant
+            # left by a deleted image of the same name.
+            self.storage.delete(variant_path)
+            saved = self.storage.save(
+                variant_path, EncryptedFile(ContentFile(data), password=password))
+            if saved != variant_path:
+                self.storage.delete(saved)
+                raise ValueError('Storage renamed the "{}" variant of {} to "{}".'.format(
+                    variant, self.name, saved))
+
+        if save:
+            self.instance.save()
+
+    save.alters_data = True
+
+    def delete(self, save=True):
+        """Delete the variants along with the image."""
+        if self.name:
+            for variant in self.field.variants:
+                self.storage.delete(variant_name(self.name, variant))
+        super().delete(save=save)
+
+    delete.alters_data = True
+
+    def _get_image_dimensions(self):
+        """Return the dimensions saved in the width and height fields."""
+        if not hasattr(self, '_dimensions_cache'):
+            self._dimensions_cache = (
+                getattr(self.instance, self.field.width_field, None)
+                if self.field.width_field else None,
+                getattr(self.instance, self.field.height_field, None)
+                if self.field.height_field else None,
+            )
+        return self._dimensions_cache
+
+    def variant_url(self, variant):
+        """Return the URL `FetchView` serves the `variant` of the image at."""
+        if variant not in self.field.variants:
+            raise ValueError('{} has no "{}" variant.'.format(self.field, variant))
+        return '{}&variant={}'.format(self.url, variant)
 
 
 class EncryptedFileField(FileField):
@@ -142,15 +337,35 @@ class EncryptedFileField(FileField):
 
 
 class EncryptedImageField(ImageField):
+    """Encrypted image, with optional resized `variants`.
+
+    `variants` maps names to (width, height) boxes: the image is resized to
+    fit each of them on save, and the variants are encrypted with the row key
+    next to the original.
+    """
     attr_class = EncryptedImageFieldFile
 
+    def __init__(self, *args, variants=None, **kwargs):
+        """Check the names of the variants."""
+        self.variants = dict(variants or {})
+        for variant in self.variants:
+            if not VARIANT_NAME_RE.match(variant):
+                raise ValueError('Invalid image variant name "{}".'.format(variant))
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        """Add the variants."""
+        name, path, args, kwargs = super().deconstruct()
+        if self.variants:
+            kwargs['variants'] = self.variants
+        return name, path, args, kwargs
+
     def update_dimension_fields(self, instance, force=False, *args, **kwargs):
         """
         Since we're encrypting the file, any attempts to force recalculation of
         the dimensions will always fail, resulting in a null value for height
-        and width.  To avoid that, we just set force=False all the time and
-        expect that if you want to change those values, you'll do it on your
-        own.
+        and width.  To avoid that, we just set force=False all the time: the
+        dimensions are set from the plaintext by `EncryptedImageFieldFile.save`.
         """
         ImageField.update_dimension_fields(
             self, instance, force=False, *args, **kwargs)
@@ -0,0 +1,259 @@
+"""Cache of the files decrypted by `FetchView`.
+
+With `PGCRYPTO_FILE_CACHE_BYTES`, the plaintext of the served files is kept
+in a memory LRU of that many bytes, and with `PGCRYPTO_FILE_CACHE_DIR` in a
+second tier of files in that directory, bounded by
+`PGCRYPTO_FILE_CACHE_DIR_BYTES`. The directory holds plaintext: it must be a
+tmpfs or an encrypted volume only readable by the application.
+
+Files are cached by row key id and path, with a version combining the
+fingerprint of the key and the mtime or ETag of the stored file: a rotated key
+or a replaced file is a miss and replaces the cached version. The files of
+keys evicted from the key caches (shredded or rotated, see
+`pgcrypto.invalidation`) are evicted from both tiers.
+"""
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+
+from . import instrumentation
+
+_lock = threading.Lock()
+_cache = None
+
+# Names of the files of the directory tier: digests of the key id, path and version.
+CACHE_FILE_RE = re.compile(r'^[0-9a-f]{16}-[0-9a-f]{32}-[0-9a-f]{32}$')
+
+
+def _digest(value, length=32):
+    return hashlib.sha256(value.encode('utf-8')).hexdigest()[:length]
+
+
+def fingerprint(key):
+    """Return a fingerprint of the row key `key`, distinguishing rotated keys."""
+    return _digest(key, 16)
+
+
+class MemoryTier:
+    """LRU of file contents holding up to `max_bytes` bytes."""
+
+    def __init__(self, max_bytes):
+        """Start empty."""
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key_id, path, version):
+        """Return the cached `version` of the file, `None` if it isn't cached."""
+        with self.lock:
+            entry = self.entries.get((key_id, path))
+            if entry is None or entry[0] != version:
+                return None
+            self.entries.move_to_end((key_id, path))
+            return entry[1]
+
+    def set(self, key_id, path, version, content):
+        """Cache `content`, replacing the other versions of the file."""
+        with self.lock:
+            self._pop((key_id, path))
+            self.entries[(key_id, path)] = (version, content)
+            self.size += len(content)
+            while self.size > self.max_bytes:
+                self._pop(next(iter(self.entries)))
+
+    def evict(self, key_ids):
+        """Drop the files of `key_ids`."""
+        with self.lock:
+            for entry_key in [k for k in self.entries if k[0] in key_ids]:
+                self._pop(entry_key)
+
+    def clear(self):
+        """Drop every file."""
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def _pop(self, entry_key):
+        entry = self.entries.pop(entry_key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+
+class DirectoryTier:
+    """Files of up to `max_bytes` bytes in `directory`, evicted by last use.
+
+    The directory can be shared by the processes of a host: the file names
+    start with digests of the key id and path, so that any process can evict
+    the files of a key or the other versions of a file. Files not named like
+    the cached ones are never removed.
+    """
+
+    def __init__(self, directory, max_bytes):
+        """Create `directory` if needed."""
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    @staticmethod
+    def prefix(key_id, path=None):
+        """Return the prefix of the file names of `key_id`, or of its file `path`."""
+        prefix = _digest(key_id, 16) + '-'
+        if path is not None:
+            prefix += _digest(path) + '-'
+        return prefix
+
+    def get(self, key_id, path, version):
+        """Return the cached `version` of the file, `None` if it isn't cached."""
+        name = os.path.join(self.directory, self.prefix(key_id, path) + _digest(version))
+        try:
+            with open(name, 'rb') as f:
+                content = f.read()
+            os.utime(name)
+        except FileNotFoundError:
+            return None
+        return content
+
+    def set(self, key_id, path, version, content):
+        """Cache `content`, replacing the other versions of the file."""
+        self._remove(self.prefix(key_id, path))
+        fd, temp_name = tempfile.mkstemp(dir=self.directory, prefix='.')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(temp_name, os.path.join(
+            self.directory, self.prefix(key_id, path) + _digest(version)))
+        self._trim()
+
+    def evict(self, key_ids):
+        """Remove the files of `key_ids`."""
+        for key_id in key_ids:
+            self._remove(self.prefix(key_id))
+
+    def clear(self):
+        """Remove every file."""
+        self._remove('')
+
+    def _entries(self):
+        # Files being written are hidden, other files aren't the cache's.
+        return [
+            entry for entry in os.scandir(self.directory)
+            if CACHE_FILE_RE.match(entry.name)
+        ]
+
+    def _remove(self, prefix):
+        for entry in self._entries():
+            if entry.name.startswith(prefix):
+                self._unlink(entry.path)
+
+    def _trim(self):
+        entries = []
+        for entry in self._entries():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            self._unlink(path)
+            size -= entry_size
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+class FileCache:
+    """The memory tier, then the optional directory tier."""
+
+    def __init__(self, max_bytes, max_file_bytes=None, directory=None,
+                 directory_bytes=None):
+        """Cache the files of up to `max_file_bytes` bytes."""
+        self.max_file_bytes = max_file_bytes or max_bytes // 8
+        self.tiers = [MemoryTier(max_bytes)]
+        if directory:
+            self.tiers.append(DirectoryTier(directory, directory_bytes or max_bytes))
+
+    def get(self, key_id, path, version):
+        """Return the cached `version` of the file, `None` if it isn't cached.
+
+        A file found in the directory tier is brought back into memory.
+        """
+        key_id = str(key_id)
+        for index, tier in enumerate(self.tiers):
+            content = tier.get(key_id, path, version)
+            if content is not None:
+                instrumentation.record(instrumentation.FILE_CACHE_HITS)
+                if index:
+                    self.tiers[0].set(key_id, path, version, content)
+                return content
+        instrumentation.record(instrumentation.FILE_CACHE_MISSES)
+        return None
+
+    def set(self, key_id, path, version, content):
+        """Cache `content` in every tier unless it is too big."""
+        if len(content) > self.max_file_bytes:
+            return
+        for tier in self.tiers:
+            tier.set(str(key_id), path, version, content)
+
+    def evict(self, key_ids):
+        """Drop the files of `key_ids` from every tier."""
+        key_ids = {str(key_id) for key_id in key_ids}
+        for tier in self.tiers:
+            tier.evict(key_ids)
+
+    def clear(self):
+        """Drop every file from every tier."""
+        for tier in self.tiers:
+            tier.clear()
+
+
+def get_cache():
+    """Return the `FileCache` configured by the settings, `None` if disabled."""
+    global _cache
+    max_bytes = getattr(settings, 'PGCRYPTO_FILE_CACHE_BYTES', None)
+    if not max_bytes:
+        return None
+    with _lock:
+        if _cache is None:
+            _cache = FileCache(
+                max_bytes,
+                getattr(settings, 'PGCRYPTO_FILE_CACHE_MAX_FILE_BYTES', None),
+                getattr(settings, 'PGCRYPTO_FILE_CACHE_DIR', None),
+                getattr(settings, 'PGCRYPTO_FILE_CACHE_DIR_BYTES', None),
+            )
+        return _cache
+
+
+def evict(key_ids):
+    """Drop the files of `key_ids` from the cache, if it was used."""
+    if _cache is not None:
+        _cache.evict(key_ids)
+
+
+def clear():
+    """Drop every cached file, if the cache was used."""
+    if _cache is not None:
+        _cache.clear()
+
+
+def _reset(setting, **kwargs):
+    global _cache
+    if setting.startswith('PGCRYPTO_FILE_CACHE'):
+        with _lock:
+            _cache = None
+
+
+setting_changed.connect(_reset)
@@ -0,0 +1,169 @@
+"""Counters for the decryption and key lookup work done by pgcrypto.
+
+Code paths call `record(name, value)`; the values are added to every
+collection active on the current thread (see `collect`) and sent with the
+`metric_recorded` signal for exporters such as statsd or prometheus.
+"""
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from django.db import connections
+from django.dispatch import Signal
+
+from pgcrypto import DECRYPT_FUNCTIONS
+
+# Number of `DecryptedCol` compiled into SQL.
+DECRYPTED_COLUMNS = 'decrypted_columns'
+# Executed queries decrypting in the database and their duration in seconds.
+DECRYPT_QUERIES = 'decrypt_queries'
+DECRYPT_QUERY_TIME = 'decrypt_query_time'
+# Lookups answered by the in-process key cache, or not.
+KEY_CACHE_HITS = 'key_cache_hits'
+KEY_CACHE_MISSES = 'key_cache_misses'
+# Files served by `FetchView` from the file cache, or decrypted.
+FILE_CACHE_HITS = 'file_cache_hits'
+FILE_CACHE_MISSES = 'file_cache_misses'
+# `key_store` queries issued from python.
+KEY_STORE_QUERIES = 'key_store_queries'
+# Round trips to the redis key store.
+REDIS_CALLS = 'redis_calls'
+# Python side decryption (files and `decrypt_in_python`): seconds spent and
+# bytes produced.
+DECRYPT_TIME = 'decrypt_time'
+DECRYPTED_BYTES = 'decrypted_bytes'
+# Field values decrypted in python by `PGPQuerySet.decrypt_in_python`.
+PYTHON_DECRYPTED_VALUES = 'python_decrypted_values'
+# Field values encrypted in python with `PGCRYPTO_ENCRYPT_IN_PYTHON`.
+PYTHON_ENCRYPTED_VALUES = 'python_encrypted_values'
+
+metric_recorded = Signal(providing_args=['name', 'value'])
+
+_local = threading.local()
+
+
+class Metrics(Counter):
+    """Values recorded while a collection was active."""
+
+    def __str__(self):
+        """List the recorded values."""
+        return ', '.join('{}={}'.format(name, self[name]) for name in sorted(self))
+
+
+def _active():
+    try:
+        return _local.collections
+    except AttributeError:
+        _local.collections = []
+        return _local.collections
+
+
+def record(name, value=1):
+    """Add `value` to the metric `name`."""
+    for metrics in _active():
+        metrics[name] += value
+    if metric_recorded.has_listeners():
+        metric_recorded.send(sender=None, name=name, value=value)
+
+
+@contextmanager
+def timed(name):
+    """Record the time spent in the block under `name`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def _time_decrypt_queries(execute, sql, params, many, context):
+    if not any(function in sql for function in DECRYPT_FUNCTIONS):
+        return execute(sql, params, many, context)
+
+    record(DECRYPT_QUERIES)
+    with timed(DECRYPT_QUERY_TIME):
+        return execute(sql, params, many, context)
+
+
+@contextmanager
+def collect():
+    """Collect the metrics recorded on this thread within the block.
+
+    Queries decrypting in the database are also counted and timed on every
+    connection of the thread.
+    """
+    metrics = Metrics()
+    active = _active()
+    outermost = not active
+    active.append(metrics)
+    wrappers = []
+    try:
+        if outermost:
+            for connection in connections.all():
+                if hasattr(connection, 'execute_wrapper'):
+                    wrapper = connection.execute_wrapper(_time_decrypt_queries)
+                    wrapper.__enter__()
+                    wrappers.append(wrapper)
+        yield metrics
+    finally:
+        for wrapper in reversed(wrappers):
+            wrapper.__exit__(None, None, None)
+        active.remove(metrics)
+
+
+@contextmanager
+def assert_max_metrics(**limits):
+    """Fail when the block records more than `limits`, e.g. `decrypted_columns=4`."""
+    with collect() as metrics:
+        yield metrics
+
+    exceeded = [
+        '{} {} > {}'.format(name, metrics[name], limit)
+        for name, limit in sorted(limits.items())
+        if metrics[name] > limit
+    ]
+    if exceeded:
+        raise AssertionError('pgcrypto metrics exceeded: {} ({})'.format(
+            ', '.join(exceeded), metrics))
+
+
+def server_timing(metrics):
+    """Format `metrics` as a `Server-Timing` header value."""
+    entries = [
+        'pgcrypto-db;dur={:.1f};desc="{} decrypting queries, {} columns"'.format(
+            metrics[DECRYPT_QUERY_TIME] * 1000,
+            metrics[DECRYPT_QUERIES],
+            metrics[DECRYPTED_COLUMNS],
+        ),
+        'pgcrypto-keys;desc="{} hits, {} misses, {} key_store queries, '
+        '{} redis calls"'.format(
+            metrics[KEY_CACHE_HITS],
+            metrics[KEY_CACHE_MISSES],
+            metrics[KEY_STORE_QUERIES],
+            metrics[REDIS_CALLS],
+        ),
+    ]
+    if metrics[DECRYPTED_BYTES]:
+        entries.append('pgcrypto-files;dur={:.1f};desc="{} bytes decrypted"'.format(
+            metrics[DECRYPT_TIME] * 1000, metrics[DECRYPTED_BYTES]))
+    return ', '.join(entries)
+
+
+class ServerTimingMiddleware(object):
+    """Collect the metrics of each request into a `Server-Timing` header."""
+
+    def __init__(self, get_response=None):
+        """Keep the next handler."""
+        self.get_response = get_response
+
+    def __call__(self, request):
+        """Add the pgcrypto metrics of the request to the response."""
+        with collect() as metrics:
+            response = self.get_response(request)
+
+        value = server_timing(metrics)
+        if response.has_header('Server-Timing'):
+            value = '{}, {}'.format(response['Server-Timing'], value)
+        response['Server-Timing'] = value
+        return response
@@ -0,0 +1,211 @@
+"""Evict keys from the in-process caches when they change in redis.
+
+With `PGCRYPTO_KEY_CACHE_INVALIDATION`, a thread of each process listens to
+redis and drops the keys written or deleted by any process from the caches of
+`pgcrypto.keys`:
+
+* `'tracking'`: server assisted client side caching (redis 6+). A connection
+  with `CLIENT TRACKING ON BCAST` redirects the invalidation of every written
+  key to the listener, whichever client wrote it.
+* `'pubsub'`: the ids published on `INVALIDATION_CHANNEL` by
+  `keys.store_keys` and `keys.delete_keys`, for servers without tracking.
+
+The listener subscribes on every node of a sharded key store. Keys are only
+cached while it is connected, and the caches are emptied when it loses a
+connection since invalidations may have been missed.
+"""
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from . import sharding
+from .constants import get_redis_host, get_redis_nodes, get_redis_port
+
+logger = logging.getLogger(__name__)
+
+MODES = ('tracking', 'pubsub')
+INVALIDATION_CHANNEL = 'pgcrypto:invalidate'
+TRACKING_CHANNEL = '__redis__:invalidate'
+# Seconds between the pings checking the connections, and before reconnecting.
+PING_INTERVAL = 5
+RECONNECT_DELAY = 1
+# Seconds waited for messages on each node in turn with several nodes.
+POLL_INTERVAL = 0.05
+
+_lock = threading.Lock()
+_listener = None
+# Incremented by every invalidation, see `start_read`.
+_generation = 0
+
+
+def get_mode():
+    """Return the `PGCRYPTO_KEY_CACHE_INVALIDATION` mode, or `None`."""
+    mode = getattr(settings, 'PGCRYPTO_KEY_CACHE_INVALIDATION', None)
+    if mode and mode not in MODES:
+        raise ImproperlyConfigured(
+            'PGCRYPTO_KEY_CACHE_INVALIDATION must be one of {}, not {!r}.'.format(
+                MODES, mode))
+    return mode
+
+
+def start_read():
+    """Return a token to cache the keys about to be read, `None` if they can't be.
+
+    Keys read from redis are only cached if `is_current(token)` once read, so
+    that an invalidation received meanwhile isn't overwritten by a stale key.
+    """
+    mode = get_mode()
+    if mode and not get_listener(mode).connected.is_set():
+        return None
+    return _generation
+
+
+def is_current(token):
+    """Tell whether no invalidation was received since `start_read` returned `token`."""
+    return token is not None and token == _generation
+
+
+def invalidate(key_ids=None):
+    """Evict `key_ids`, or every key, from the key caches."""
+    global _generation
+    from . import keys
+
+    _generation += 1
+    if key_ids is None:
+        keys.clear_caches()
+    else:
+        keys.evict(key_ids)
+
+
+def get_listener(mode):
+    """Return the listener thread of this process for `mode`, starting it if needed."""
+    global _listener
+    listener = _listener
+    if listener is not None and listener.mode == mode and listener.is_current():
+        return listener
+
+    with _lock:
+        if _listener is None or _listener.mode != mode or not _listener.is_current():
+            if _listener is not None:
+                _listener.stop()
+            _listener = Listener(mode)
+            _listener.start()
+        return _listener
+
+
+def stop():
+    """Stop the listener of this process, if any."""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener.join(PING_INTERVAL)
+            _listener = None
+
+
+class Listener(threading.Thread):
+    """Thread receiving the invalidations of `mode` and evicting the keys."""
+    daemon = True
+
+    def __init__(self, mode):
+        """Listen for `mode` invalidations in this process."""
+        super().__init__(name='pgcrypto-invalidation')
+        self.mode = mode
+        self.pid = os.getpid()
+        self.connected = threading.Event()
+        self.stopped = threading.Event()
+        self.connections = []
+
+    def is_current(self):
+        """Tell whether the thread runs in this process, threads don't survive a fork."""
+        return self.pid == os.getpid() and not self.stopped.is_set() and self.is_alive()
+
+    def stop(self):
+        """Ask the thread to disconnect and end."""
+        self.stopped.set()
+
+    def run(self):
+        """Listen, and start over with empty caches when the connection is lost."""
+        import redis
+
+        while not self.stopped.is_set():
+            try:
+                self.listen()
+            except (redis.RedisError, OSError):
+                logger.warning('Key cache invalidation connection lost.', exc_info=True)
+            finally:
+                self.connected.clear()
+                for connection in self.connections:
+                    connection.disconnect()
+                self.connections = []
+                invalidate()
+            self.stopped.wait(RECONNECT_DELAY)
+
+    def connect(self, node=None):
+        """Return a new connection to the key store, or to one of its nodes."""
+        import redis
+
+        if node is None:
+            host, port = get_redis_host() or 'localhost', get_redis_port() or 6379
+        else:
+            host, port = sharding.parse_node(node)
+        connection = redis.Connection(host=host, port=port)
+        self.connections.append(connection)
+        return connection
+
+    def command(self, connection, *args):
+        """Send a command on `connection` and return its response."""
+        connection.send_command(*args)
+        return connection.read_response()
+
+    def subscribe(self, node):
+        """Subscribe to the invalidations of `node`, return the subscriber and tracker."""
+        subscriber = self.connect(node)
+        if self.mode != 'tracking':
+            self.command(subscriber, 'SUBSCRIBE', INVALIDATION_CHANNEL)
+            return subscriber, None
+
+        client_id = self.command(subscriber, 'CLIENT', 'ID')
+        self.command(subscriber, 'SUBSCRIBE', TRACKING_CHANNEL)
+        tracker = self.connect(node)
+        self.command(tracker, 'CLIENT', 'TRACKING', 'ON', 'REDIRECT', client_id, 'BCAST')
+        return subscriber, tracker
+
+    def listen(self):
+        """Subscribe to the invalidations and evict the keys until stopped."""
+        nodes = list(dict.fromkeys(
+            get_redis_nodes() + get_redis_nodes('REDIS_PREVIOUS_NODES'))) or [None]
+        subscribed = [self.subscribe(node) for node in nodes]
+        self.connected.set()
+
+        timeout = PING_INTERVAL if len(subscribed) == 1 else POLL_INTERVAL
+        pinged = time.monotonic()
+        while not self.stopped.is_set():
+            for subscriber, _ in subscribed:
+                while subscriber.can_read(timeout=timeout):
+                    self.handle(subscriber.read_response())
+            if time.monotonic() - pinged < PING_INTERVAL:
+                continue
+            # Check the connections are still there.
+            pinged = time.monotonic()
+            for subscriber, tracker in subscribed:
+                subscriber.send_command('PING')
+                if tracker is not None:
+                    self.command(tracker, 'PING')
+
+    def handle(self, message):
+        """Evict the keys named by a pubsub `message`."""
+        if message[0] != b'message':
+            return
+        data = message[2]
+        if data is None:
+            # The tracked keys were flushed.
+            invalidate()
+        elif isinstance(data, list):
+            invalidate(key_id.decode('utf-8') for key_id in data)
+        else:
+            invalidate(data.decode('utf-8').split(','))
@@ -0,0 +1,377 @@
+"""Access to the redis key store backing the `key_store` foreign table."""
+from base64 import b64encode
+from functools import lru_cache
+from os import urandom
+
+from django.db import DEFAULT_DB_ALIAS
+
+from . import file_cache, instrumentation, invalidation, sharding
+from .constants import (
+    get_redis_host,
+    get_redis_nodes,
+    get_redis_port,
+    get_redis_staging_db,
+)
+
+# Staging hash holding the keys replaced by a rotation, by checkpoint name.
+PREVIOUS_KEYS_NAME = 'pgcrypto:previous:{}'
+
+KEY_SQL = 'select key from key_store where id = %s::text'
+LOCAL_KEYS_UPSERT_SQL = (
+    'INSERT INTO pgcrypto_localkey (id, key) '
+    'SELECT * FROM unnest(%s::text[], %s::text[]) '
+    'ON CONFLICT (id) DO UPDATE SET key = EXCLUDED.key'
+)
+LOCAL_KEYS_DELETE_SQL = 'DELETE FROM pgcrypto_localkey WHERE id = ANY(%s::text[])'
+
+# In-process caches of the keys resolved by `get_key`, by database alias then
+# stringified id. `cache` is the default database's.
+caches = {DEFAULT_DB_ALIAS: {}}
+cache = caches[DEFAULT_DB_ALIAS]
+
+
+@lru_cache(maxsize=None)
+def get_redis(db=0, node=None):
+    """Return a (pooled) redis client for the key store, or one of its `node`s."""
+    import redis
+
+    if node is None:
+        return redis.Redis(host=get_redis_host(), port=get_redis_port(), db=db)
+    host, port = sharding.parse_node(node)
+    return redis.Redis(host=host, port=port, db=db)
+
+
+def get_ring(previous=False):
+    """Return the `HashRing` of `DEFF_REDIS_NODES`, or of the previous nodes.
+
+    `None` when the key store isn't sharded.
+    """
+    nodes = get_redis_nodes('REDIS_PREVIOUS_NODES' if previous else 'REDIS_NODES')
+    return sharding.get_ring(nodes) if nodes else None
+
+
+def get_nodes():
+    """Return every node of the key store, current and previous, or `[None]`."""
+    nodes = get_redis_nodes() + get_redis_nodes('REDIS_PREVIOUS_NODES')
+    return list(dict.fromkeys(nodes)) or [None]
+
+
+def group_by_node(key_ids):
+    """Return `key_ids` by the node holding them."""
+    ring = get_ring()
+    if ring is None:
+        return {None: list(key_ids)} if key_ids else {}
+    return ring.group(key_ids)
+
+
+def moved_key_ids(key_ids):
+    """Return `key_ids` by the previous node of those not yet moved to their node."""
+    previous = get_ring(previous=True)
+    if previous is None:
+        return {}
+    current = get_ring()
+    moved = {}
+    for key_id in key_ids:
+        node = previous.get_node(key_id)
+        if current is None or node != current.get_node(key_id):
+            moved.setdefault(node, []).append(key_id)
+    return moved
+
+
+def get_cache(using=None):
+    """Return the key cache of the database `using`."""
+    return caches.setdefault(using or DEFAULT_DB_ALIAS, {})
+
+
+def clear_caches():
+    """Empty the key caches of every database, and the file cache."""
+    for database_cache in caches.values():
+        database_cache.clear()
+    file_cache.clear()
+
+
+def cache_keys(keys, token, using=None):
+    """Cache `keys` read after `invalidation.start_read()` returned `token`."""
+    if invalidation.is_current(token):
+        get_cache(using).update(keys)
+
+
+def evict(key_ids):
+    """Remove `key_ids` from the key caches of every database, and their files."""
+    key_ids = [str(key_id) for key_id in key_ids]
+    for key_id in key_ids:
+        for database_cache in caches.values():
+            database_cache.pop(key_id, None)
+    file_cache.evict(key_ids)
+
+
+def get_read_database(using=None):
+    """Return the alias of the database reading the `key_store` of `using`.
+
+    `PGCRYPTO_KEY_READ_DATABASE`, in the settings of `using` or globally, sends
+    the key reads to a replica with the same `key_store` foreign table.
+    """
+    from django.conf import settings
+    using = using or DEFAULT_DB_ALIAS
+    database = settings.DATABASES.get(using, {})
+    if 'PGCRYPTO_KEY_READ_DATABASE' in database:
+        return database['PGCRYPTO_KEY_READ_DATABASE'] or using
+    return getattr(settings, 'PGCRYPTO_KEY_READ_DATABASE', None) or using
+
+
+def generate_key():
+    """Return a new random 256 bit key, base64 encoded."""
+    return b64encode(urandom(32)).decode('utf-8')
+
+
+def get_key(key_id, create=True, use_cache=True, using=None):
+    """Return the key of `key_id` from the `key_store` table of `using`.
+
+    The table is read on `get_read_database(using)` and the key cached per
+    database. A new key is stored for ids without one unless `create` is
+    false, in which case `None` is returned.
+    """
+    key_id = str(key_id)
+    cache = get_cache(using)
+    token = invalidation.start_read()
+    if use_cache:
+        try:
+            key = cache[key_id]
+        except KeyError:
+            instrumentation.record(instrumentation.KEY_CACHE_MISSES)
+        else:
+            instrumentation.record(instrumentation.KEY_CACHE_HITS)
+            return key
+
+    from django.db import connections
+    with connections[get_read_database(using)].cursor() as cursor:
+        instrumentation.record(instrumentation.KEY_STORE_QUERIES)
+        cursor.execute(KEY_SQL, (key_id,))
+        row = cursor.fetchone()
+
+    if row is not None:
+        key = row[0]
+    elif create:
+        key = create_key(key_id, using=using)
+    else:
+        return None
+
+    if use_cache:
+        cache_keys({key_id: key}, token, using)
+    return key
+
+
+def get_keys(key_ids, use_cache=True, fill_cache=True, using=None):
+    """Return the keys of `key_ids` by stringified id, missing ones left out.
+
+    Ids not in the cache of `using` are fetched with a single `MGET` and,
+    with `fill_cache`, cached. Unlike `get_key`, no key is created.
+    """
+    cache = get_cache(using)
+    token = invalidation.start_read()
+    found = {}
+    missing = []
+    for key_id in {str(key_id) for key_id in key_ids}:
+        if use_cache and key_id in cache:
+            found[key_id] = cache[key_id]
+        else:
+            missing.append(key_id)
+    if use_cache and found:
+        instrumentation.record(instrumentation.KEY_CACHE_HITS, len(found))
+    if use_cache and missing:
+        instrumentation.record(instrumentation.KEY_CACHE_MISSES, len(missing))
+
+    fetched = fetch_keys(missing)
+    if use_cache and fill_cache:
+        cache_keys(fetched, token, using)
+    found.update(fetched)
+    return found
+
+
+def create_key(key_id, using=None):
+    """Store a new key for `key_id` unless one exists and return the stored key."""
+    return create_keys([key_id], using=using)[str(key_id)]
+
+
+def create_keys(key_ids, using=None):
+    """Store new keys for the `key_ids` without one and return all their keys.
+
+    The batched `create_key`: one pipelined round trip per node for any number
+    of ids. While rebalancing, keys not moved yet are moved rather than
+    replaced by new ones.
+    """
+    key_ids = [str(key_id) for key_id in key_ids]
+    if not key_ids:
+        return {}
+
+    moved = fetch_keys_from(moved_key_ids(key_ids))
+    created = {}
+    for node, node_ids in group_by_node(key_ids).items():
+        pipe = get_redis(node=node).pipeline(transaction=False)
+        for key_id in node_ids:
+            pipe.set(key_id, moved.get(key_id) or generate_key(), nx=True)
+        pipe.mget(node_ids)
+        instrumentation.record(instrumentation.REDIS_CALLS)
+        values = pipe.execute()[-1]
+        created.update(
+            (key_id, value.decode('utf-8')) for key_id, value in zip(node_ids, values))
+    store_local_keys(created, using=using)
+    return created
+
+
+def fetch_keys_from(key_ids_by_node):
+    """Fetch the keys of ids grouped by node, with one `MGET` per node."""
+    found = {}
+    for node, key_ids in key_ids_by_node.items():
+        instrumentation.record(instrumentation.REDIS_CALLS)
+        values = get_redis(node=node).mget(key_ids)
+        found.update(
+            (key_id, value.decode('utf-8'))
+            for key_id, value in zip(key_ids, values)
+            if value is not None
+        )
+    return found
+
+
+def fetch_keys(key_ids):
+    """Fetch the keys of `key_ids` with a single `MGET` per node.
+
+    Returns a dict mapping the stringified id to its key. Ids without a key
+    are left out. While rebalancing, the keys not found on their node are
+    looked up on their previous one.
+    """
+    key_ids = [str(key_id) for key_id in key_ids]
+    if not key_ids:
+        return {}
+
+    found = fetch_keys_from(group_by_node(key_ids))
+    missing = [key_id for key_id in key_ids if key_id not in found]
+    if missing:
+        found.update(fetch_keys_from(moved_key_ids(missing)))
+    return found
+
+
+def write_keys(key_ids, write, publish=False):
+    """Call `write(pipe, node_ids)` with a pipeline of each node, then run them.
+
+    While rebalancing, the ids are also written on their previous node.
+    """
+    groups = [group_by_node(key_ids), moved_key_ids(key_ids)]
+    for node_ids_by_node in groups:
+        for node, node_ids in node_ids_by_node.items():
+            pipe = get_redis(node=node).pipeline(transaction=False)
+            write(pipe, node_ids)
+            if publish:
+                publish_invalidation(pipe, node_ids)
+            instrumentation.record(instrumentation.REDIS_CALLS)
+            pipe.execute()
+
+
+def publish_invalidation(pipe, key_ids):
+    """Add the publication of `key_ids` to `pipe` in the `'pubsub'` invalidation mode."""
+    if key_ids and invalidation.get_mode() == 'pubsub':
+        pipe.publish(invalidation.INVALIDATION_CHANNEL, ','.join(key_ids))
+
+
+def store_keys(keys, nx=False, using=None):
+    """Write a mapping of id to key in one pipelined round trip.
+
+    Unless `nx`, the replaced keys are evicted from the key caches, and from
+    those of the other processes with `PGCRYPTO_KEY_CACHE_INVALIDATION`.
+    """
+    keys = {str(key_id): key for key_id, key in keys.items()}
+
+    def write(pipe, key_ids):
+        for key_id in key_ids:
+            pipe.set(key_id, keys[key_id], nx=nx)
+
+    write_keys(list(keys), write, publish=not nx)
+    if not nx:
+        evict(keys)
+        store_local_keys(keys, using=using)
+
+
+def delete_keys(key_ids, using=None):
+    """Shred the keys of `key_ids`: what they encrypted can't be decrypted anymore.
+
+    The keys are deleted from redis, the key caches (of every process with
+    `PGCRYPTO_KEY_CACHE_INVALIDATION`) and the local key table of `using`.
+    """
+    key_ids = [str(key_id) for key_id in key_ids]
+    if not key_ids:
+        return
+
+    write_keys(key_ids, lambda pipe, node_ids: pipe.delete(*node_ids), publish=True)
+    evict(key_ids)
+    if local_keys_enabled():
+        from django.db import connections
+        with connections[using or DEFAULT_DB_ALIAS].cursor() as cursor:
+            cursor.execute(LOCAL_KEYS_DELETE_SQL, [key_ids])
+
+
+def local_keys_enabled():
+    """Tell whether `PGCRYPTO_LOCAL_KEYS` is set globally or for a database."""
+    from django.conf import settings
+    return getattr(settings, 'PGCRYPTO_LOCAL_KEYS', False) or any(
+        database.get('PGCRYPTO_LOCAL_KEYS') for database in settings.DATABASES.values())
+
+
+def store_local_keys(keys, using=None, force=False):
+    """Copy `keys` to the local key table read by `pgcrypto_row_key`.
+
+    Done on every key write when `local_keys_enabled()`, so that the copy
+    stays current; `pgcrypto_sync_local_keys` fills it for existing keys.
+    """
+    if not keys or not (force or local_keys_enabled()):
+        return
+    from django.db import connections
+    with connections[using or DEFAULT_DB_ALIAS].cursor() as cursor:
+        cursor.execute(LOCAL_KEYS_UPSERT_SQL, [
+            [str(key_id) for key_id in keys], list(keys.values())])
+
+
+def scan_key_ids(node=None, count=1000):
+    """Iterate over the ids of the keys stored on `node`, or on every node."""
+    for scanned in get_nodes() if node is None else [node]:
+        for key_id in get_redis(node=scanned).scan_iter(count=count):
+            yield key_id.decode('utf-8')
+
+
+def get_staging_redis():
+    """Return the client of the staging db, on the first node of a sharded key store."""
+    return get_redis(get_redis_staging_db(), get_nodes()[0])
+
+
+def stage_keys(name, keys):
+    """Park `keys` in the staging hash `name`, outside the `key_store` db."""
+    if not keys:
+        return
+    pipe = get_staging_redis().pipeline(transaction=False)
+    for key_id, key in keys.items():
+        pipe.hset(name, str(key_id), key)
+    pipe.execute()
+
+
+def fetch_staged_keys(name, key_ids=None):
+    """Read keys back from the staging hash `name`."""
+    r = get_staging_redis()
+    if key_ids is None:
+        staged = r.hgetall(name)
+        return {k.decode('utf-8'): v.decode('utf-8') for k, v in staged.items()}
+
+    key_ids = [str(key_id) for key_id in key_ids]
+    if not key_ids:
+        return {}
+    values = r.hmget(name, key_ids)
+    return {
+        key_id: value.decode('utf-8')
+        for key_id, value in zip(key_ids, values)
+        if value is not None
+    }
+
+
+def unstage_keys(name, key_ids):
+    """Remove `key_ids` from the staging hash `name`."""
+    key_ids = [str(key_id) for key_id in key_ids]
+    if key_ids:
+        get_staging_redis().hdel(name, *key_ids)
@@ -1,4 +1,7 @@
-from django.db.models.lookups import Lookup
+from django.db.models.expressions import Col
+from django.db.models.lookups import IContains, IStartsWith, Lookup
+
+from pgcrypto import search
 
 
 class HashLookup(Lookup):
@@ -20,3 +23,52 @@ class HashLookup(Lookup):
         params = lhs_params + rhs_params
         rhs = self.lhs.field.encrypt_sql % rhs
         return ('{}::bytea = {}'.format(lhs, rhs)), params
+
+
+class SearchTokenLookupMixin:
+    """Match the search tokens of the value before decrypting it.
+
+    Used when the model has a `SearchTokensField` for the field: the token
+    condition is answered by the index and the decrypted comparison only
+    verifies the candidates. Otherwise, or when the searched text is too
+    short to have tokens, the lookup decrypts every row as usual.
+    """
+
+    def get_search_tokens(self, tokens_field, connection):
+        """Return the tokens every match has, or `None`."""
+        raise NotImplementedError('The `get_search_tokens` needs to be implemented.')
+
+    def as_sql(self, compiler, connection):
+        """Prefix the decrypted comparison with the token match."""
+        sql, params = super().as_sql(compiler, connection)
+        target = getattr(self.lhs, 'target', None)
+        tokens_field = getattr(target, 'search_tokens_field', None)
+        searchable = isinstance(self.lhs, Col) and isinstance(self.rhs, str)
+        if tokens_field is None or not searchable:
+            return sql, params
+
+        tokens = self.get_search_tokens(tokens_field, connection)
+        if not tokens:
+            return sql, params
+        column, column_params = compiler.compile(tokens_field.get_col(self.lhs.alias))
+        sql = '({} @> %s::text[] AND {})'.format(column, sql)
+        return sql, column_params + [tokens] + params
+
+
+class SearchTokenIStartsWith(SearchTokenLookupMixin, IStartsWith):
+    """`istartswith` narrowed down by the prefix tokens."""
+
+    def get_search_tokens(self, tokens_field, connection):
+        """Return the tokens of the searched prefix."""
+        return search.startswith_tokens(
+            self.rhs, search.get_search_key(connection),
+            tokens_field.ngram_size, tokens_field.prefix_length)
+
+
+class SearchTokenIContains(SearchTokenLookupMixin, IContains):
+    """`icontains` narrowed down by the n-gram tokens."""
+
+    def get_search_tokens(self, tokens_field, connection):
+        """Return the n-gram tokens of the searched text."""
+        return search.contains_tokens(
+            self.rhs, search.get_search_key(connection), tokens_field.ngram_size)
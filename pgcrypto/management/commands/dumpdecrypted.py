@@ -0,0 +1,100 @@
+import csv
+import json
+import time
+
+from django.apps import apps
+from django.core.exceptions import FieldDoesNotExist
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DEFAULT_DB_ALIAS
+
+from pgcrypto.managers import PGPQuerySet
+
+
+class Command(BaseCommand):
+    help = (
+        'Write the decrypted rows of a model as CSV or JSON Lines, streaming them '
+        'with a server-side cursor and decrypting a chunk at a time.'
+    )
+
+    def add_arguments(self, parser):
+        """Define the command line."""
+        parser.add_argument('model', help='Model to export as app_label.ModelName.')
+        parser.add_argument('--format', choices=('csv', 'jsonl'), default='jsonl')
+        parser.add_argument(
+            '--fields', default=None,
+            help='Comma separated field names to export, defaults to all the columns.',
+        )
+        parser.add_argument(
+            '-o', '--output', default=None,
+            help='File to write to, defaults to the standard output.',
+        )
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument(
+            '--in-database', action='store_true',
+            help='Decrypt in postgres (with the prefetched keys) rather than in python.',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=None,
+            help='Size of the thread pool decrypting in python.',
+        )
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        """Export the model."""
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+
+        fields = model._meta.concrete_fields
+        if options['fields']:
+            names = [name.strip() for name in options['fields'].split(',')]
+            try:
+                fields = [model._meta.get_field(name) for name in names]
+            except FieldDoesNotExist as e:
+                raise CommandError(str(e))
+
+        queryset = PGPQuerySet(model=model, using=options['database']).order_by('pk')
+        rows = queryset.decrypted_iterator(
+            chunk_size=options['chunk_size'],
+            in_database=options['in_database'],
+            workers=options['workers'],
+        )
+
+        output = self.stdout
+        if options['output']:
+            output = open(options['output'], 'w', newline='')
+        started = time.time()
+        try:
+            count = self.write(output, options['format'], fields, rows)
+        finally:
+            if options['output']:
+                output.close()
+
+        elapsed = max(time.time() - started, 1e-6)
+        self.stderr.write('{}: exported {} rows in {:.1f}s ({:.0f} rows/s).'.format(
+            model._meta.label, count, elapsed, count / elapsed))
+
+    def write(self, output, format, fields, rows):
+        """Write `rows` to `output` and return their number."""
+        count = 0
+        if format == 'csv':
+            writer = csv.writer(output)
+            writer.writerow([field.attname for field in fields])
+            for obj in rows:
+                writer.writerow([
+                    ''
+                    if field.value_from_object(obj) is None
+                    else field.value_to_string(obj)
+                    for field in fields
+                ])
+                count += 1
+        else:
+            for obj in rows:
+                output.write(json.dumps(
+                    {field.attname: field.value_from_object(obj) for field in fields},
+                    cls=DjangoJSONEncoder,
+                ) + '\n')
+                count += 1
+        return count
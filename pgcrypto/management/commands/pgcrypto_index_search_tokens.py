@@ -0,0 +1,65 @@
+import time
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router
+
+from pgcrypto.fields import SearchTokensField
+from pgcrypto.managers import PGPQuerySet
+
+
+class Command(BaseCommand):
+    help = (
+        'Compute the SearchTokensField tokens of the existing rows of a model, '
+        'e.g. after adding the field or updating the rows outside of the ORM.'
+    )
+
+    def add_arguments(self, parser):
+        """Define the command line."""
+        parser.add_argument('model', help='Model to index, as app_label.ModelName.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='Number of rows decrypted and updated at a time.',
+        )
+        parser.add_argument(
+            '--database', help='Database to use instead of the routed one.')
+
+    def handle(self, *args, **options):
+        """Recompute the tokens chunk by chunk, in primary key order."""
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+
+        fields = [
+            field for field in model._meta.concrete_fields
+            if isinstance(field, SearchTokensField)
+        ]
+        if not fields:
+            raise CommandError(
+                '{} has no search tokens fields.'.format(model._meta.label))
+
+        database = options['database'] or router.db_for_write(model)
+        queryset = PGPQuerySet(model, using=database).order_by('pk').only(
+            *[field.source for field in fields])
+
+        started = time.time()
+        count = 0
+        last_pk = None
+        while True:
+            chunk = queryset
+            if last_pk is not None:
+                chunk = chunk.filter(pk__gt=last_pk)
+            objs = list(chunk[:options['chunk_size']])
+            if not objs:
+                break
+            for obj in objs:
+                for field in fields:
+                    field.pre_save(obj, False)
+            queryset.bulk_update(objs, [field.name for field in fields])
+            count += len(objs)
+            last_pk = objs[-1].pk
+
+        elapsed = max(time.time() - started, 1e-6)
+        self.stdout.write('Indexed {} rows of {} in {:.1f}s ({:.0f} rows/s).'.format(
+            count, model._meta.label, elapsed, count / elapsed))
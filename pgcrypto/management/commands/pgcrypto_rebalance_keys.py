@@ -0,0 +1,98 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pgcrypto import keys, sharding
+
+
+class Command(BaseCommand):
+    help = (
+        'Move the keys of a sharded key store (DEFF_REDIS_NODES) to the node they hash '
+        'to, e.g. after adding nodes.'
+    )
+
+    def add_arguments(self, parser):
+        """Define the command line."""
+        parser.add_argument(
+            '--batch-size', type=int, default=5000,
+            help='Number of keys scanned and moved per round trip.',
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Count the keys to move without moving them.',
+        )
+        parser.add_argument(
+            '--keep', action='store_true',
+            help='Leave the moved keys on their previous node as well.',
+        )
+        parser.add_argument(
+            '--key-store-sql', action='store_true',
+            help='Print the SQL making key_store a view over every node, and exit.',
+        )
+
+    def handle(self, *args, **options):
+        """Scan every node and move the keys it shouldn't hold."""
+        ring = keys.get_ring()
+        if ring is None:
+            raise CommandError(
+                'DEFF_REDIS_NODES is not set: the key store is not sharded.')
+        if options['key_store_sql']:
+            for statement in sharding.key_store_sql(keys.get_nodes()):
+                self.stdout.write(statement)
+            return
+
+        self.dry_run = options['dry_run']
+        self.keep = options['keep']
+        batch_size = options['batch_size']
+        started = time.time()
+        moved = conflicts = 0
+        for node in keys.get_nodes():
+            batch = []
+            for key_id in keys.scan_key_ids(node, count=batch_size):
+                if ring.get_node(key_id) != node:
+                    batch.append(key_id)
+                if len(batch) >= batch_size:
+                    result = self.move(node, batch, ring)
+                    moved, conflicts = self.add(result, moved, conflicts)
+                    batch = []
+            moved, conflicts = self.add(self.move(node, batch, ring), moved, conflicts)
+
+        elapsed = max(time.time() - started, 1e-6)
+        self.stdout.write('{} {} keys in {:.1f}s ({:.0f} keys/s), {} conflicts.'.format(
+            'Would move' if self.dry_run else 'Moved', moved, elapsed, moved / elapsed,
+            conflicts))
+        if conflicts:
+            raise CommandError(
+                '{} keys differ from the key already on their node and were left in '
+                'place.'.format(conflicts))
+
+    @staticmethod
+    def add(counts, moved, conflicts):
+        """Add the counts of a batch."""
+        return moved + counts[0], conflicts + counts[1]
+
+    def move(self, node, key_ids, ring):
+        """Copy `key_ids` from `node` to their node and return the moved and conflicts."""
+        if not key_ids or self.dry_run:
+            return len(key_ids), 0
+
+        source = keys.get_redis(node=node)
+        values = dict(zip(key_ids, source.mget(key_ids)))
+        moved = []
+        conflicts = 0
+        for target, target_ids in ring.group([k for k in key_ids if values[k]]).items():
+            pipe = keys.get_redis(node=target).pipeline(transaction=False)
+            for key_id in target_ids:
+                pipe.set(key_id, values[key_id], nx=True)
+            pipe.mget(target_ids)
+            stored = pipe.execute()[-1]
+            for key_id, value in zip(target_ids, stored):
+                if value == values[key_id]:
+                    moved.append(key_id)
+                else:
+                    self.stderr.write('Key {} differs on {}.'.format(key_id, target))
+                    conflicts += 1
+
+        if moved and not self.keep:
+            source.delete(*moved)
+        return len(moved), conflicts
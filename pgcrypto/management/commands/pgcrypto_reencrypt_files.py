@@ -0,0 +1,278 @@
+import os
+import time
+from concurrent.futures import as_completed, ProcessPoolExecutor, ThreadPoolExecutor
+
+from cryptography.fernet import InvalidToken
+from django.apps import apps
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router
+
+from pgcrypto import keys
+from pgcrypto.constants import get_bytes
+from pgcrypto.crypt import Cryptographer
+from pgcrypto.fields import EncryptedFileField, EncryptedImageField, variant_name
+from pgcrypto.models import Checkpoint
+
+
+def reencrypt(content, old_key, new_key, salt, iterations):
+    """Re-encrypt one file; runs in the process pool.
+
+    Returns `None` for files an interrupted run already re-encrypted.
+    """
+    try:
+        return Cryptographer.reencrypted(
+            old_key.encode('utf-8'), new_key.encode('utf-8'), content,
+            salt=salt, iterations=iterations,
+        )
+    except InvalidToken:
+        Cryptographer.decrypted(new_key.encode('utf-8'), content)
+        return None
+
+
+def encrypted_file_fields(model):
+    """Return the encrypted file fields of `model`."""
+    return [
+        field for field in model._meta.fields
+        if isinstance(field, (EncryptedFileField, EncryptedImageField))
+    ]
+
+
+class Command(BaseCommand):
+    help = (
+        'Re-encrypt the files of EncryptedFileField and EncryptedImageField, either '
+        'from an older file format or from the keys replaced by pgcrypto_rotate_keys.'
+    )
+
+    def add_arguments(self, parser):
+        """Define the command line."""
+        parser.add_argument(
+            'models', nargs='*',
+            help='Models to process as app_label.ModelName, defaults to all models '
+                 'with encrypted file fields.',
+        )
+        parser.add_argument(
+            '--rotation',
+            help='Label of a pgcrypto_rotate_keys run; files are decrypted with the '
+                 'keys it replaced and encrypted with the current ones.',
+        )
+        parser.add_argument(
+            '--source-salt',
+            help='Salt the files were written with, defaults to DEFF_SALT.',
+        )
+        parser.add_argument(
+            '--source-iterations', type=int,
+            help='PBKDF2 iterations the files were written with, defaults to {}.'.format(
+                Cryptographer.iterations),
+        )
+        parser.add_argument('--chunk-size', type=int, default=100)
+        parser.add_argument(
+            '--processes', type=int, default=None,
+            help='Size of the process pool doing the (CPU bound) re-encryption.',
+        )
+        parser.add_argument(
+            '--io-threads', type=int, default=8,
+            help='Number of concurrent storage reads and writes.',
+        )
+        parser.add_argument(
+            '--label', default='default',
+            help='Checkpoint name. Reuse it to resume an interrupted run.',
+        )
+        parser.add_argument(
+            '--restart', action='store_true',
+            help='Ignore the saved checkpoints and start from the first row.',
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only count the files and the bytes that would be re-encrypted.',
+        )
+
+    def handle(self, *args, **options):
+        """Re-encrypt the files of every selected model."""
+        if options['models']:
+            try:
+                models = [apps.get_model(label) for label in options['models']]
+            except (LookupError, ValueError) as e:
+                raise CommandError(str(e))
+        else:
+            models = [
+                model for model in apps.get_models() if encrypted_file_fields(model)]
+
+        models = [(model, encrypted_file_fields(model)) for model in models]
+        for model, fields in models:
+            if not fields:
+                raise CommandError('{} has no encrypted file fields.'.format(
+                    model._meta.label))
+
+        self.options = options
+        self.salt = get_bytes(options['source_salt']) if options['source_salt'] else None
+        self.iterations = options['source_iterations']
+
+        io_pool = ThreadPoolExecutor(max_workers=options['io_threads'])
+        cpu_pool = None
+        if not options['dry_run']:
+            cpu_pool = ProcessPoolExecutor(options['processes'])
+        try:
+            for model, fields in models:
+                if options['dry_run']:
+                    self.estimate(model, fields, io_pool)
+                else:
+                    self.reencrypt_model(model, fields, io_pool, cpu_pool)
+        finally:
+            io_pool.shutdown()
+            if cpu_pool is not None:
+                cpu_pool.shutdown()
+
+    def iter_chunks(self, model, fields, database, last_pk=None):
+        """Yield rows of (pk, file names) with keyset pagination."""
+        pk_field = model._meta.pk
+        queryset = model._default_manager.using(database).order_by('pk').values_list(
+            'pk', *[field.attname for field in fields])
+        while True:
+            chunk = queryset
+            if last_pk is not None:
+                chunk = chunk.filter(pk__gt=pk_field.to_python(last_pk))
+            rows = list(chunk[:self.options['chunk_size']])
+            if not rows:
+                return
+            yield rows
+            last_pk = rows[-1][0]
+
+    def files_of(self, rows, fields):
+        """Return (pk, storage, name) for every non empty file of `rows`.
+
+        The image variants are included, missing ones are skipped when read.
+        """
+        return [
+            (row[0], field.storage, file_name)
+            for row in rows
+            for field, name in zip(fields, row[1:])
+            if name
+            for file_name in [name] + [
+                variant_name(name, variant) for variant in getattr(field, 'variants', ())
+            ]
+        ]
+
+    def estimate(self, model, fields, io_pool):
+        """Report how much data a real run would process."""
+        database = router.db_for_read(model)
+        count = size = 0
+        for rows in self.iter_chunks(model, fields, database):
+            files = self.files_of(rows, fields)
+            sizes = io_pool.map(
+                lambda f: f[1].size(f[2]) if f[1].exists(f[2]) else 0, files)
+            count += len(files)
+            size += sum(sizes)
+        self.stdout.write('{}: {} files, {:.1f} MiB would be re-encrypted.'.format(
+            model._meta.label, count, size / 2 ** 20))
+
+    def reencrypt_model(self, model, fields, io_pool, cpu_pool):
+        """Re-encrypt the files of one model, chunk by chunk."""
+        database = router.db_for_write(model)
+        name = 'files:{}:{}'.format(self.options['label'], model._meta.label_lower)
+        checkpoint, _ = Checkpoint.objects.using(database).get_or_create(name=name)
+        if self.options['restart']:
+            checkpoint.last_pk = None
+            checkpoint.processed = 0
+
+        previous_name = None
+        if self.options['rotation']:
+            previous_name = keys.PREVIOUS_KEYS_NAME.format(
+                'rotate:{}'.format(self.options['rotation']))
+
+        started = time.time()
+        count = size = 0
+        for rows in self.iter_chunks(model, fields, database, checkpoint.last_pk):
+            chunk_count, chunk_size = self.reencrypt_chunk(
+                self.files_of(rows, fields), previous_name, io_pool, cpu_pool)
+            count += chunk_count
+            size += chunk_size
+            if previous_name:
+                # Also drops the keys of rows whose files were removed since.
+                keys.unstage_keys(previous_name, [row[0] for row in rows])
+
+            checkpoint.last_pk = str(rows[-1][0])
+            checkpoint.processed += chunk_count
+            checkpoint.save(using=database)
+
+        elapsed = max(time.time() - started, 1e-6)
+        self.stdout.write(self.style.SUCCESS(
+            '{}: re-encrypted {} files, {:.1f} MiB in {:.1f}s '
+            '({:.1f} files/s, {:.2f} MiB/s).'
+            .format(model._meta.label, count, size / 2 ** 20, elapsed,
+                    count / elapsed, size / 2 ** 20 / elapsed)
+        ))
+
+    def reencrypt_chunk(self, files, previous_name, io_pool, cpu_pool):
+        """Read, re-encrypt and write back the files of one chunk.
+
+        The three stages overlap: a file is handed to the process pool as soon
+        as it has been read and written back as soon as it is re-encrypted.
+        """
+        pks = {pk for pk, _, _ in files}
+        new_keys = keys.fetch_keys(pks)
+        if previous_name:
+            old_keys = keys.fetch_staged_keys(previous_name, pks)
+        else:
+            old_keys = new_keys
+
+        files = [f for f in files if str(f[0]) in old_keys and str(f[0]) in new_keys]
+        reads = {
+            io_pool.submit(self.read, storage, name): (pk, storage, name)
+            for pk, storage, name in files
+        }
+
+        crypts = {}
+        for future in as_completed(reads):
+            pk, storage, name = reads[future]
+            content = future.result()
+            if content is None:
+                continue
+            crypts[cpu_pool.submit(
+                reencrypt, content, old_keys[str(pk)], new_keys[str(pk)],
+                self.salt, self.iterations,
+            )] = (storage, name)
+
+        writes = []
+        size = 0
+        for future in as_completed(crypts):
+            storage, name = crypts[future]
+            content = future.result()
+            if content is None:
+                continue
+            size += len(content)
+            writes.append(io_pool.submit(self.write, storage, name, content))
+        for future in as_completed(writes):
+            future.result()
+        return len(crypts), size
+
+    @staticmethod
+    def read(storage, name):
+        """Return the content of the stored file `name`, `None` if it is missing."""
+        if not storage.exists(name):
+            return None
+        with storage.open(name, 'rb') as f:
+            return f.read()
+
+    @staticmethod
+    def write(storage, name, content):
+        """Replace the stored file `name` with `content`, never losing both copies.
+
+        `content` is first saved next to the file. Local storages then rename
+        it over the file; other storages delete the file only once the copy is
+        stored, and the copy once the file is written again.
+        """
+        root, ext = os.path.splitext(name)
+        copy = storage.save('{}.reencrypted{}'.format(root, ext), ContentFile(content))
+        try:
+            path, copy_path = storage.path(name), storage.path(copy)
+        except NotImplementedError:
+            storage.delete(name)
+            saved = storage.save(name, ContentFile(content))
+            if saved != name:
+                raise CommandError(
+                    'Storage renamed "{}" to "{}" while re-encrypting, the content '
+                    'is kept in "{}".'.format(name, saved, copy))
+            storage.delete(copy)
+        else:
+            os.replace(copy_path, path)
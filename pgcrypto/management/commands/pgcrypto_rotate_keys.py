@@ -0,0 +1,280 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router, transaction
+
+from pgcrypto import (
+    AES_REENCRYPT_SQL,
+    keys,
+    PGP_SYM_REENCRYPT_BYTEA_SQL,
+    PGP_SYM_REENCRYPT_SQL,
+)
+from pgcrypto.management.commands.pgcrypto_reencrypt_files import encrypted_file_fields
+from pgcrypto.mixins import AESFieldMixin, Encryption, RowKeyFieldMixin
+from pgcrypto.models import Checkpoint
+
+STAGING_NAME = 'pgcrypto:rotation:{}'
+
+ROTATE_SQL = (
+    'UPDATE {table} SET {assignments} '
+    'FROM (VALUES {values}) AS v (id, old_key, new_key) '
+    'WHERE {table}.{pk} = v.id::{pk_type}'
+)
+ADD_PENDING_SQL = 'UPDATE {table} SET pending = pending || %s::text[] WHERE id = %s'
+REMOVE_PENDING_SQL = (
+    'UPDATE {table} SET pending = ('
+    'SELECT coalesce(array_agg(p), \'{{}}\') FROM unnest(pending) p '
+    'WHERE p <> ALL(%s::text[])'
+    ') WHERE id = %s'
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Give every row of a model a fresh key and re-encrypt its PGP symmetric '
+        'key and AES fields server side, chunk by chunk.'
+    )
+
+    def add_arguments(self, parser):
+        """Define the command line."""
+        parser.add_argument('model', help='Model to rotate, as app_label.ModelName.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='Number of rows re-encrypted per UPDATE statement.',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Number of chunks processed in parallel, each on its own connection.',
+        )
+        parser.add_argument(
+            '--options',
+            help='pgp_sym_encrypt options for the new ciphertexts of every field, e.g. '
+                 '"cipher-algo=aes256". Defaults to the options of each field.',
+        )
+        parser.add_argument(
+            '--label',
+            help='Checkpoint name, defaults to the model label. Reuse it to resume.',
+        )
+        parser.add_argument(
+            '--restart', action='store_true',
+            help='Ignore the saved checkpoint and start from the first row.',
+        )
+        parser.add_argument(
+            '--database', help='Database to use instead of the routed one.')
+
+    def handle(self, *args, **options):
+        """Rotate the keys of the model, resuming from the checkpoint."""
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+
+        fields = [
+            field for field in model._meta.concrete_fields
+            if isinstance(field, RowKeyFieldMixin)
+        ]
+        if not fields:
+            raise CommandError('{} has no fields encrypted with per row keys.'.format(
+                model._meta.label))
+
+        self.model = model
+        self.fields = fields
+        self.database = options['database'] or router.db_for_write(model)
+        self.pgp_options = options['options']
+        self.file_fields = encrypted_file_fields(model)
+
+        name = 'rotate:{}'.format(options['label'] or model._meta.label_lower)
+        self.staging_name = STAGING_NAME.format(name)
+        self.previous_name = keys.PREVIOUS_KEYS_NAME.format(name)
+        checkpoint, _ = Checkpoint.objects.using(self.database).get_or_create(name=name)
+        self.checkpoint = checkpoint
+
+        self.promote_pending()
+        if options['restart']:
+            checkpoint.last_pk = None
+            checkpoint.processed = 0
+            checkpoint.save(using=self.database)
+
+        started = time.time()
+        rotated = self.run(options['chunk_size'], max(options['workers'], 1))
+        elapsed = max(time.time() - started, 1e-6)
+
+        self.stdout.write(self.style.SUCCESS(
+            'Rotated {} rows of {} in {:.1f}s ({:.0f} rows/s).'.format(
+                rotated, model._meta.label, elapsed, rotated / elapsed)
+        ))
+        if self.file_fields:
+            self.stdout.write(self.style.WARNING(
+                'Previous keys were kept in "{}" for the encrypted files of this '
+                'model; re-encrypt them with '
+                '`pgcrypto_reencrypt_files {} --rotation {}`.'.format(
+                    self.previous_name, model._meta.label, name[len('rotate:'):])
+            ))
+
+    def iter_chunks(self, chunk_size):
+        """Yield the primary keys to rotate with keyset pagination."""
+        pk_field = self.model._meta.pk
+        queryset = self.model._default_manager.using(self.database).order_by('pk')
+        last_pk = self.checkpoint.last_pk
+        while True:
+            chunk = queryset
+            if last_pk is not None:
+                chunk = chunk.filter(pk__gt=pk_field.to_python(last_pk))
+            pks = list(chunk.values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                return
+            yield pks
+            last_pk = pks[-1]
+
+    def run(self, chunk_size, workers):
+        """Process every chunk and advance the watermark in pk order."""
+        rotated = 0
+        if workers == 1:
+            for pks in self.iter_chunks(chunk_size):
+                rotated += self.rotate_chunk(pks)
+                self.advance(pks[-1], len(pks))
+            return rotated
+
+        in_flight = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for pks in self.iter_chunks(chunk_size):
+                in_flight.append((pks, executor.submit(self.rotate_chunk_in_thread, pks)))
+                if len(in_flight) >= workers * 2:
+                    # Later chunks can't advance the watermark before the
+                    # oldest one, so wait for it to keep `in_flight` bounded.
+                    wait([in_flight[0][1]])
+                rotated += self.collect(in_flight)
+            wait([future for _, future in in_flight])
+            rotated += self.collect(in_flight)
+        return rotated
+
+    def collect(self, in_flight):
+        """Advance the watermark over the finished prefix of `in_flight`."""
+        rotated = 0
+        while in_flight and in_flight[0][1].done():
+            pks, future = in_flight.pop(0)
+            rotated += future.result()
+            self.advance(pks[-1], len(pks))
+        return rotated
+
+    def advance(self, last_pk, count):
+        """Persist the keyset watermark."""
+        self.checkpoint.last_pk = str(last_pk)
+        self.checkpoint.processed += count
+        Checkpoint.objects.using(self.database).filter(pk=self.checkpoint.pk).update(
+            last_pk=self.checkpoint.last_pk,
+            processed=self.checkpoint.processed,
+        )
+
+    def rotate_chunk_in_thread(self, pks):
+        """Rotate a chunk on the worker thread's own connection."""
+        try:
+            return self.rotate_chunk(pks)
+        finally:
+            connections[self.database].close()
+
+    def rotate_chunk(self, pks):
+        """Re-encrypt one chunk with new keys in a single statement.
+
+        New keys are staged outside of the key store first and the chunk ids
+        are recorded as pending in the same transaction as the UPDATE, so an
+        interrupted run can always promote the keys matching the committed
+        ciphertexts.
+        """
+        old_keys = keys.fetch_keys(pks)
+        if not old_keys:
+            return 0
+        new_keys = {key_id: Encryption.generate_key() for key_id in old_keys}
+
+        keys.stage_keys(self.staging_name, new_keys)
+        if self.file_fields:
+            # Only the files need the previous keys, see `pgcrypto_reencrypt_files`.
+            with_files = self.rows_with_files(pks)
+            keys.stage_keys(self.previous_name, {
+                key_id: key for key_id, key in old_keys.items() if key_id in with_files})
+
+        connection = connections[self.database]
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        assignments = []
+        params = []
+        for field in self.fields:
+            column = qn(field.column)
+            if isinstance(field, AESFieldMixin):
+                reencrypt_sql = AES_REENCRYPT_SQL
+            else:
+                reencrypt_sql = PGP_SYM_REENCRYPT_SQL
+                if field.binary:
+                    reencrypt_sql = PGP_SYM_REENCRYPT_BYTEA_SQL
+                params.append(self.get_pgp_options(field, connection))
+            assignments.append('{} = {}'.format(column, reencrypt_sql.format(
+                column='{}.{}'.format(table, column),
+                old_key='v.old_key',
+                new_key='v.new_key',
+            )))
+        sql = ROTATE_SQL.format(
+            table=table,
+            assignments=', '.join(assignments),
+            values=', '.join(['(%s, %s, %s)'] * len(new_keys)),
+            pk=qn(self.model._meta.pk.column),
+            pk_type=self.model._meta.pk.rel_db_type(connection),
+        )
+        for key_id, new_key in new_keys.items():
+            params.extend([key_id, old_keys[key_id], new_key])
+
+        checkpoint_table = qn(Checkpoint._meta.db_table)
+        with transaction.atomic(using=self.database), connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            cursor.execute(
+                ADD_PENDING_SQL.format(table=checkpoint_table),
+                [list(new_keys), self.checkpoint.pk],
+            )
+            # The local copy of the keys must match the committed ciphertexts.
+            keys.store_local_keys(new_keys, using=self.database)
+
+        self.promote(list(new_keys), new_keys)
+        return len(new_keys)
+
+    def rows_with_files(self, pks):
+        """Return the stringified primary keys of the rows of `pks` with files."""
+        rows = self.model._default_manager.using(self.database).filter(
+            pk__in=pks).values_list('pk', *[field.attname for field in self.file_fields])
+        return {str(row[0]) for row in rows if any(row[1:])}
+
+    def get_pgp_options(self, field, connection):
+        """Return `--options`, or else the options of `field`, for the new ciphertexts."""
+        if self.pgp_options is not None:
+            return self.pgp_options
+        return field.get_pgp_options(connection)
+
+    def promote(self, key_ids, new_keys):
+        """Move committed keys from staging into the key store."""
+        keys.store_keys(new_keys, using=self.database)
+        keys.unstage_keys(self.staging_name, key_ids)
+        connection = connections[self.database]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                REMOVE_PENDING_SQL.format(
+                    table=connection.ops.quote_name(Checkpoint._meta.db_table)),
+                [key_ids, self.checkpoint.pk],
+            )
+
+    def promote_pending(self):
+        """Finish the promotion of chunks committed by an interrupted run."""
+        pending = self.checkpoint.pending
+        if not pending:
+            return
+
+        staged = keys.fetch_staged_keys(self.staging_name, pending)
+        missing = set(pending) - set(staged)
+        if missing:
+            raise CommandError(
+                '{} committed rows have no staged key in "{}": {}'.format(
+                    len(missing), self.staging_name, ', '.join(sorted(missing)))
+            )
+        self.promote(pending, staged)
+        self.checkpoint.pending = []
+        self.stdout.write('Promoted {} keys left pending by a previous run.'.format(
+            len(staged)))
@@ -0,0 +1,44 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from pgcrypto import keys
+
+
+class Command(BaseCommand):
+    help = (
+        'Copy the keys of the redis key store into the local key table read by '
+        'the parallel safe pgcrypto_row_key function (PGCRYPTO_LOCAL_KEYS).'
+    )
+
+    def add_arguments(self, parser):
+        """Define the command line."""
+        parser.add_argument(
+            '--batch-size', type=int, default=5000,
+            help='Number of keys read with one MGET and written with one INSERT.',
+        )
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        """Scan the key store and upsert its keys batch by batch."""
+        batch_size = options['batch_size']
+        started = time.time()
+        count = 0
+        batch = []
+        for key_id in keys.scan_key_ids(count=batch_size):
+            batch.append(key_id)
+            if len(batch) >= batch_size:
+                count += self.sync(batch, options['database'])
+                batch = []
+        count += self.sync(batch, options['database'])
+
+        elapsed = max(time.time() - started, 1e-6)
+        self.stdout.write('Copied {} keys in {:.1f}s ({:.0f} keys/s).'.format(
+            count, elapsed, count / elapsed))
+
+    def sync(self, key_ids, database):
+        """Copy the keys of `key_ids` and return how many were found."""
+        found = keys.fetch_keys(key_ids)
+        keys.store_local_keys(found, using=database, force=True)
+        return len(found)
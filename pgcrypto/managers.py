@@ -0,0 +1,628 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import connections, models, router, transaction
+from django.db.models.expressions import Col
+from django.db.models.query import ModelIterable
+from django.db.models.sql import Query
+from django.db.models.sql.compiler import FORCE
+
+from pgcrypto import DECRYPTED_ALIAS, instrumentation, invalidation, keys, search
+from pgcrypto.fields import EncryptedFileField, EncryptedImageField, SearchTokensField
+from pgcrypto.mixins import Ciphertext, DecryptedCol, get_setting, RowKeyFieldMixin
+
+DECRYPT_VALUES_SQL = (
+    'SELECT CASE v.field {cases} END '
+    'FROM unnest(%s::int[], %s::bytea[], %s::text[]) '
+    'WITH ORDINALITY AS v(field, value, key, n) '
+    'ORDER BY v.n'
+)
+BULK_UPDATE_SQL = (
+    'UPDATE {table} SET {assignments} FROM unnest({arrays}) AS v({columns}) '
+    'WHERE {table}.{pk} = v.{pk}'
+)
+KEY_COLUMN = 'pgcrypto_key'
+# `OFFSET 0` keeps the planner from inlining the projection into each reference.
+LATERAL_DECRYPT_SQL = 'CROSS JOIN LATERAL (SELECT {columns} OFFSET 0) AS {alias}'
+
+
+class CiphertextColumnsMixin:
+    """Compiler mixin selecting the ciphertext of the queried model's fields.
+
+    Only the model's own columns are affected: conditions, ordering,
+    annotations and `select_related` models are still decrypted in SQL.
+    """
+
+    def get_default_columns(self, start_alias=None, opts=None, from_parent=None):
+        """Replace `DecryptedCol` by the plain column for the queried model."""
+        columns = super().get_default_columns(start_alias, opts, from_parent)
+        if opts is not None:
+            return columns
+        return [
+            Col(column.alias, column.target)
+            if isinstance(column, DecryptedCol) else column
+            for column in columns
+        ]
+
+
+class DecryptOnceMixin:
+    """Compiler mixin decrypting each column of a table alias once per row.
+
+    A column referenced in several places (select list, WHERE, ORDER BY,
+    annotations...) is otherwise decrypted at every reference. When the SQL
+    has such repetitions, it is compiled again with the repeated columns
+    decrypted by a `LATERAL` projection of their alias and every reference
+    reading its result.
+    """
+    lateral = {}
+
+    def compile(self, node, select_format=False):
+        """Count the decrypted columns, or read them from the lateral projection."""
+        if not isinstance(node, DecryptedCol):
+            return super().compile(node, select_format)
+
+        key = (node.alias, node.target)
+        if key in self.lateral:
+            sql, params = self.lateral_column(*key), []
+        else:
+            self.decrypted.setdefault(key, []).append(node)
+            sql, params = node.as_decrypt_sql(self, self.connection)
+        if select_format is FORCE or (select_format and not self.query.subquery):
+            return node.output_field.select_format(self, sql, params)
+        return sql, params
+
+    def lateral_column(self, alias, target):
+        """Return the lateral projection's column of `target` on `alias`."""
+        quote_name = self.connection.ops.quote_name
+        return '{}.{}'.format(
+            quote_name(DECRYPTED_ALIAS.format(alias)), quote_name(target.column))
+
+    def as_sql(self, with_limits=True, with_col_aliases=False):
+        """Compile again with a lateral projection when columns are decrypted twice."""
+        self.decrypted = {}
+        sql, params = super().as_sql(with_limits, with_col_aliases)
+        repeated = {
+            key: nodes[0] for key, nodes in self.decrypted.items()
+            if len(nodes) > 1 and key[0] in self.query.alias_map
+        }
+        once = get_setting(self.connection, 'PGCRYPTO_DECRYPT_ONCE', True)
+        unsupported = self.query.select_for_update or self.query.combinator
+        if repeated and once and not unsupported:
+            self.lateral = {**self.lateral, **repeated}
+            return self.as_sql(with_limits, with_col_aliases)
+
+        instrumentation.record(
+            instrumentation.DECRYPTED_COLUMNS,
+            len(self.lateral) + sum(len(nodes) for nodes in self.decrypted.values()),
+        )
+        return sql, params
+
+    def get_from_clause(self):
+        """Add the lateral projections after the tables they decrypt."""
+        result, params = super().get_from_clause()
+        projections = {}
+        for (alias, target), node in self.lateral.items():
+            projections.setdefault(alias, []).append(node)
+        for alias, nodes in projections.items():
+            columns = []
+            for node in nodes:
+                sql, node_params = node.as_decrypt_sql(self, self.connection)
+                columns.append('{} AS {}'.format(
+                    sql, self.connection.ops.quote_name(node.target.column)))
+                params.extend(node_params)
+            result.append(LATERAL_DECRYPT_SQL.format(
+                columns=', '.join(columns),
+                alias=self.connection.ops.quote_name(DECRYPTED_ALIAS.format(alias)),
+            ))
+        return result, params
+
+    def get_group_by(self, select, order_by):
+        """Group by the lateral columns of the aliases grouped by primary key.
+
+        Postgres only knows that the other columns of a table depend on its
+        primary key, not the columns of the projection.
+        """
+        result = super().get_group_by(select, order_by)
+        grouped = {sql for sql, _ in result}
+        for alias, target in self.lateral:
+            pk = '{}.{}'.format(
+                self.quote_name_unless_alias(alias),
+                self.quote_name_unless_alias(target.model._meta.pk.column),
+            )
+            column = self.lateral_column(alias, target)
+            if pk in grouped and column not in grouped:
+                result.append((column, []))
+                grouped.add(column)
+        return result
+
+
+@lru_cache(maxsize=None)
+def extended_compiler(compiler, mixins):
+    """Return `compiler` extended with the `mixins`."""
+    name = ''.join(mixin.__name__.replace('Mixin', '') for mixin in mixins)
+    return type(name + compiler.__name__, mixins + (compiler,), {})
+
+
+class PGPQuery(Query):
+    """Query compiled with the `compiler_mixins`."""
+    compiler_mixins = (DecryptOnceMixin,)
+
+    def get_compiler(self, using=None, connection=None):
+        """Return the backend's compiler extended with the `compiler_mixins`."""
+        if using is None and connection is None:
+            raise ValueError('Need either using or connection')
+        if using:
+            connection = connections[using]
+        compiler = extended_compiler(
+            connection.ops.compiler(self.compiler), self.compiler_mixins)
+        return compiler(self, connection, using)
+
+
+class CiphertextQuery(PGPQuery):
+    """Query compiled with `CiphertextColumnsMixin`."""
+    compiler_mixins = (CiphertextColumnsMixin, DecryptOnceMixin)
+
+
+class PythonDecryptingIterable(ModelIterable):
+    """Yield model instances whose encrypted fields are decrypted in python.
+
+    Rows are decrypted a chunk at a time, with the keys of the chunk fetched
+    at once through the key cache, and in a thread pool when the queryset has
+    `workers`.
+    """
+
+    def __iter__(self):
+        """Select the ciphertexts and decrypt them chunk by chunk."""
+        queryset = self.queryset._chain()
+        queryset.query = queryset.query.chain(CiphertextQuery)
+        connection = connections[queryset.db]
+        fields = [
+            field for field in queryset.model._meta.concrete_fields
+            if isinstance(field, RowKeyFieldMixin)
+        ]
+
+        workers = self.queryset._decrypt_workers
+        pool = ThreadPoolExecutor(max_workers=workers) if workers else None
+        try:
+            chunk = []
+            for obj in ModelIterable(queryset, self.chunked_fetch, self.chunk_size):
+                chunk.append(obj)
+                if len(chunk) >= self.chunk_size:
+                    self.decrypt(chunk, fields, connection, pool)
+                    yield from chunk
+                    chunk = []
+            self.decrypt(chunk, fields, connection, pool)
+            yield from chunk
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    def decrypt(self, objs, fields, connection, pool):
+        """Replace the ciphertexts loaded on `objs` by their python values."""
+        row_keys = keys.get_keys(
+            (obj.pk for obj in objs), fill_cache=self.queryset._cache_keys,
+            using=connection.alias)
+        values = [
+            (obj, field, bytes(obj.__dict__[field.attname]), row_keys.get(str(obj.pk)))
+            for obj in objs
+            for field in fields
+            if obj.__dict__.get(field.attname) is not None
+        ]
+        if not values:
+            return
+
+        with instrumentation.timed(instrumentation.DECRYPT_TIME):
+            decrypted = self.decrypt_values(values, connection, pool)
+
+        for (obj, field, _, _), text in zip(values, decrypted):
+            value = None if text is None else field.from_decrypted(text)
+            obj.__dict__[field.attname] = value
+
+    def decrypt_values(self, values, connection, pool):
+        """Return the text of the (obj, field, ciphertext, key) `values`."""
+        def decrypt_value(value):
+            obj, field, ciphertext, key = value
+            if key is None:
+                # Like `pgp_sym_decrypt` with the NULL key of a missing row.
+                return None
+            return field.decrypt(ciphertext, key, connection)
+
+        if pool is None:
+            decrypted = [decrypt_value(value) for value in values]
+        else:
+            decrypted = list(pool.map(decrypt_value, values))
+
+        instrumentation.record(instrumentation.PYTHON_DECRYPTED_VALUES, len(values))
+        instrumentation.record(
+            instrumentation.DECRYPTED_BYTES,
+            sum(len(text) for text in decrypted if text is not None),
+        )
+        return decrypted
+
+
+class DatabaseDecryptingIterable(PythonDecryptingIterable):
+    """Decrypt each chunk in the database with one query and the prefetched keys.
+
+    The decryption stays in postgres but the `key_store` is not queried for
+    every row and column.
+    """
+
+    def decrypt_values(self, values, connection, pool):
+        """Decrypt `values` with a single `SELECT` over arrays of ciphertexts and keys."""
+        fields = []
+        for _, field, _, _ in values:
+            if field not in fields:
+                fields.append(field)
+        cases = ' '.join(
+            'WHEN {} THEN {}'.format(
+                i, field.get_decrypt_with_key_sql('v.value', 'v.key', connection))
+            for i, field in enumerate(fields)
+        )
+        params = [
+            [fields.index(field) for _, field, _, _ in values],
+            [ciphertext for _, _, ciphertext, _ in values],
+            [key for _, _, _, key in values],
+        ]
+        with connection.cursor() as cursor:
+            cursor.execute(DECRYPT_VALUES_SQL.format(cases=cases), params)
+            return [row[0] for row in cursor.fetchall()]
+
+
+def get_row_keys(objs, using=None):
+    """Return the keys of `objs` by stringified primary key, creating missing ones.
+
+    Known keys come from the cache of the database `using` or one `MGET`, the
+    others are created in one more round trip.
+    """
+    token = invalidation.start_read()
+    row_keys = keys.get_keys((obj.pk for obj in objs), using=using)
+    missing = {str(obj.pk) for obj in objs} - set(row_keys)
+    if missing:
+        created = keys.create_keys(missing, using=using)
+        keys.cache_keys(created, token, using)
+        row_keys.update(created)
+    return row_keys
+
+
+def search_tokens_fields(model, fields):
+    """Return the `SearchTokensField`s of `model` indexing one of `fields`."""
+    if model is None:
+        return []
+    names = {field.name for field in fields}
+    return [
+        field for field in model._meta.concrete_fields
+        if isinstance(field, SearchTokensField) and field.source in names
+    ]
+
+
+def encrypt_objs(objs, fields, connection, workers=None, row_keys=None):
+    """Encrypt the values of `fields` on `objs` in place, see `PGPQuerySet.bulk_create`.
+
+    The keys come from `get_row_keys` unless given as `row_keys`. Returns the
+    replaced (obj, attname, value) to put the plaintexts back.
+    """
+    objs = [obj for obj in objs if obj.pk is not None]
+    if row_keys is None:
+        row_keys = get_row_keys(objs, using=connection.alias)
+    for field in search_tokens_fields(objs[0]._meta.model if objs else None, fields):
+        for obj in objs:
+            field.pre_save(obj, obj._state.adding)
+
+    values = [
+        (obj, field, obj.__dict__[field.attname])
+        for obj in objs
+        for field in fields
+        if obj.__dict__.get(field.attname) is not None
+        if not isinstance(obj.__dict__[field.attname], Ciphertext)
+    ]
+
+    def encrypt_value(value):
+        obj, field, plaintext = value
+        text = field.get_plaintext(plaintext, connection)
+        return field.encrypt(text, row_keys[str(obj.pk)], connection)
+
+    if workers:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            encrypted = list(pool.map(encrypt_value, values))
+    else:
+        encrypted = [encrypt_value(value) for value in values]
+
+    for (obj, field, _), ciphertext in zip(values, encrypted):
+        obj.__dict__[field.attname] = ciphertext
+    instrumentation.record(instrumentation.PYTHON_ENCRYPTED_VALUES, len(values))
+    return [(obj, field.attname, plaintext) for obj, field, plaintext in values]
+
+
+@lru_cache(maxsize=None)
+def has_row_keys(model):
+    """Tell whether instances of `model` are encrypted with their row's key."""
+    return any(
+        isinstance(field, (RowKeyFieldMixin, EncryptedFileField, EncryptedImageField))
+        for field in model._meta.concrete_fields
+    )
+
+
+def prefetch_object_keys(objs):
+    """Load the keys of `objs` and their related objects into the key cache.
+
+    Objects cached by `select_related` and `prefetch_related` are included,
+    and every key missing from the cache of their database is fetched with a
+    single `MGET` per database. Like `prefetch_related_objects`, it works on
+    any list of instances.
+    """
+    key_ids = defaultdict(set)
+    seen = set()
+    stack = list(objs)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or not isinstance(obj, models.Model):
+            continue
+        seen.add(id(obj))
+        if obj.pk is not None and has_row_keys(type(obj)):
+            key_ids[obj._state.db].add(str(obj.pk))
+        stack.extend(obj._state.fields_cache.values())
+        for related in getattr(obj, '_prefetched_objects_cache', {}).values():
+            stack.extend(related)
+    found = {}
+    for using, ids in key_ids.items():
+        found.update(keys.get_keys(ids, using=using))
+    return found
+
+
+class PGPQuerySet(models.QuerySet):
+    """QuerySet able to encrypt and decrypt fields on the application servers."""
+
+    def __init__(self, model=None, query=None, using=None, hints=None):
+        """Start with decryption in SQL, each column decrypted once per row."""
+        if query is None:
+            query = PGPQuery(model)
+        super().__init__(model, query, using, hints)
+        self._decrypt_workers = None
+        self._cache_keys = True
+        self._prefetch_keys = False
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._decrypt_workers = self._decrypt_workers
+        clone._cache_keys = self._cache_keys
+        clone._prefetch_keys = self._prefetch_keys
+        return clone
+
+    def _fetch_all(self):
+        fetched = self._result_cache is not None
+        super()._fetch_all()
+        if self._prefetch_keys and not fetched:
+            prefetch_object_keys(self._result_cache)
+
+    def prefetch_keys(self):
+        """Warm the key cache with the keys of the results in one round trip.
+
+        Once evaluated, the keys of the instances and of their `select_related`
+        and `prefetch_related` objects are fetched with a single `MGET`, so
+        that saving them or decrypting them in python doesn't look keys up one
+        by one. Works within a `Prefetch(queryset=...)` too.
+        """
+        clone = self._chain()
+        clone._prefetch_keys = True
+        return clone
+
+    def decrypt_in_python(self, workers=None):
+        """Select the ciphertexts and decrypt them in python.
+
+        The `pgp_sym_decrypt` work moves from the database to the application
+        servers. Values are decrypted `workers` threads at a time, defaulting
+        to the `PGCRYPTO_DECRYPT_WORKERS` setting (no pool when unset).
+        """
+        clone = self._chain()
+        clone._iterable_class = PythonDecryptingIterable
+        if workers is None:
+            workers = getattr(settings, 'PGCRYPTO_DECRYPT_WORKERS', None)
+        clone._decrypt_workers = workers
+        return clone
+
+    def decrypted_iterator(self, chunk_size=2000, in_database=False, workers=None):
+        """Stream the rows with a server-side cursor, decrypting a chunk at a time.
+
+        The keys of each chunk are fetched in one `MGET` and, to keep the memory
+        constant, not added to the key cache. The chunk is decrypted in python
+        (see `decrypt_in_python`) or, with `in_database`, by one query given
+        the ciphertexts and keys.
+        """
+        queryset = self.decrypt_in_python(workers)
+        if in_database:
+            queryset._iterable_class = DatabaseDecryptingIterable
+        queryset._cache_keys = False
+        return queryset.iterator(chunk_size=chunk_size)
+
+    def bulk_create(self, objs, *args, workers=None, row_keys=None, **kwargs):
+        """Insert `objs`, encrypting in python when `PGCRYPTO_ENCRYPT_IN_PYTHON` is set.
+
+        The keys of all the rows are then created in one round trip and the
+        values encrypted before the INSERT, `workers` threads at a time
+        (defaulting to the `PGCRYPTO_ENCRYPT_WORKERS` setting). Values are
+        also encrypted in python with `row_keys`, keys already resolved by
+        stringified primary key.
+        """
+        objs = list(objs)
+        using = self._db or router.db_for_write(self.model, **self._hints)
+        connection = connections[using]
+        in_python = get_setting(connection, 'PGCRYPTO_ENCRYPT_IN_PYTHON', False)
+        if row_keys is None and not in_python:
+            return super().bulk_create(objs, *args, **kwargs)
+
+        if workers is None:
+            workers = getattr(settings, 'PGCRYPTO_ENCRYPT_WORKERS', None)
+        fields = [
+            field for field in self.model._meta.concrete_fields
+            if isinstance(field, RowKeyFieldMixin)
+        ]
+        plaintexts = encrypt_objs(objs, fields, connection, workers, row_keys=row_keys)
+        try:
+            return super().bulk_create(objs, *args, **kwargs)
+        finally:
+            for obj, attname, value in plaintexts:
+                obj.__dict__[attname] = value
+
+    async def acreate(self, **kwargs):
+        """Async `create()`: the key is resolved without blocking, see `pgcrypto.aio`."""
+        from pgcrypto import aio
+
+        obj = self.model(**kwargs)
+        self._for_write = True
+        await aio.asave(obj, force_insert=True, using=self.db)
+        return obj
+
+    async def abulk_create(self, objs, *args, **kwargs):
+        """Async `bulk_create()`, resolving the keys of all the rows concurrently first.
+
+        The values are then encrypted in python with the keys of their rows: a
+        multi-row `INSERT` encrypted in SQL would use the first row's key.
+        """
+        from pgcrypto import aio
+
+        objs = list(objs)
+        self._for_write = True
+        if has_row_keys(self.model):
+            kwargs['row_keys'] = await aio.aget_row_keys(objs, using=self.db)
+        return await aio.sync_to_async(self.bulk_create)(objs, *args, **kwargs)
+
+    def bulk_update(self, objs, fields, batch_size=None, workers=None):
+        """Update `fields` of `objs` with one `UPDATE` per `batch_size` rows.
+
+        The values and the keys of the rows are sent as arrays and every row
+        is encrypted with its own key. With `PGCRYPTO_ENCRYPT_IN_PYTHON`, the
+        values are encrypted before, see `bulk_create`. As with `bulk_create`,
+        `save()` and the signals are not called. Returns the number of
+        updated rows.
+        """
+        objs = list(objs)
+        fields = [self.model._meta.get_field(name) for name in fields]
+        if any(not field.concrete or field.many_to_many for field in fields):
+            raise ValueError('bulk_update() can only be used with concrete fields.')
+        if any(field.primary_key for field in fields):
+            raise ValueError('bulk_update() cannot be used with primary key fields.')
+        if any(obj.pk is None for obj in objs):
+            raise ValueError('All bulk_update() objects must have a primary key set.')
+        if not fields or not objs:
+            return 0
+
+        # The search tokens of updated fields are updated along.
+        for field in search_tokens_fields(self.model, fields):
+            if field not in fields:
+                fields.append(field)
+            for obj in objs:
+                field.pre_save(obj, False)
+
+        using = self._db or router.db_for_write(self.model, **self._hints)
+        connection = connections[using]
+        in_python = get_setting(connection, 'PGCRYPTO_ENCRYPT_IN_PYTHON', False)
+        if workers is None:
+            workers = getattr(settings, 'PGCRYPTO_ENCRYPT_WORKERS', None)
+        batch_size = batch_size or len(objs)
+
+        updated = 0
+        with transaction.atomic(using=connection.alias, savepoint=False):
+            for start in range(0, len(objs), batch_size):
+                updated += self._bulk_update_batch(
+                    objs[start:start + batch_size], fields, connection, in_python,
+                    workers)
+        return updated
+
+    def _bulk_update_batch(self, objs, fields, connection, in_python, workers):
+        quote_name = connection.ops.quote_name
+        pk = self.model._meta.pk
+        encrypted = [field for field in fields if isinstance(field, RowKeyFieldMixin)]
+        row_keys = get_row_keys(objs, using=connection.alias) if encrypted else {}
+        plaintexts = []
+        if encrypted and in_python:
+            plaintexts = encrypt_objs(objs, encrypted, connection, workers, row_keys)
+
+        try:
+            columns = [quote_name(pk.column)]
+            arrays = ['%s::{}[]'.format(pk.cast_db_type(connection))]
+            params = [[pk.get_db_prep_save(obj.pk, connection) for obj in objs]]
+            assignments = []
+            for field in fields:
+                column = quote_name(field.column)
+                values = [getattr(obj, field.attname) for obj in objs]
+                columns.append(column)
+                if isinstance(field, SearchTokensField):
+                    # unnest() would flatten a two dimensional array.
+                    arrays.append('%s::text[]')
+                    params.append([
+                        None if value is None else ','.join(value) for value in values])
+                    assignments.append("{0} = string_to_array(v.{0}, ',')".format(column))
+                elif not isinstance(field, RowKeyFieldMixin):
+                    arrays.append('%s::{}[]'.format(field.cast_db_type(connection)))
+                    params.append([
+                        field.get_db_prep_save(value, connection) for value in values])
+                    assignments.append('{0} = v.{0}'.format(column))
+                elif in_python:
+                    arrays.append('%s::bytea[]')
+                    params.append(values)
+                    assignments.append('{0} = v.{0}'.format(column))
+                else:
+                    arrays.append('%s::{}[]'.format(field.plaintext_db_type))
+                    params.append([
+                        None if value is None else field.get_plaintext(value, connection)
+                        for value in values
+                    ])
+                    encrypt_sql = field.get_encrypt_with_key_sql(
+                        'v.' + column, 'v.' + quote_name(KEY_COLUMN), connection)
+                    assignments.append('{} = {}'.format(column, encrypt_sql))
+            if encrypted and not in_python:
+                columns.append(quote_name(KEY_COLUMN))
+                arrays.append('%s::text[]')
+                params.append([row_keys[str(obj.pk)] for obj in objs])
+        finally:
+            for obj, attname, value in plaintexts:
+                obj.__dict__[attname] = value
+
+        sql = BULK_UPDATE_SQL.format(
+            table=quote_name(self.model._meta.db_table),
+            assignments=', '.join(assignments),
+            arrays=', '.join(arrays),
+            columns=', '.join(columns),
+            pk=quote_name(pk.column),
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount
+
+    def update(self, **kwargs):
+        """Update the rows, along with the search tokens of the updated fields.
+
+        The tokens of a value are the same for every row. Expressions can't be
+        tokenized in python, so updating the source of a `SearchTokensField`
+        with one is refused rather than leaving stale tokens.
+        """
+        fields = [self.model._meta.get_field(name) for name in kwargs]
+        tokens_fields = search_tokens_fields(self.model, fields)
+        if tokens_fields:
+            connection = connections[
+                self._db or router.db_for_write(self.model, **self._hints)]
+            key = search.get_search_key(connection)
+        for field in tokens_fields:
+            value = kwargs[field.source]
+            if hasattr(value, 'resolve_expression'):
+                raise ValueError(
+                    "update() can't compute the search tokens of {} from an "
+                    "expression, use bulk_update().".format(field.source))
+            kwargs.setdefault(field.name, search.value_tokens(
+                value, key, field.ngram_size, field.prefix_length))
+        return super().update(**kwargs)
+
+    update.alters_data = True
+
+
+class PGPManager(models.Manager.from_queryset(PGPQuerySet)):
+    """Manager decrypting in python when `PGCRYPTO_DECRYPT_IN_PYTHON` is set."""
+
+    def get_queryset(self):
+        """Return a `PGPQuerySet`."""
+        queryset = super().get_queryset()
+        if getattr(settings, 'PGCRYPTO_DECRYPT_IN_PYTHON', False):
+            queryset = queryset.decrypt_in_python()
+        return queryset
@@ -0,0 +1,26 @@
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pgcrypto', '0001_add_pgcrypto_extension'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Checkpoint',
+            fields=[
+                ('id', models.AutoField(
+                    auto_created=True, primary_key=True, serialize=False,
+                    verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('last_pk', models.TextField(blank=True, null=True)),
+                ('pending', django.contrib.postgres.fields.ArrayField(
+                    base_field=models.TextField(), blank=True, default=list, size=None)),
+                ('processed', models.BigIntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,59 @@
+from django.db import migrations
+
+# Encrypt-then-MAC over pgcrypto's raw AES: iv (16) || aes-cbc ciphertext || hmac (16).
+# Separate encryption and authentication keys are derived from the row key.
+CREATE_AES_ENCRYPT = '''
+CREATE OR REPLACE FUNCTION pgcrypto_aes_encrypt(data bytea, key text) RETURNS bytea AS $$
+DECLARE
+    raw_key bytea := decode(key, 'base64');
+    iv bytea := gen_random_bytes(16);
+    encrypted bytea;
+BEGIN
+    encrypted := encrypt_iv(
+        data, hmac('enc'::bytea, raw_key, 'sha256'), iv, 'aes-cbc/pad:pkcs');
+    RETURN iv || encrypted || substring(
+        hmac(iv || encrypted, hmac('mac'::bytea, raw_key, 'sha256'), 'sha256')
+        FROM 1 FOR 16
+    );
+END;
+$$ LANGUAGE plpgsql VOLATILE STRICT PARALLEL SAFE;
+'''
+CREATE_AES_DECRYPT = '''
+CREATE OR REPLACE FUNCTION pgcrypto_aes_decrypt(data bytea, key text) RETURNS bytea AS $$
+DECLARE
+    raw_key bytea := decode(key, 'base64');
+    size integer := length(data);
+    iv bytea;
+    encrypted bytea;
+BEGIN
+    IF size < 48 THEN
+        RAISE EXCEPTION 'Wrong key or corrupt data';
+    END IF;
+    iv := substring(data FROM 1 FOR 16);
+    encrypted := substring(data FROM 17 FOR size - 32);
+    IF substring(data FROM size - 15) <> substring(
+        hmac(iv || encrypted, hmac('mac'::bytea, raw_key, 'sha256'), 'sha256')
+        FROM 1 FOR 16
+    ) THEN
+        RAISE EXCEPTION 'Wrong key or corrupt data';
+    END IF;
+    RETURN decrypt_iv(
+        encrypted, hmac('enc'::bytea, raw_key, 'sha256'), iv, 'aes-cbc/pad:pkcs');
+END;
+$$ LANGUAGE plpgsql IMMUTABLE STRICT PARALLEL SAFE;
+'''
+DROP_AES_FUNCTIONS = [
+    'DROP FUNCTION IF EXISTS pgcrypto_aes_encrypt(bytea, text);',
+    'DROP FUNCTION IF EXISTS pgcrypto_aes_decrypt(bytea, text);',
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pgcrypto', '0002_checkpoint'),
+    ]
+
+    operations = [
+        migrations.RunSQL([CREATE_AES_ENCRYPT, CREATE_AES_DECRYPT], DROP_AES_FUNCTIONS),
+    ]
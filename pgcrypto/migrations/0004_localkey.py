@@ -0,0 +1,29 @@
+from django.db import migrations, models
+
+# Reads the local copy of the keys so that decrypting scans can run in
+# parallel workers, unlike the `key_store` subquery.
+CREATE_ROW_KEY = '''
+CREATE OR REPLACE FUNCTION pgcrypto_row_key(row_id text) RETURNS text AS $$
+    SELECT key FROM pgcrypto_localkey WHERE id = row_id
+$$ LANGUAGE sql STABLE STRICT PARALLEL SAFE;
+'''
+DROP_ROW_KEY = 'DROP FUNCTION IF EXISTS pgcrypto_row_key(text);'
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pgcrypto', '0003_aes_functions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LocalKey',
+            fields=[
+                ('id', models.CharField(
+                    max_length=255, primary_key=True, serialize=False)),
+                ('key', models.TextField()),
+            ],
+        ),
+        migrations.RunSQL(CREATE_ROW_KEY, DROP_ROW_KEY),
+    ]
@@ -1,27 +1,64 @@
-import queue
-from base64 import b64encode
-from os import urandom
-from uuid import UUID
+import logging
+import re
+from datetime import date, datetime, time
 
-import redis
+import pytz
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, router
 from django.db.models.expressions import Col
-from django.utils.functional import cached_property
 from django.db.models.sql.subqueries import UpdateQuery
+from django.utils import timezone
+from django.utils.functional import cached_property
 
 from pgcrypto import (
+    AES_DECRYPT_SQL,
+    AES_DECRYPT_WITH_KEY_SQL,
+    AES_ENCRYPT_SQL,
+    AES_ENCRYPT_WITH_KEY_SQL,
+    instrumentation,
+    KEY_STORE_KEY_SQL,
+    keys,
+    LOCAL_KEY_SQL,
+    PGP_SYM_DECRYPT_BYTEA_SQL,
+    PGP_SYM_DECRYPT_BYTEA_SQL_WITH_OPTIONS,
+    PGP_SYM_DECRYPT_BYTEA_WITH_KEY_SQL,
+    PGP_SYM_DECRYPT_BYTEA_WITH_KEY_SQL_WITH_OPTIONS,
     PGP_SYM_DECRYPT_SQL,
+    PGP_SYM_DECRYPT_SQL_WITH_OPTIONS,
+    PGP_SYM_DECRYPT_WITH_KEY_SQL,
+    PGP_SYM_DECRYPT_WITH_KEY_SQL_WITH_OPTIONS,
+    PGP_SYM_ENCRYPT_BYTEA_WITH_KEY_SQL,
+    PGP_SYM_ENCRYPT_BYTEA_WITH_KEY_SQL_WITH_OPTIONS,
     PGP_SYM_ENCRYPT_SQL,
+    PGP_SYM_ENCRYPT_SQL_WITH_OPTIONS,
+    PGP_SYM_ENCRYPT_WITH_KEY_SQL,
+    PGP_SYM_ENCRYPT_WITH_KEY_SQL_WITH_OPTIONS,
+    ROW_KEY_SQL,
 )
-from pgcrypto.constants import REDIS_HOST, REDIS_PORT
+from pgcrypto.lookups import SearchTokenIContains, SearchTokenIStartsWith
+
+logger = logging.getLogger(__name__)
 
+NOT_PROVIDED = object()
 
-def get_setting(connection, key):
+# pgcrypto option strings, e.g. "s2k-mode=1, compress-algo=0".
+PGP_OPTIONS_RE = re.compile(
+    r'^\s*[a-z0-9-]+\s*=\s*[a-z0-9-]+\s*(,\s*[a-z0-9-]+\s*=\s*[a-z0-9-]+\s*)*$')
+
+
+def get_setting(connection, key, default=NOT_PROVIDED):
     """Get key from connection or default to settings."""
     if key in connection.settings_dict:
         return connection.settings_dict[key]
-    else:
+    elif default is NOT_PROVIDED:
         return getattr(settings, key)
+    else:
+        return getattr(settings, key, default)
+
+
+class Ciphertext(bytes):
+    """A value encrypted in python, sent to the database as is."""
 
 
 class DecryptedCol(Col):
@@ -35,6 +72,12 @@ class DecryptedCol(Col):
 
     def as_sql(self, compiler, connection):
         """Build SQL with decryption and casting."""
+        sql, params = self.as_decrypt_sql(compiler, connection)
+        instrumentation.record(instrumentation.DECRYPTED_COLUMNS)
+        return sql, params
+
+    def as_decrypt_sql(self, compiler, connection):
+        """Build the SQL of `as_sql` without recording it."""
         sql, params = super(DecryptedCol, self).as_sql(compiler, connection)
         sql = self.target.get_decrypt_sql(connection) % (sql, self.alias, self.target.get_cast_sql())
         return sql, params
@@ -139,89 +182,357 @@ class PGPMixin:
 class Encryption:
     @classmethod
     def generate_key(cls):
-        return b64encode(urandom(32)).decode('utf-8')
+        return keys.generate_key()
 
 
-class PGPSymmetricKeyFieldMixin(PGPMixin):
-    """PGP symmetric key encrypted field mixin for postgres."""
-    encrypt_sql = PGP_SYM_ENCRYPT_SQL
-    decrypt_sql = PGP_SYM_DECRYPT_SQL
+class RowKeyFieldMixin(PGPMixin):
+    """Field mixin encrypting each row with its own key from the `key_store`."""
     cast_type = 'TEXT'
-    keys = {}
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    encrypt_with_key_sql = None  # Set in implementation class
+    decrypt_with_key_sql = None  # Set in implementation class
+    # Type of the plaintexts of `get_plaintext` given to `get_encrypt_with_key_sql`.
+    plaintext_db_type = 'text'
+    keys = keys.cache
+    class_lookups = {
+        'icontains': SearchTokenIContains,
+        'istartswith': SearchTokenIStartsWith,
+    }
 
-    def pre_save(self, model_instance, add):
-        """Save the original_value."""
-        key_id = getattr(model_instance, "pk")
-
-        # from django.db import connection
-        # with connection.cursor() as cursor:
-        #     print("trying to fetch key for %s", (key_id,))
-        #     cursor.execute("select key from key_store where id = %s::text", (key_id,))
-        #     row = cursor.fetchone()
-        #     if row is None:
-        #         print("no key found for %s. Creating new one", (key_id,))
-        #         key = Encryption.generate_key()
-        #         self.keys[key_id] = key
-        #         r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0)
-        #         r.set(str(key_id), key, nx=True)
-        #     else:
-        #         print("Loading key from %s", (key_id,))
-        #         self.keys[key_id] = row[0]
-
-        return super(PGPSymmetricKeyFieldMixin, self).pre_save(model_instance, add)
+    @cached_property
+    def search_tokens_field(self):
+        """Return the `SearchTokensField` of the model indexing this field, if any."""
+        from pgcrypto.fields import SearchTokensField
+        for field in self.model._meta.concrete_fields:
+            if isinstance(field, SearchTokensField) and field.source == self.name:
+                return field
+        return None
+
+    def get_inserted_pk(self, compiler):
+        """Return the primary key of the row of the INSERT whose value is compiled.
+
+        Django asks the placeholders row by row, skipping the values that are
+        expressions, so counting the calls of the field finds its row.
+        """
+        objs = [
+            obj for obj in compiler.query.objs
+            if not hasattr(obj.__dict__.get(self.attname), 'resolve_expression')
+        ]
+        rows = compiler.__dict__.setdefault('_pgcrypto_rows', {})
+        index = rows.get(self.attname, 0)
+        rows[self.attname] = index + 1
+        return objs[index % len(objs)].pk
+
+    @staticmethod
+    def get_filtered_pk(where):
+        """Return the primary key the `where` clause of a write is filtered on, if any."""
+        key_id = None
+        for child in where.children:
+            if child.lookup_name != 'exact':
+                continue
+            if getattr(getattr(child.lhs, 'field', None), 'name', None) == 'id':
+                key_id = child.rhs
+            elif getattr(getattr(child.rhs, 'field', None), 'name', None) == 'id':
+                key_id = child.lhs
+            elif getattr(child.lhs, '__name__', None) == 'UUID':
+                key_id = child.lhs
+            elif getattr(child.rhs, '__name__', None) == 'UUID':
+                key_id = child.rhs
+        return key_id
 
     def get_placeholder(self, value, compiler, connection):
-        """Tell postgres to encrypt this field using PGP."""
-        if compiler.query is UpdateQuery:
-            print("update query")
+        """Tell postgres to encrypt this field with the key of the row."""
+        if isinstance(value, Ciphertext):
+            if hasattr(compiler.query, 'objs'):
+                # Still count the row, see `get_inserted_pk`.
+                self.get_inserted_pk(compiler)
+            return '%s'
+
         key_id = None
         if hasattr(compiler.query, 'objs'):
-            # key = self.keys[compiler.query.objs[0].id]
-            key_id = compiler.query.objs[0].pk
+            key_id = self.get_inserted_pk(compiler)
         elif hasattr(compiler.query, 'where'):
-            for child in compiler.query.where.children:
-                if child.lookup_name == 'exact':
-                    if hasattr(child.lhs, 'field') and hasattr(child.lhs.field, 'name') and child.lhs.field.name == 'id':
-                        key_id = child.rhs
-                    elif hasattr(child.rhs, 'field') and hasattr(child.rhs.field, 'name') and child.rhs.field.name == 'id':
-                        key_id = child.lhs
-                    elif hasattr(child.lhs, '__name__') and child.lhs.__name__ == 'UUID':
-                        # key = self.keys[child.lhs]
-                        key_id = child.lhs
-                    elif hasattr(child.rhs, '__name__') and child.rhs.__name__ == 'UUID':
-                        # key = self.keys[child.rhs]
-                        key_id = child.rhs
+            key_id = self.get_filtered_pk(compiler.query.where)
+        if key_id is None and isinstance(compiler.query, UpdateQuery):
+            # Several rows are updated: each is encrypted with its own key.
+            return self.get_encrypt_with_key_sql(
+                self.get_plaintext_sql(), self.get_row_key_sql(connection), connection)
         if key_id is None:
-            print("couldn't find key id!")
-
-        try:
-            key = self.keys[key_id]
-        except:
-            from django.db import connection
-            with connection.cursor() as cursor:
-                print("trying to fetch key for %s", (key_id,))
-                cursor.execute("select key from key_store where id = %s::text", (key_id,))
-                row = cursor.fetchone()
-                if row is None:
-                    print("no key found for %s. Creating new one", (key_id,))
-                    key = Encryption.generate_key()
-                    r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0)
-                    r.set(str(key_id), key, nx=True)
-                else:
-                    print("Loading key from %s", (key_id,))
-                    key = row[0]
-        self.keys[key_id] = key
-
-        val = self.encrypt_sql.format(key)
-        # del self.keys[key_id]
-        return val
+            logger.warning("couldn't find key id for %s", self)
+
+        key = keys.get_key(key_id, using=connection.alias)
+        return self.get_encrypt_sql(key, connection)
+
+    def get_encrypt_sql(self, key, connection):
+        """Get encrypt sql for `key`."""
+        return self.encrypt_sql.format(key)
+
+    def get_plaintext_sql(self):
+        """Get sql converting the `%s` parameter to the plaintext encrypted."""
+        return '%s::text'
+
+    def get_row_key_sql(self, connection):
+        """Get sql selecting the key of the row of the field's table being written."""
+        quote_name = connection.ops.quote_name
+        return ROW_KEY_SQL.format(
+            table=quote_name(self.model._meta.db_table),
+            pk=quote_name(self.model._meta.pk.column),
+        )
+
+    def get_encrypt_with_key_sql(self, value, key, connection):
+        """Get sql encrypting the text `value` expression with the `key` expression."""
+        return self.encrypt_with_key_sql.format(value=value, key=key)
 
     def get_decrypt_sql(self, connection):
         """Get decrypt sql."""
-        return self.decrypt_sql  # .format(self.key)
+        return self.get_key_access_sql(self.decrypt_sql, connection)
+
+    def get_key_access_sql(self, sql, connection):
+        """Read the keys of the decrypt `sql` from the local key table when configured.
+
+        With `PGCRYPTO_LOCAL_KEYS`, the `key_store` subquery, which keeps the
+        planner from using parallel workers, is replaced by the `PARALLEL SAFE`
+        `pgcrypto_row_key` function.
+        """
+        if get_setting(connection, 'PGCRYPTO_LOCAL_KEYS', False):
+            return sql.replace(KEY_STORE_KEY_SQL, LOCAL_KEY_SQL)
+        return sql
+
+    def get_decrypt_with_key_sql(self, value, key, connection):
+        """Get sql decrypting the `value` expression to text with the `key` expression."""
+        return self.decrypt_with_key_sql.format(value=value, key=key)
+
+    def pre_save(self, model_instance, add):
+        """Encrypt the value in python when `PGCRYPTO_ENCRYPT_IN_PYTHON` is set.
+
+        The key of the row must be known, so rows without a primary key yet are
+        still encrypted in SQL.
+        """
+        value = super().pre_save(model_instance, add)
+        if value is None or isinstance(value, Ciphertext) or model_instance.pk is None:
+            return value
+
+        using = model_instance._state.db or router.db_for_write(
+            type(model_instance), instance=model_instance)
+        connection = connections[using]
+        if not get_setting(connection, 'PGCRYPTO_ENCRYPT_IN_PYTHON', False):
+            return value
+        instrumentation.record(instrumentation.PYTHON_ENCRYPTED_VALUES)
+        return self.encrypt(
+            self.get_plaintext(value, connection),
+            keys.get_key(model_instance.pk, using=using),
+            connection,
+        )
+
+    def get_db_prep_save(self, value, connection):
+        """Leave values encrypted in python untouched."""
+        if isinstance(value, Ciphertext):
+            return value
+        return super().get_db_prep_save(value, connection)
+
+    def get_plaintext(self, value, connection):
+        """Return `value` as the text the SQL encryption would receive."""
+        value = self.get_db_prep_save(value, connection)
+        if isinstance(value, datetime):
+            # The database prints `timestamptz` in the connection's time zone.
+            if timezone.is_aware(value):
+                value = value.astimezone(pytz.timezone(connection.timezone_name))
+            return value.isoformat(' ')
+        if isinstance(value, (date, time)):
+            return value.isoformat()
+        return str(value)
+
+    def encrypt(self, text, key, connection):
+        """Encrypt `text` in python, readable by `get_decrypt_sql`."""
+        raise NotImplementedError('The `encrypt` needs to be implemented.')
+
+    def decrypt(self, value, key, connection):
+        """Decrypt the stored `value` in python, see `PGPQuerySet.decrypt_in_python`."""
+        raise NotImplementedError('The `decrypt` needs to be implemented.')
+
+    def from_decrypted(self, value):
+        """Convert decrypted text like the SQL cast of `get_cast_sql` does."""
+        value = self.to_python(value)
+        if isinstance(value, datetime) and self.get_cast_sql() == 'TIMESTAMP':
+            # `::TIMESTAMP` drops the offset of the stored `timestamptz` text.
+            value = value.replace(tzinfo=None)
+        return value
+
+
+class PGPSymmetricKeyFieldMixin(RowKeyFieldMixin):
+    """PGP symmetric key encrypted field mixin for postgres."""
+    encrypt_sql = PGP_SYM_ENCRYPT_SQL
+    encrypt_sql_with_options = PGP_SYM_ENCRYPT_SQL_WITH_OPTIONS
+    decrypt_sql = PGP_SYM_DECRYPT_SQL
+    decrypt_sql_with_options = PGP_SYM_DECRYPT_SQL_WITH_OPTIONS
+    encrypt_with_key_sql = PGP_SYM_ENCRYPT_WITH_KEY_SQL
+    encrypt_with_key_sql_with_options = PGP_SYM_ENCRYPT_WITH_KEY_SQL_WITH_OPTIONS
+    decrypt_with_key_sql = PGP_SYM_DECRYPT_WITH_KEY_SQL
+    decrypt_with_key_sql_with_options = PGP_SYM_DECRYPT_WITH_KEY_SQL_WITH_OPTIONS
+
+    encrypt_bytea_with_key_sql = PGP_SYM_ENCRYPT_BYTEA_WITH_KEY_SQL
+    encrypt_bytea_with_key_sql_with_options = (
+        PGP_SYM_ENCRYPT_BYTEA_WITH_KEY_SQL_WITH_OPTIONS)
+    decrypt_bytea_sql = PGP_SYM_DECRYPT_BYTEA_SQL
+    decrypt_bytea_sql_with_options = PGP_SYM_DECRYPT_BYTEA_SQL_WITH_OPTIONS
+    decrypt_bytea_with_key_sql = PGP_SYM_DECRYPT_BYTEA_WITH_KEY_SQL
+    decrypt_bytea_with_key_sql_with_options = (
+        PGP_SYM_DECRYPT_BYTEA_WITH_KEY_SQL_WITH_OPTIONS)
+    binary_codec = None  # `pgcrypto.binary` codec of the fields supporting `binary`
+
+    def __init__(self, *args, options=None, binary=False, **kwargs):
+        """`options` are passed to pgcrypto, see `get_pgp_options`.
+
+        With `binary`, values are encrypted in the compact encoding of the
+        field's `binary_codec`, see `pgcrypto.binary`.
+        """
+        self.options = options
+        self.binary = binary
+        super().__init__(*args, **kwargs)
+        if binary:
+            if self.binary_codec is None:
+                raise ImproperlyConfigured(
+                    '{} has no binary encoding.'.format(type(self).__name__))
+            self.codec = self.binary_codec(self)
+
+    def deconstruct(self):
+        """Add `options` and `binary` to the field's arguments."""
+        name, path, args, kwargs = super().deconstruct()
+        if self.options is not None:
+            kwargs['options'] = self.options
+        if self.binary:
+            kwargs['binary'] = True
+        return name, path, args, kwargs
+
+    @property
+    def plaintext_db_type(self):
+        """Binary plaintexts are bytea."""
+        return 'bytea' if self.binary else 'text'
+
+    def get_pgp_options(self, connection):
+        """Get the pgcrypto options of the field.
+
+        They come from the field's `options`, or the `PGCRYPTO_SYM_OPTIONS` of
+        the database or the settings. An empty string means pgcrypto's defaults.
+        """
+        options = self.options
+        if options is None:
+            options = get_setting(connection, 'PGCRYPTO_SYM_OPTIONS', '')
+        if options and not PGP_OPTIONS_RE.match(options):
+            raise ImproperlyConfigured('Invalid pgcrypto options: {!r}'.format(options))
+        return options
+
+    def get_encrypt_sql(self, key, connection):
+        """Get encrypt sql for `key`, with the options of the field."""
+        if self.binary:
+            return self.get_encrypt_with_key_sql(
+                self.get_plaintext_sql(), "'{}'".format(key), connection)
+        options = self.get_pgp_options(connection)
+        if options:
+            return self.encrypt_sql_with_options.format(key, options)
+        return self.encrypt_sql.format(key)
+
+    def get_plaintext_sql(self):
+        """Get sql converting the `%s` parameter to the plaintext encrypted."""
+        if self.binary:
+            return self.codec.get_encode_sql()
+        return super().get_plaintext_sql()
+
+    def get_encrypt_with_key_sql(self, value, key, connection):
+        """Get sql encrypting `value` with `key`, with the options of the field."""
+        options = self.get_pgp_options(connection)
+        if self.binary:
+            sql = self.encrypt_bytea_with_key_sql
+            if options:
+                sql = self.encrypt_bytea_with_key_sql_with_options
+        elif options:
+            sql = self.encrypt_with_key_sql_with_options
+        else:
+            sql = self.encrypt_with_key_sql
+        return sql.format(value=value, key=key, options=options)
+
+    def get_decrypt_sql(self, connection):
+        """Get decrypt sql, with the options of the field."""
+        options = self.get_pgp_options(connection)
+        if self.binary:
+            sql = self.decrypt_bytea_sql
+            if options:
+                sql = self.decrypt_bytea_sql_with_options.format(options)
+            sql = self.codec.get_decode_sql(sql) + '::%s'
+        elif options:
+            sql = self.decrypt_sql_with_options.format(options)
+        else:
+            sql = self.decrypt_sql
+        return self.get_key_access_sql(sql, connection)
+
+    def get_decrypt_with_key_sql(self, value, key, connection):
+        """Get sql decrypting `value` with `key` to text, with the field's options."""
+        options = self.get_pgp_options(connection)
+        if self.binary:
+            sql = self.decrypt_bytea_with_key_sql
+            if options:
+                sql = self.decrypt_bytea_with_key_sql_with_options
+            sql = sql.format(value=value, key=key, options=options)
+            return '{}::{}::text'.format(
+                self.codec.get_decode_sql(sql), self.get_cast_sql())
+        if options:
+            return self.decrypt_with_key_sql_with_options.format(
+                value=value, key=key, options=options)
+        return self.decrypt_with_key_sql.format(value=value, key=key)
+
+    def get_plaintext(self, value, connection):
+        """Return `value` as the text, or the bytes, the SQL encryption would receive."""
+        if not self.binary:
+            return super().get_plaintext(value, connection)
+        value = self.get_db_prep_save(value, connection)
+        if isinstance(value, datetime) and timezone.is_aware(value):
+            # Like `::timestamp`, in the connection's time zone.
+            value = timezone.make_naive(value, pytz.timezone(connection.timezone_name))
+        return self.codec.encode(value)
+
+    def from_decrypted(self, value):
+        """Decode the bytes of binary values, see `RowKeyFieldMixin.from_decrypted`."""
+        if isinstance(value, (bytes, memoryview)):
+            return self.codec.decode(value)
+        return super().from_decrypted(value)
+
+    def encrypt(self, text, key, connection):
+        """Encrypt `text` in python like `pgp_sym_encrypt` with the field's options.
+
+        The bytes of binary values are encrypted like `pgp_sym_encrypt_bytea`.
+        """
+        from pgcrypto import openpgp
+        data = text if self.binary else text.encode('utf-8')
+        return Ciphertext(openpgp.encrypt(
+            data, key, self.get_pgp_options(connection), binary=self.binary))
+
+    def decrypt(self, value, key, connection):
+        """Decrypt the OpenPGP message `value` in python, to bytes for binary values."""
+        from pgcrypto import openpgp
+        data = openpgp.decrypt(value, key, self.get_pgp_options(connection))
+        return data if self.binary else data.decode('utf-8')
+
+
+class AESFieldMixin(RowKeyFieldMixin):
+    """Raw AES encrypted field mixin for postgres.
+
+    Values are encrypted with `encrypt_iv` under a random IV and
+    authenticated with a truncated HMAC, see `0003_aes_functions`. Without the
+    OpenPGP framing, ciphertexts are smaller and cheaper to decrypt.
+    """
+    encrypt_sql = AES_ENCRYPT_SQL
+    decrypt_sql = AES_DECRYPT_SQL
+    encrypt_with_key_sql = AES_ENCRYPT_WITH_KEY_SQL
+    decrypt_with_key_sql = AES_DECRYPT_WITH_KEY_SQL
+
+    def encrypt(self, text, key, connection):
+        """Encrypt `text` in python like `pgcrypto_aes_encrypt`."""
+        from pgcrypto.crypt import AESCryptographer
+        return Ciphertext(AESCryptographer.encrypted(key, text.encode('utf-8')))
+
+    def decrypt(self, value, key, connection):
+        """Decrypt `value` in python."""
+        from pgcrypto.crypt import AESCryptographer
+        return AESCryptographer.decrypted(key, value).decode('utf-8')
 
 
 class DecimalPGPFieldMixin:
@@ -0,0 +1,34 @@
+from django.contrib.postgres.fields import ArrayField
+from django.db import models
+
+
+class Checkpoint(models.Model):
+    """Progress of a resumable batch job such as a key rotation.
+
+    `last_pk` is the keyset pagination watermark: every row up to and
+    including it has been processed. `pending` holds the ids whose new keys
+    are committed in the database but not yet promoted to the key store.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    last_pk = models.TextField(blank=True, null=True)
+    pending = ArrayField(models.TextField(), default=list, blank=True)
+    processed = models.BigIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        """Show the job name and how far it got."""
+        return '{} ({})'.format(self.name, self.last_pk)
+
+
+class LocalKey(models.Model):
+    """Copy of a row key in postgres, read by the `pgcrypto_row_key` function.
+
+    The `key_store` foreign table can't be read by parallel workers; this
+    table and the `PARALLEL SAFE` function can, see `PGCRYPTO_LOCAL_KEYS`.
+    """
+    id = models.CharField(max_length=255, primary_key=True)
+    key = models.TextField()
+
+    def __str__(self):
+        """Show the row id, not the key."""
+        return self.id
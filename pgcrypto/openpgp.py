@@ -0,0 +1,373 @@
+"""OpenPGP symmetric key messages, as written by pgcrypto's `pgp_sym_encrypt`.
+
+This implements the subset of RFC 4880 that pgcrypto produces and reads: a
+Symmetric-Key Encrypted Session Key packet (optionally carrying an encrypted
+session key) followed by a Symmetrically Encrypted Integrity Protected Data
+packet (or a plain Symmetrically Encrypted Data packet with `disable-mdc=1`)
+holding an optionally compressed Literal Data packet.
+"""
+import hashlib
+import time
+import zlib
+from os import urandom
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import algorithms, Cipher, modes
+
+try:
+    from cryptography.hazmat.decrepit.ciphers import algorithms as decrepit_algorithms
+    from cryptography.hazmat.decrepit.ciphers.modes import CFB
+except ImportError:  # cryptography < 43
+    decrepit_algorithms = algorithms
+    CFB = modes.CFB
+
+# Packet tags.
+SKESK = 3
+SED = 9
+COMPRESSED = 8
+LITERAL = 11
+SEIPD = 18
+MDC = 19
+
+MDC_HEADER = b'\xd3\x14'
+
+# OpenPGP id: (pgcrypto option name, cryptography algorithm name, key size).
+CIPHERS = {
+    2: ('3des', 'TripleDES', 24),
+    3: ('cast5', 'CAST5', 16),
+    4: ('bf', 'Blowfish', 16),
+    7: ('aes128', 'AES', 16),
+    8: ('aes192', 'AES', 24),
+    9: ('aes256', 'AES', 32),
+}
+HASHES = {
+    1: 'md5', 2: 'sha1', 3: 'ripemd160', 8: 'sha256', 9: 'sha384', 10: 'sha512',
+    11: 'sha224',
+}
+# Compression id: zlib wbits.
+COMPRESSION = {0: None, 1: -15, 2: 15}
+
+# pgcrypto option values and defaults, see "F.25.3.6. Options for PGP Functions".
+CIPHER_IDS = {name: cipher_id for cipher_id, (name, _, _) in CIPHERS.items()}
+S2K_DIGEST_IDS = {'md5': 1, 'sha1': 2}
+ENCRYPT_OPTIONS = {
+    'cipher-algo': 'aes128',
+    'compress-algo': '0',
+    'compress-level': '6',
+    'convert-crlf': '0',
+    'disable-mdc': '0',
+    'sess-key': '0',
+    's2k-mode': '3',
+    's2k-count': '65536',
+    's2k-digest-algo': 'sha1',
+    's2k-cipher-algo': None,
+    'unicode-mode': '0',
+}
+
+
+class PGPError(ValueError):
+    """The data is not an OpenPGP message this module can decrypt with the key."""
+
+
+def parse_options(options):
+    """Split a pgcrypto options string like 'compress-algo=1, s2k-mode=1'."""
+    parsed = {}
+    for option in (options or '').split(','):
+        if option.strip():
+            name, value = option.split('=')
+            parsed[name.strip()] = value.strip()
+    return parsed
+
+
+def _algorithm(cipher_id):
+    try:
+        _, name, key_size = CIPHERS[cipher_id]
+    except KeyError:
+        raise PGPError('Unsupported cipher algorithm {}'.format(cipher_id))
+    algorithm = getattr(decrepit_algorithms, name, None) or getattr(algorithms, name)
+    return algorithm, key_size
+
+
+def _cfb(cipher_id, key, iv=None):
+    algorithm, _ = _algorithm(cipher_id)
+    if iv is None:
+        iv = bytes(algorithm.block_size // 8)
+    return Cipher(algorithm(key), CFB(iv), backend=default_backend())
+
+
+def _block_size(cipher_id):
+    return _algorithm(cipher_id)[0].block_size // 8
+
+
+def decode_count(coded):
+    """Return the number of bytes hashed by an iterated S2K count octet."""
+    return (16 + (coded & 15)) << ((coded >> 4) + 6)
+
+
+def encode_count(count):
+    """Return the smallest S2K count octet hashing at least `count` bytes."""
+    for coded in range(256):
+        if decode_count(coded) >= count:
+            return coded
+    return 255
+
+
+def s2k(password, key_size, hash_id, salt=b'', count=None):
+    """Derive a `key_size` bytes key from `password` (RFC 4880 3.7.1)."""
+    try:
+        hash_name = HASHES[hash_id]
+    except KeyError:
+        raise PGPError('Unsupported S2K digest algorithm {}'.format(hash_id))
+
+    data = salt + password
+    if count is not None and count > len(data):
+        data = data * (count // len(data)) + data[:count % len(data)]
+
+    key = b''
+    preload = 0
+    while len(key) < key_size:
+        digest = hashlib.new(hash_name)
+        digest.update(bytes(preload))
+        digest.update(data)
+        key += digest.digest()
+        preload += 1
+    return key[:key_size]
+
+
+def iter_packets(data):
+    """Yield the (tag, body) of the packets of `data`.
+
+    Both packet formats are read, including the partial body lengths
+    pgcrypto streams its data packets with.
+    """
+    view = memoryview(data)
+    position = 0
+    while position < len(view):
+        header = view[position]
+        position += 1
+        if not header & 0x80:
+            raise PGPError('Corrupt data')
+
+        if header & 0x40:
+            tag = header & 0x3f
+            chunks = []
+            while True:
+                length, position, partial = _new_length(view, position)
+                chunks.append(view[position:position + length])
+                position += length
+                if not partial:
+                    break
+            body = b''.join(chunks)
+        else:
+            tag = (header >> 2) & 0x0f
+            length_type = header & 3
+            if length_type == 3:
+                length = len(view) - position
+            else:
+                size = 1 << length_type
+                length = int.from_bytes(view[position:position + size], 'big')
+                position += size
+            body = bytes(view[position:position + length])
+            position += length
+
+        if position > len(view):
+            raise PGPError('Truncated data')
+        yield tag, body
+
+
+def _new_length(view, position):
+    first = view[position]
+    if first < 192:
+        return first, position + 1, False
+    if first < 224:
+        return ((first - 192) << 8) + view[position + 1] + 192, position + 2, False
+    if first == 255:
+        return int.from_bytes(view[position + 1:position + 5], 'big'), position + 5, False
+    return 1 << (first & 0x1f), position + 1, True
+
+
+def read_skesk(body, password):
+    """Return the (cipher id, session key) of a symmetric-key encrypted session key."""
+    if body[0] != 4:
+        raise PGPError('Unsupported session key packet version {}'.format(body[0]))
+    cipher_id = body[1]
+    mode = body[2]
+    hash_id = body[3]
+    if mode == 0:
+        salt, count, position = b'', None, 4
+    elif mode == 1:
+        salt, count, position = body[4:12], None, 12
+    elif mode == 3:
+        salt, count, position = body[4:12], decode_count(body[12]), 13
+    else:
+        raise PGPError('Unsupported S2K mode {}'.format(mode))
+
+    key = s2k(password, _algorithm(cipher_id)[1], hash_id, salt, count)
+    encrypted_session_key = body[position:]
+    if not encrypted_session_key:
+        return cipher_id, key
+
+    decryptor = _cfb(cipher_id, key).decryptor()
+    session = decryptor.update(encrypted_session_key) + decryptor.finalize()
+    return session[0], session[1:]
+
+
+def decrypt_seipd(body, cipher_id, key):
+    """Decrypt and check a Symmetrically Encrypted Integrity Protected Data packet."""
+    if body[0] != 1:
+        raise PGPError('Unsupported encrypted data packet version {}'.format(body[0]))
+    block_size = _block_size(cipher_id)
+    decryptor = _cfb(cipher_id, key).decryptor()
+    plain = decryptor.update(body[1:]) + decryptor.finalize()
+
+    if plain[block_size - 2:block_size] != plain[block_size:block_size + 2]:
+        raise PGPError('Wrong key or corrupt data')
+    if plain[-22:-20] != MDC_HEADER or hashlib.sha1(plain[:-20]).digest() != plain[-20:]:
+        raise PGPError('Corrupt data')
+    return plain[block_size + 2:-22]
+
+
+def decrypt_sed(body, cipher_id, key):
+    """Decrypt a Symmetrically Encrypted Data packet (OpenPGP CFB with resync)."""
+    block_size = _block_size(cipher_id)
+    decryptor = _cfb(cipher_id, key).decryptor()
+    prefix = decryptor.update(body[:block_size + 2])
+    if prefix[block_size - 2:block_size] != prefix[block_size:block_size + 2]:
+        raise PGPError('Wrong key or corrupt data')
+
+    decryptor = _cfb(cipher_id, key, body[2:block_size + 2]).decryptor()
+    return decryptor.update(body[block_size + 2:]) + decryptor.finalize()
+
+
+def read_literal(data, options):
+    """Return the content of the (compressed) Literal Data packet in `data`."""
+    for tag, body in iter_packets(data):
+        if tag == COMPRESSED:
+            try:
+                wbits = COMPRESSION[body[0]]
+            except KeyError:
+                raise PGPError('Unsupported compression algorithm {}'.format(body[0]))
+            try:
+                content = body[1:] if wbits is None else zlib.decompress(body[1:], wbits)
+            except zlib.error:
+                raise PGPError('Corrupt data')
+            return read_literal(content, options)
+        if tag == LITERAL:
+            name_length = body[1]
+            content = body[6 + name_length:]
+            if options.get('convert-crlf') == '1' and body[0] != ord('b'):
+                content = content.replace(b'\r\n', b'\n')
+            return content
+    raise PGPError('Corrupt data')
+
+
+def decrypt(data, password, options=None):
+    """Decrypt a message of `pgp_sym_encrypt` and return its bytes.
+
+    `password` is the key given to pgcrypto, `options` its options string;
+    only `convert-crlf` matters when decrypting.
+    """
+    if isinstance(password, str):
+        password = password.encode('utf-8')
+    options = parse_options(options)
+
+    session = None
+    for tag, body in iter_packets(bytes(data)):
+        if tag == SKESK and session is None:
+            session = read_skesk(body, password)
+        elif tag in (SEIPD, SED):
+            if session is None:
+                raise PGPError('Corrupt data')
+            cipher_id, key = session
+            if tag == SEIPD:
+                return read_literal(decrypt_seipd(body, cipher_id, key), options)
+            return read_literal(decrypt_sed(body, cipher_id, key), options)
+    raise PGPError('Corrupt data')
+
+
+def packet(tag, body):
+    """Return a packet in the new format with a fixed body length."""
+    length = len(body)
+    if length < 192:
+        header = bytes([length])
+    elif length < 8384:
+        length -= 192
+        header = bytes([(length >> 8) + 192, length & 0xff])
+    else:
+        header = b'\xff' + length.to_bytes(4, 'big')
+    return bytes([0xc0 | tag]) + header + body
+
+
+def write_skesk(password, options, cipher_id, s2k_cipher_id, hash_id):
+    """Return the (session key, Symmetric-Key Encrypted Session Key packet body)."""
+    s2k_mode = int(options['s2k-mode'])
+    salt = urandom(8) if s2k_mode else b''
+    count = None
+    spec = bytes([s2k_mode, hash_id]) + salt
+    if s2k_mode == 3:
+        coded = encode_count(int(options['s2k-count']))
+        count = decode_count(coded)
+        spec += bytes([coded])
+    elif s2k_mode not in (0, 1):
+        raise PGPError('Unsupported S2K mode {}'.format(s2k_mode))
+
+    if options['sess-key'] != '1':
+        key = s2k(password, _algorithm(cipher_id)[1], hash_id, salt, count)
+        return key, bytes([4, cipher_id]) + spec
+
+    s2k_key = s2k(password, _algorithm(s2k_cipher_id)[1], hash_id, salt, count)
+    key = urandom(_algorithm(cipher_id)[1])
+    encryptor = _cfb(s2k_cipher_id, s2k_key).encryptor()
+    session = encryptor.update(bytes([cipher_id]) + key) + encryptor.finalize()
+    return key, bytes([4, s2k_cipher_id]) + spec + session
+
+
+def encrypt(data, password, options=None, binary=False):
+    """Encrypt `data` with `password` and `options` as `pgp_sym_encrypt` does.
+
+    The message is readable by `pgp_sym_decrypt` and `decrypt`, or like
+    `pgp_sym_encrypt_bytea` with `binary`, readable by `pgp_sym_decrypt_bytea`.
+    """
+    if isinstance(password, str):
+        password = password.encode('utf-8')
+    parsed = parse_options(options)
+    unknown = set(parsed) - set(ENCRYPT_OPTIONS)
+    if unknown:
+        raise PGPError('Unsupported options: {}'.format(', '.join(sorted(unknown))))
+    options = dict(ENCRYPT_OPTIONS, **parsed)
+
+    try:
+        cipher_id = CIPHER_IDS[options['cipher-algo']]
+        s2k_cipher_id = CIPHER_IDS[options['s2k-cipher-algo'] or options['cipher-algo']]
+        hash_id = S2K_DIGEST_IDS[options['s2k-digest-algo']]
+        compression = COMPRESSION[int(options['compress-algo'])]
+    except (KeyError, ValueError) as e:
+        raise PGPError('Unsupported option value {}'.format(e))
+
+    key, skesk = write_skesk(password, options, cipher_id, s2k_cipher_id, hash_id)
+    if options['convert-crlf'] == '1' and not binary:
+        data = data.replace(b'\n', b'\r\n')
+    literal_type = b'b' if binary else b't'
+    literal = packet(
+        LITERAL, literal_type + b'\x00' + int(time.time()).to_bytes(4, 'big') + data)
+    if compression is not None:
+        compressor = zlib.compressobj(
+            int(options['compress-level']), zlib.DEFLATED, compression)
+        compressed = compressor.compress(literal) + compressor.flush()
+        literal = packet(COMPRESSED, bytes([int(options['compress-algo'])]) + compressed)
+
+    block_size = _block_size(cipher_id)
+    prefix = urandom(block_size)
+    prefix += prefix[-2:]
+    if options['disable-mdc'] == '1':
+        encryptor = _cfb(cipher_id, key).encryptor()
+        encrypted = encryptor.update(prefix)
+        encryptor = _cfb(cipher_id, key, encrypted[2:]).encryptor()
+        encrypted += encryptor.update(literal) + encryptor.finalize()
+        return packet(SKESK, skesk) + packet(SED, encrypted)
+
+    plain = prefix + literal + MDC_HEADER
+    plain += hashlib.sha1(plain).digest()
+    encryptor = _cfb(cipher_id, key).encryptor()
+    encrypted = encryptor.update(plain) + encryptor.finalize()
+    return packet(SKESK, skesk) + packet(SEIPD, b'\x01' + encrypted)
@@ -0,0 +1,73 @@
+"""Blind tokens for searching encrypted text without decrypting every row.
+
+A `SearchTokensField` stores keyed HMACs of the lowercased prefixes and
+n-grams of another field. A `__istartswith` or `__icontains` lookup on that
+field first matches the tokens of the searched text, which a GIN index
+answers, and only decrypts the candidate rows to verify them.
+"""
+import hmac
+from hashlib import sha256
+
+from django.conf import settings
+
+PREFIX = 'p'
+NGRAM = 'g'
+# Hex digits kept of each HMAC: 64 bits, enough to keep false candidates rare.
+TOKEN_LENGTH = 16
+
+
+def get_search_key(connection):
+    """Return the HMAC key: `PGCRYPTO_SEARCH_KEY`, defaulting to `PGCRYPTO_KEY`."""
+    from pgcrypto.mixins import get_setting
+    key = get_setting(connection, 'PGCRYPTO_SEARCH_KEY', None)
+    if key is None:
+        key = get_setting(connection, 'PGCRYPTO_KEY', settings.PGCRYPTO_KEY)
+    return key.encode('utf-8')
+
+
+def normalize(value):
+    """Return `value` as compared by `ILIKE`."""
+    return str(value).lower()
+
+
+def token(key, kind, text):
+    """Return the token of `text` for a prefix or n-gram `kind`."""
+    digest = hmac.new(key, '{}\0{}'.format(kind, text).encode('utf-8'), sha256)
+    return digest.hexdigest()[:TOKEN_LENGTH]
+
+
+def ngrams(text, size):
+    """Return the distinct substrings of `text` of `size` characters."""
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def value_tokens(value, key, ngram_size, prefix_length):
+    """Return the sorted tokens stored for `value`."""
+    if value is None:
+        return []
+    text = normalize(value)
+    tokens = {
+        token(key, PREFIX, text[:i])
+        for i in range(1, min(len(text), prefix_length) + 1)
+    }
+    tokens.update(token(key, NGRAM, ngram) for ngram in ngrams(text, ngram_size))
+    return sorted(tokens)
+
+
+def startswith_tokens(value, key, ngram_size, prefix_length):
+    """Return the tokens a value starting with `value` has, `None` for any value."""
+    text = normalize(value)
+    if not text:
+        return None
+    tokens = {token(key, PREFIX, text[:prefix_length])}
+    if len(text) > prefix_length:
+        tokens.update(token(key, NGRAM, ngram) for ngram in ngrams(text, ngram_size))
+    return sorted(tokens)
+
+
+def contains_tokens(value, key, ngram_size):
+    """Return the tokens a value containing `value` has, `None` when too short."""
+    text = normalize(value)
+    if len(text) < ngram_size:
+        return None
+    return sorted(token(key, NGRAM, ngram) for ngram in ngrams(text, ngram_size))
@@ -0,0 +1,104 @@
+"""Consistent hashing of the key ids over several redis nodes.
+
+With `DEFF_REDIS_NODES` (`host:port` strings, or one comma separated string),
+each key lives on the node its id hashes to on a ring of `VNODES` points per
+node, so that adding a node only moves about 1/N of the keys. While they are
+moved by `pgcrypto_rebalance_keys`, `DEFF_REDIS_PREVIOUS_NODES` lists the
+nodes before the change: keys not yet moved are read from there.
+"""
+import bisect
+import hashlib
+from functools import lru_cache
+
+# Points of each node on the ring.
+VNODES = 160
+
+SHARD_NAME = 'redis_shard_{}'
+CREATE_SHARD_SERVER_SQL = (
+    "CREATE SERVER IF NOT EXISTS {server} FOREIGN DATA WRAPPER redis_fdw "
+    "OPTIONS (address '{host}', port '{port}');"
+)
+CREATE_SHARD_USER_SQL = 'CREATE USER MAPPING IF NOT EXISTS FOR PUBLIC SERVER {server};'
+CREATE_SHARD_TABLE_SQL = (
+    "CREATE FOREIGN TABLE IF NOT EXISTS key_store_{name} (id text, key text) "
+    "SERVER {server} OPTIONS (database '0');"
+)
+DROP_KEY_STORE_TABLE_SQL = (
+    "DO $$ BEGIN IF EXISTS (SELECT 1 FROM pg_class WHERE relname = 'key_store' "
+    "AND relkind = 'f') THEN DROP FOREIGN TABLE key_store; END IF; END $$;"
+)
+CREATE_KEY_STORE_VIEW_SQL = 'CREATE OR REPLACE VIEW key_store AS {};'
+
+
+def hash_id(value):
+    """Return the position of `value` on the ring, stable across processes."""
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+def parse_node(node):
+    """Return the host and port of a `host:port` node."""
+    host, _, port = node.rpartition(':')
+    if not host:
+        return node, 6379
+    return host, int(port)
+
+
+class HashRing:
+    """Consistent hashing ring mapping key ids to `nodes`."""
+
+    def __init__(self, nodes, vnodes=VNODES):
+        """Place `vnodes` points of each node on the ring."""
+        if not nodes:
+            raise ValueError('A hash ring needs at least one node.')
+        self.nodes = tuple(nodes)
+        points = sorted(
+            (hash_id('{}#{}'.format(node, i)), node)
+            for node in self.nodes
+            for i in range(vnodes)
+        )
+        self.hashes = [position for position, _ in points]
+        self.owners = [node for _, node in points]
+
+    def get_node(self, key_id):
+        """Return the node holding the key of `key_id`."""
+        index = bisect.bisect(self.hashes, hash_id(str(key_id)))
+        return self.owners[index % len(self.owners)]
+
+    def group(self, key_ids):
+        """Return `key_ids` by node, in their order."""
+        groups = {}
+        for key_id in key_ids:
+            groups.setdefault(self.get_node(key_id), []).append(key_id)
+        return groups
+
+
+@lru_cache(maxsize=None)
+def get_ring(nodes):
+    """Return the (cached) ring of the tuple `nodes`."""
+    return HashRing(nodes)
+
+
+def key_store_sql(nodes):
+    """Return the SQL turning `key_store` into a view over a foreign table per node.
+
+    The key of an id is on a single node (or on two with the same value while
+    rebalancing), so the `id = ...` condition pushed down to every table
+    finds it.
+    """
+    statements = []
+    selects = []
+    for node in nodes:
+        host, port = parse_node(node)
+        name = hashlib.md5(node.encode('utf-8')).hexdigest()[:8]
+        server = SHARD_NAME.format(name)
+        statements += [
+            CREATE_SHARD_SERVER_SQL.format(server=server, host=host, port=port),
+            CREATE_SHARD_USER_SQL.format(server=server),
+            CREATE_SHARD_TABLE_SQL.format(name=name, server=server),
+        ]
+        selects.append('SELECT id, key FROM key_store_{}'.format(name))
+    statements += [
+        DROP_KEY_STORE_TABLE_SQL,
+        CREATE_KEY_STORE_VIEW_SQL.format(' UNION ALL '.join(selects)),
+    ]
+    return statements
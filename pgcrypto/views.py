@@ -1,13 +1,26 @@
+import io
+import itertools
 import os
+import zipfile
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from urllib.parse import urlencode, urlsplit
 
-import magic
-import requests
 from django.conf import settings
 from django.core.validators import URLValidator, ValidationError
-from django.http import Http404, HttpResponse
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
 from django.views.generic import View
 
-from .crypt import Cryptographer
+from . import file_cache, keys
+from .fields import variant_name, VARIANT_NAME_RE
+
+# A file to decrypt: `read()` returns its content, `version` (the mtime or the
+# ETag of the stored file, `None` if unknown) changes when it is replaced.
+StoredFile = namedtuple('StoredFile', 'path read version last_modified')
 
 
 class FetchView(View):
@@ -27,6 +40,13 @@ class FetchView(View):
     to view *all* files, while using something like StaffRequiredMixin would
     mean that only staff members could read the file.
 
+    A `variant` query parameter serves that variant of an `EncryptedImageField`
+    (see `EncryptedImageFieldFile.variant_url`) instead of the original image.
+
+    Responses carry an ETag and a Last-Modified header to answer conditional
+    requests with a 304, and `PGCRYPTO_FILE_CACHE_BYTES` caches the decrypted
+    files (see `pgcrypto.file_cache`).
+
     Theoretically you could also write your view to be smart enough to take the
     requested path and match it against a list of permissions, allowing you to
     set out per-user permissions whilst still only using one encryption key for
@@ -34,6 +54,10 @@ class FetchView(View):
 
     """
 
+    # Database whose `key_store` holds the keys of the files, e.g. the
+    # database the models with the files are routed to.
+    using = None
+
     def get(self, request, *args, **kwargs):
 
         path = kwargs.get("path")
@@ -47,39 +71,128 @@ class FetchView(View):
         if not path:
             raise Http404
 
+        variant = request.GET.get('variant')
+        if variant is not None:
+            if not VARIANT_NAME_RE.match(variant):
+                raise Http404
+            path = self._variant_path(path, variant)
+
+        with self.open_file(self.resolve_path(path)) as stored:
+            return self.respond(request, uuid, stored)
+
+    def resolve_path(self, path):
+        """Return the local path of the file at `path`, URLs being returned as is.
+
+        Raises `Http404` for paths outside of MEDIA_ROOT and missing files.
+        """
         if self._is_url(path):
+            return path
 
-            content = requests.get(path, stream=True).raw.read()
+        # Normalise the path to strip out naughty attempts
+        path = os.path.normpath(path).replace(
+            settings.MEDIA_URL, settings.MEDIA_ROOT, 1)
 
-        else:
+        # Evil path request!
+        if not path.startswith(settings.MEDIA_ROOT):
+            raise Http404
 
-            # Normalise the path to strip out naughty attempts
-            path = os.path.normpath(path).replace(
-                settings.MEDIA_URL, settings.MEDIA_ROOT, 1)
+        # The file requested doesn't exist locally.  A legit 404
+        if not os.path.exists(path):
+            raise Http404
 
-            # Evil path request!
-            if not path.startswith(settings.MEDIA_ROOT):
-                raise Http404
+        return path
 
-            # The file requested doesn't exist locally.  A legit 404
-            if not os.path.exists(path):
-                raise Http404
+    @contextmanager
+    def open_file(self, path):
+        """Yield the `StoredFile` of the path returned by `resolve_path`."""
+        if self._is_url(path):
+            import requests
 
-            with open(path, "rb") as f:
-                content = f.read()
+            with requests.get(path, stream=True) as remote:
+                last_modified = remote.headers.get('Last-Modified')
+                if last_modified:
+                    last_modified = parse_http_date_safe(last_modified)
+                yield StoredFile(
+                    path, remote.raw.read,
+                    version=remote.headers.get('ETag'),
+                    last_modified=last_modified,
+                )
+            return
 
-        from django.db import connection
-        with connection.cursor() as cursor:
-            cursor.execute("select key from key_store where id = %s", (uuid,))
-            row = cursor.fetchone()
-            if row is None:
-                raise Http404
-            else:
-                key = row[0].encode('utf-8')
+        stat = os.stat(path)
+        yield StoredFile(
+            path, partial(self._read, path),
+            version='{}-{}'.format(stat.st_mtime_ns, stat.st_size),
+            last_modified=int(stat.st_mtime),
+        )
+
+    def respond(self, request, uuid, stored):
+        """Return the decrypted `stored` file, or a 304.
+
+        The version of `stored` (its mtime or remote ETag) and the key
+        fingerprint make the ETag of the response, answering conditional
+        requests before the file is read.
+        """
+        key = keys.get_key(uuid, create=False, using=self.using)
+        if key is None:
+            raise Http404
+
+        version = self.get_version(key, stored)
+        etag = None
+        if version is not None:
+            etag = '"{}"'.format(
+                file_cache.fingerprint('{}\0{}'.format(stored.path, version)))
+            not_modified = get_conditional_response(
+                request, etag=etag, last_modified=stored.last_modified)
+            if not_modified is not None:
+                return not_modified
+
+        content = self.decrypt(uuid, key, stored)
+
+        import magic
 
-        content = Cryptographer.decrypted(password=key, content=content)
-        return HttpResponse(
+        response = HttpResponse(
             content, content_type=magic.Magic(mime=True).from_buffer(content))
+        if etag:
+            response['ETag'] = etag
+        if stored.last_modified:
+            response['Last-Modified'] = http_date(stored.last_modified)
+        return response
+
+    @staticmethod
+    def get_version(key, stored):
+        """Return the version of `stored` decrypted with `key`, `None` if unknown."""
+        if stored.version is None:
+            return None
+        return '{}:{}'.format(file_cache.fingerprint(key), stored.version)
+
+    def decrypt(self, uuid, key, stored):
+        """Return the plaintext of `stored`, from the file cache when enabled."""
+        version = self.get_version(key, stored)
+        cache = file_cache.get_cache() if version is not None else None
+        content = cache.get(uuid, stored.path, version) if cache else None
+        if content is None:
+            # Loaded on first use, like `requests`: most processes never serve files.
+            from .crypt import Cryptographer
+
+            content = Cryptographer.decrypted(
+                password=key.encode('utf-8'), content=stored.read())
+            if cache:
+                cache.set(uuid, stored.path, version, content)
+        return content
+
+    @classmethod
+    def _variant_path(cls, path, variant):
+        """Return the path, or the URL, of the `variant` of the file at `path`."""
+        if cls._is_url(path):
+            url = urlsplit(path)
+            return url._replace(path=variant_name(url.path, variant)).geturl()
+        return variant_name(path, variant)
+
+    @staticmethod
+    def _read(path):
+        with open(path, "rb") as f:
+            return f.read()
 
     @staticmethod
     def _is_url(path):
@@ -88,3 +201,117 @@ class FetchView(View):
             return True
         except ValidationError:
             return False
+
+
+class ZipStream(io.RawIOBase):
+    """Unseekable file collecting what `zipfile` writes until it is drained."""
+
+    def __init__(self):
+        """Start empty."""
+        super().__init__()
+        self.chunks = []
+
+    def writable(self):
+        """Accept writes."""
+        return True
+
+    def write(self, data):
+        """Collect `data`."""
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        """Return and forget the data written since the last call."""
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def archive_query(files):
+    """Return the `ArchiveView` query string of encrypted `FieldFile`s."""
+    query = []
+    for file in files:
+        query.append(('id', str(file.instance.pk)))
+        query.append(('path', file.storage.url(file.name)))
+    return urlencode(query)
+
+
+class ArchiveView(FetchView):
+    """Stream a ZIP of several files.
+
+    The files are given as pairs of `id` and `path` query parameters (see
+    `archive_query`). Like `FetchView`, it has to be subclassed with your own
+    access rules.
+
+    The keys of all the files are fetched in one batch, then `workers` threads
+    read and decrypt the files while the archive is streamed in request
+    order: at most `workers` decrypted files are held in memory, the one being
+    written included.
+    """
+
+    archive_name = 'files.zip'
+    compression = zipfile.ZIP_STORED
+    max_files = 100
+    workers = 4
+
+    def get(self, request, *args, **kwargs):
+        """Return the streamed archive, or a 404 for unknown or too many files."""
+        ids = request.GET.getlist('id')
+        paths = request.GET.getlist('path')
+        if not ids or len(ids) != len(paths) or len(ids) > self.max_files:
+            raise Http404
+
+        file_keys = keys.get_keys(ids, using=self.using)
+        if not all(key_id in file_keys for key_id in ids):
+            raise Http404
+        files = [
+            (key_id, self.resolve_path(path), name)
+            for key_id, path, name in zip(ids, paths, self.archive_names(paths))
+        ]
+
+        response = StreamingHttpResponse(
+            self.stream(files, file_keys), content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename="{}"'.format(
+            self.archive_name)
+        return response
+
+    @staticmethod
+    def archive_names(paths):
+        """Return the names of the files of `paths` in the archive, made unique."""
+        names = []
+        for path in paths:
+            name = os.path.basename(urlsplit(path).path) or 'file'
+            root, ext = os.path.splitext(name)
+            count = 1
+            while name in names:
+                count += 1
+                name = '{} ({}){}'.format(root, count, ext)
+            names.append(name)
+        return names
+
+    def fetch(self, key_id, key, path):
+        """Read and decrypt one file, in a worker thread."""
+        with self.open_file(path) as stored:
+            return self.decrypt(key_id, key, stored)
+
+    def stream(self, files, file_keys):
+        """Yield the archive, file by file."""
+        output = ZipStream()
+        files = iter(files)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            # Files are read and decrypted at most `workers` ahead of the archive.
+            pending = deque(
+                (name, pool.submit(self.fetch, key_id, file_keys[key_id], path))
+                for key_id, path, name in itertools.islice(files, self.workers)
+            )
+            with zipfile.ZipFile(output, 'w', compression=self.compression) as archive:
+                while pending:
+                    name, future = pending.popleft()
+                    archive.writestr(name, future.result())
+                    del future
+                    # The next file only once this one is written out.
+                    for key_id, path, next_name in itertools.islice(files, 1):
+                        pending.append((next_name, pool.submit(
+                            self.fetch, key_id, file_keys[key_id], path)))
+                    yield output.drain()
+        yield output.drain()
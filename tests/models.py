@@ -1,8 +1,10 @@
 import uuid
 
+from django.contrib.postgres.indexes import GinIndex
 from django.db import models
 
 from pgcrypto import fields
+from pgcrypto.managers import PGPManager
 
 
 class EncryptedFKModel(models.Model):
@@ -34,6 +36,8 @@ class EncryptedModel(models.Model):
         EncryptedFKModel, blank=True, null=True, on_delete=models.CASCADE
     )
 
+    objects = PGPManager()
+
     class Meta:
         """Sets up the meta for the test model."""
         app_label = 'tests'
@@ -54,3 +58,99 @@ class RelatedDateTime(models.Model):
         EncryptedDateTime, null=True,
         on_delete=models.CASCADE, related_name='related_again'
     )
+
+
+class EncryptedFileModel(models.Model):
+    """Dummy model used to exercise encrypted file storage."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    attachment = fields.EncryptedFileField(upload_to='attachments', blank=True)
+
+    class Meta:
+        """Sets up the meta for the test model."""
+        app_label = 'tests'
+
+
+class EncryptedAttachmentModel(models.Model):
+    """Dummy model used to test the key rotation of rows with encrypted files."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    text = fields.TextPGPSymmetricKeyField(blank=True, null=True)
+    attachment = fields.EncryptedFileField(upload_to='attachments', blank=True)
+
+    class Meta:
+        """Sets up the meta for the test model."""
+        app_label = 'tests'
+
+
+class EncryptedImageModel(models.Model):
+    """Dummy model used to exercise encrypted images and their variants."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    image = fields.EncryptedImageField(
+        upload_to='images', width_field='width', height_field='height',
+        variants={'thumb': (32, 32)}, blank=True,
+    )
+    width = models.PositiveIntegerField(null=True)
+    height = models.PositiveIntegerField(null=True)
+
+    class Meta:
+        """Sets up the meta for the test model."""
+        app_label = 'tests'
+
+
+class EncryptedOptionsModel(models.Model):
+    """Dummy model used to test fields with pgcrypto options."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    text = fields.TextPGPSymmetricKeyField(
+        options='s2k-mode=1, compress-algo=0', blank=True, null=True)
+    integer = fields.IntegerPGPSymmetricKeyField(
+        options='cipher-algo=aes256', blank=True, null=True)
+
+    class Meta:
+        """Sets up the meta for the test model."""
+        app_label = 'tests'
+
+
+class EncryptedBinaryModel(models.Model):
+    """Dummy model used to test fields encrypted in their binary encoding."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    integer = fields.IntegerPGPSymmetricKeyField(binary=True, blank=True, null=True)
+    date = fields.DatePGPSymmetricKeyField(binary=True, blank=True, null=True)
+    datetime = fields.DateTimePGPSymmetricKeyField(binary=True, blank=True, null=True)
+    decimal = fields.DecimalPGPSymmetricKeyField(
+        max_digits=8, decimal_places=2, binary=True, blank=True, null=True)
+
+    objects = PGPManager()
+
+    class Meta:
+        """Sets up the meta for the test model."""
+        app_label = 'tests'
+
+
+class EncryptedAESModel(models.Model):
+    """Dummy model used to test the AES fields."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    text = fields.TextAESField(blank=True, null=True)
+    integer = fields.IntegerAESField(blank=True, null=True)
+    date = fields.DateAESField(blank=True, null=True)
+    decimal = fields.DecimalAESField(
+        max_digits=8, decimal_places=2, blank=True, null=True)
+
+    objects = PGPManager()
+
+    class Meta:
+        """Sets up the meta for the test model."""
+        app_label = 'tests'
+
+
+class EncryptedSearchModel(models.Model):
+    """Dummy model used to test the search tokens."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    email = fields.EmailPGPSymmetricKeyField(blank=True, null=True)
+    email_tokens = fields.SearchTokensField('email')
+    name = fields.CharPGPSymmetricKeyField(max_length=100, blank=True, null=True)
+
+    objects = PGPManager()
+
+    class Meta:
+        """Sets up the meta for the test model."""
+        app_label = 'tests'
+        indexes = [GinIndex(fields=['email_tokens'])]
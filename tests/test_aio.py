@@ -0,0 +1,60 @@
+import shutil
+import tempfile
+from unittest import skipUnless
+
+from asgiref.sync import async_to_sync
+from django.core.files.base import ContentFile
+from django.test import TestCase
+
+from pgcrypto import aio, instrumentation, keys
+from .factories import EncryptedModelFactory
+from .models import EncryptedFileModel, EncryptedModel
+
+
+@skipUnless(aio.async_redis_available(), 'The asyncio client needs redis>=4.2.')
+class TestAsyncSaves(TestCase):
+    """Test the async saves of `pgcrypto.aio` and `PGPQuerySet`."""
+
+    def setUp(self):
+        """Start with an empty key cache."""
+        keys.clear_caches()
+
+    def test_acreate(self):
+        """Assert the key is resolved before the synchronous insert."""
+        with instrumentation.collect() as metrics:
+            acreate = EncryptedModel.objects.all().acreate
+            instance = async_to_sync(acreate)(pgp_sym_field='async')
+
+        self.assertEqual(metrics[instrumentation.KEY_STORE_QUERIES], 0)
+        instance = EncryptedModel.objects.get(pk=instance.pk)
+        self.assertEqual(instance.pgp_sym_field, 'async')
+
+    def test_abulk_create(self):
+        """Assert the keys of all the rows are resolved before the insert."""
+        instances = EncryptedModelFactory.build_batch(5, fk_model=None)
+
+        with instrumentation.collect() as metrics:
+            async_to_sync(EncryptedModel.objects.all().abulk_create)(instances)
+
+        self.assertEqual(metrics[instrumentation.KEY_STORE_QUERIES], 0)
+        self.assertEqual(metrics[instrumentation.PYTHON_ENCRYPTED_VALUES], 25)
+        for instance in instances:
+            with self.subTest(instance=instance):
+                self.assertEqual(
+                    EncryptedModel.objects.get(pk=instance.pk).pgp_sym_field,
+                    instance.pgp_sym_field,
+                )
+
+    def test_asave_file(self):
+        """Assert files are encrypted with the key resolved asynchronously."""
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        instance = EncryptedFileModel()
+        instance.attachment = ContentFile(b'content', name='async.txt')
+
+        with self.settings(MEDIA_ROOT=media_root), instrumentation.collect() as metrics:
+            async_to_sync(aio.asave)(instance)
+
+            self.assertEqual(metrics[instrumentation.KEY_STORE_QUERIES], 0)
+            with open(instance.attachment.path, 'rb') as f:
+                self.assertNotEqual(f.read(), b'content')
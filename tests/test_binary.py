@@ -0,0 +1,146 @@
+from datetime import date, datetime
+from decimal import Decimal
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+
+from pgcrypto import fields, keys
+from pgcrypto.bulk import copy_load
+from .models import EncryptedBinaryModel
+
+
+class TestCodecs(SimpleTestCase):
+    """Test the binary encodings of `pgcrypto.binary`."""
+
+    def test_encode(self):
+        """Assert values are encoded like postgres' send functions."""
+        for name, value, data in (
+            ('integer', -5, b'\xff\xff\xff\xfb'),
+            ('date', date(2000, 1, 2), b'\x00\x00\x00\x01'),
+            ('datetime', datetime(2000, 1, 1, 0, 0, 1), b'\x00\x00\x00\x00\x00\x0fB@'),
+            ('decimal', Decimal('-1.50'), b'\xff\xff\xff\xff\xff\xff\xff\x6a'),
+        ):
+            codec = EncryptedBinaryModel._meta.get_field(name).codec
+            with self.subTest(field=name):
+                self.assertEqual(codec.encode(value), data)
+                self.assertEqual(codec.decode(data), value)
+
+    def test_decode_sql(self):
+        """Assert the decrypted bytes are read as an integer of the codec's width."""
+        field = EncryptedBinaryModel._meta.get_field('decimal')
+        self.assertEqual(
+            field.codec.get_decode_sql('v'),
+            "(('x' || encode(v, 'hex'))::bit(64)::int8 * 1e-2)",
+        )
+
+    def test_encrypt_sql(self):
+        """Assert binary values are encrypted with `pgp_sym_encrypt_bytea`."""
+        field = EncryptedBinaryModel._meta.get_field('integer')
+        self.assertEqual(
+            field.get_encrypt_sql('key', connection),
+            "pgp_sym_encrypt_bytea(int4send(%s::int4), 'key')",
+        )
+
+    def test_no_codec(self):
+        """Assert fields without a binary encoding reject `binary`."""
+        with self.assertRaises(ImproperlyConfigured):
+            fields.FloatPGPSymmetricKeyField(binary=True)
+
+    def test_decimal_digits(self):
+        """Assert binary decimals fit in 8 bytes."""
+        with self.assertRaises(ImproperlyConfigured):
+            fields.DecimalPGPSymmetricKeyField(
+                max_digits=19, decimal_places=2, binary=True)
+
+    def test_deconstruct(self):
+        """Assert `binary` is part of the migrations."""
+        field = EncryptedBinaryModel._meta.get_field('date')
+        self.assertIs(field.deconstruct()[3]['binary'], True)
+
+    def test_smaller_messages(self):
+        """Assert the binary encoding shrinks the messages of large values."""
+        text = fields.DateTimePGPSymmetricKeyField()
+        binary = EncryptedBinaryModel._meta.get_field('datetime')
+        value = datetime(2020, 5, 1, 12, 30, 1, 5)
+
+        def encrypt(field):
+            plaintext = field.get_plaintext(value, connection)
+            return field.encrypt(plaintext, 'key', connection)
+
+        self.assertLess(len(encrypt(binary)), len(encrypt(text)))
+
+    def test_python_round_trip(self):
+        """Assert binary messages encrypted in python are decrypted to the value."""
+        field = EncryptedBinaryModel._meta.get_field('decimal')
+        plaintext = field.get_plaintext(Decimal('12.34'), connection)
+        message = field.encrypt(plaintext, 'key', connection)
+
+        decrypted = field.decrypt(message, 'key', connection)
+        self.assertEqual(field.from_decrypted(decrypted), Decimal('12.34'))
+
+
+class TestBinaryFields(TestCase):
+    """Test the fields encrypted in their binary encoding."""
+    values = {
+        'integer': -42,
+        'date': date(1999, 12, 30),
+        'datetime': datetime(2020, 5, 1, 12, 30, 1, 5),
+        'decimal': Decimal('-123.45'),
+    }
+
+    def setUp(self):
+        """Start with an empty key cache."""
+        keys.clear_caches()
+
+    def assert_values(self, instance):
+        """Assert `instance` has the decrypted `values`."""
+        for name, value in self.values.items():
+            with self.subTest(field=name):
+                self.assertEqual(getattr(instance, name), value)
+
+    def test_round_trip(self):
+        """Assert values encrypted in SQL are decrypted in SQL and in python."""
+        instance = EncryptedBinaryModel.objects.create(**self.values)
+
+        self.assert_values(EncryptedBinaryModel.objects.get(pk=instance.pk))
+        self.assert_values(
+            EncryptedBinaryModel.objects.decrypt_in_python().get(pk=instance.pk))
+
+    def test_encrypt_in_python(self):
+        """Assert values encrypted in python are decrypted in SQL."""
+        with self.settings(PGCRYPTO_ENCRYPT_IN_PYTHON=True):
+            instance = EncryptedBinaryModel.objects.create(**self.values)
+
+        self.assert_values(EncryptedBinaryModel.objects.get(pk=instance.pk))
+
+    def test_lookups(self):
+        """Assert binary values are filtered on their decrypted value."""
+        instance = EncryptedBinaryModel.objects.create(**self.values)
+        EncryptedBinaryModel.objects.create(integer=1, decimal=Decimal('1'))
+
+        queryset = EncryptedBinaryModel.objects.filter(
+            integer__lt=0, decimal__lte=Decimal('-100'), date__year=1999)
+        self.assertEqual(list(queryset.values_list('pk', flat=True)), [instance.pk])
+
+    def test_bulk(self):
+        """Assert bulk writes encrypt the binary encoding."""
+        created = EncryptedBinaryModel.objects.bulk_create([EncryptedBinaryModel()])
+        for instance in created:
+            for name, value in self.values.items():
+                setattr(instance, name, value)
+        EncryptedBinaryModel.objects.bulk_update(created, list(self.values))
+        copy_load(EncryptedBinaryModel, [dict(self.values)])
+
+        instances = EncryptedBinaryModel.objects.all()
+        self.assertEqual(len(instances), 2)
+        for instance in instances:
+            self.assert_values(instance)
+
+    def test_null(self):
+        """Assert NULLs stay NULL."""
+        instance = EncryptedBinaryModel.objects.create()
+
+        instance = EncryptedBinaryModel.objects.get(pk=instance.pk)
+        self.assertIsNone(instance.integer)
+        self.assertIsNone(instance.datetime)
@@ -0,0 +1,61 @@
+from decimal import Decimal
+
+from django.test import TestCase
+
+from pgcrypto import instrumentation, keys
+from pgcrypto.bulk import copy_load
+from .factories import EncryptedModelFactory
+from .models import EncryptedAESModel, EncryptedModel
+
+
+class TestCopyLoad(TestCase):
+    """Test `pgcrypto.bulk.copy_load`."""
+
+    def setUp(self):
+        """Start with an empty key cache."""
+        keys.cache.clear()
+
+    def test_instances(self):
+        """Assert the loaded rows are decrypted with their own keys."""
+        instances = EncryptedModelFactory.build_batch(5, fk_model=None)
+        instances[0].pgp_sym_field = 'tab\tnew line\nback\\slash'
+        instances[1].integer_pgp_sym_field = None
+
+        with instrumentation.collect() as metrics:
+            result = copy_load(EncryptedModel, instances, batch_size=2)
+
+        self.assertEqual(result.rows, 5)
+        self.assertGreater(result.rows_per_second, 0)
+        # One pipelined round trip per batch.
+        self.assertEqual(metrics[instrumentation.REDIS_CALLS], 3)
+        for instance in instances:
+            with self.subTest(instance=instance):
+                loaded = EncryptedModel.objects.get(pk=instance.pk)
+                self.assertEqual(loaded.pgp_sym_field, instance.pgp_sym_field)
+                self.assertEqual(
+                    loaded.integer_pgp_sym_field, instance.integer_pgp_sym_field)
+                self.assertEqual(loaded.date_pgp_sym_field, instance.date_pgp_sym_field)
+                self.assertEqual(
+                    loaded.datetime_pgp_sym_field, instance.datetime_pgp_sym_field)
+
+    def test_dicts(self):
+        """Assert rows can be given as field values."""
+        copy_load(EncryptedAESModel, [{'text': 'bonjour', 'decimal': Decimal('1.20')}])
+
+        loaded = EncryptedAESModel.objects.get()
+        self.assertEqual(loaded.text, 'bonjour')
+        self.assertEqual(loaded.decimal, Decimal('1.20'))
+        self.assertIsNone(loaded.integer)
+
+    def test_encrypt_in_python(self):
+        """Assert ciphertexts encrypted in python are copied as is."""
+        instance = EncryptedModelFactory.build(fk_model=None, pgp_sym_field='secret')
+
+        with self.settings(PGCRYPTO_ENCRYPT_IN_PYTHON=True):
+            with instrumentation.collect() as metrics:
+                copy_load(EncryptedModel, [instance])
+
+        self.assertGreater(metrics[instrumentation.PYTHON_ENCRYPTED_VALUES], 0)
+        self.assertEqual(instance.pgp_sym_field, 'secret')
+        self.assertEqual(
+            EncryptedModel.objects.get(pk=instance.pk).pgp_sym_field, 'secret')
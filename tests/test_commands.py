@@ -0,0 +1,296 @@
+import csv
+import json
+import shutil
+import tempfile
+from io import StringIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, Storage
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+from pgcrypto import keys
+from pgcrypto.crypt import Cryptographer
+from pgcrypto.management.commands.pgcrypto_reencrypt_files import (
+    Command as ReencryptFilesCommand,
+    reencrypt,
+)
+from pgcrypto.models import Checkpoint, LocalKey
+from .factories import EncryptedModelFactory
+from .models import EncryptedAttachmentModel, EncryptedModel, EncryptedOptionsModel
+
+
+class MemoryStorage(Storage):
+    """Storage without local paths, failing to save the names in `fail`."""
+
+    def __init__(self, files, fail=()):
+        """Hold the `files` contents by name."""
+        self.files = dict(files)
+        self.fail = fail
+
+    def _save(self, name, content):
+        if name in self.fail:
+            raise OSError(name)
+        self.files[name] = content.read()
+        return name
+
+    def _open(self, name, mode='rb'):
+        return ContentFile(self.files[name])
+
+    def exists(self, name):
+        """Return whether `name` is stored."""
+        return name in self.files
+
+    def delete(self, name):
+        """Remove `name`."""
+        self.files.pop(name, None)
+
+
+class TestRotateKeysCommand(TestCase):
+    """Test `pgcrypto_rotate_keys` re-encrypts rows with new keys."""
+
+    def test_rotate(self):
+        """Assert values survive the rotation and every key changes."""
+        instances = EncryptedModelFactory.create_batch(3)
+        old_keys = keys.fetch_keys([instance.pk for instance in instances])
+
+        call_command('pgcrypto_rotate_keys', 'tests.EncryptedModel', chunk_size=2)
+
+        new_keys = keys.fetch_keys([instance.pk for instance in instances])
+        for instance in instances:
+            with self.subTest(instance=instance):
+                self.assertNotEqual(
+                    old_keys[str(instance.pk)], new_keys[str(instance.pk)])
+                rotated = EncryptedModel.objects.get(pk=instance.pk)
+                self.assertEqual(rotated.pgp_sym_field, instance.pgp_sym_field)
+                self.assertEqual(
+                    rotated.email_pgp_sym_field, instance.email_pgp_sym_field)
+
+        checkpoint = Checkpoint.objects.get(name='rotate:tests.encryptedmodel')
+        self.assertEqual(checkpoint.pending, [])
+        self.assertEqual(checkpoint.processed, 3)
+
+    def test_resume(self):
+        """Assert a finished checkpoint makes a second run a no-op."""
+        instance = EncryptedModelFactory.create()
+        call_command('pgcrypto_rotate_keys', 'tests.EncryptedModel')
+        key = keys.fetch_keys([instance.pk])
+
+        call_command('pgcrypto_rotate_keys', 'tests.EncryptedModel')
+
+        self.assertEqual(keys.fetch_keys([instance.pk]), key)
+
+    def test_field_options(self):
+        """Assert the new ciphertexts keep the pgcrypto options of their field."""
+        instance = EncryptedOptionsModel.objects.create(text='bonjour', integer=42)
+
+        with CaptureQueriesContext(connection) as queries:
+            call_command('pgcrypto_rotate_keys', 'tests.EncryptedOptionsModel')
+
+        update = next(q['sql'] for q in queries if q['sql'].startswith('UPDATE "tests_'))
+        self.assertIn("'s2k-mode=1, compress-algo=0'", update)
+        self.assertIn("'cipher-algo=aes256'", update)
+        rotated = EncryptedOptionsModel.objects.get(pk=instance.pk)
+        self.assertEqual((rotated.text, rotated.integer), ('bonjour', 42))
+
+
+class TestRotateKeysFiles(TestCase):
+    """Test the keys kept by `pgcrypto_rotate_keys` for the encrypted files."""
+    previous_name = keys.PREVIOUS_KEYS_NAME.format(
+        'rotate:tests.encryptedattachmentmodel')
+
+    def setUp(self):
+        """Store the files in a temporary MEDIA_ROOT."""
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings = self.settings(MEDIA_ROOT=media_root + '/')
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(keys.get_staging_redis().delete, self.previous_name)
+
+        self.with_file = EncryptedAttachmentModel(text='with a file')
+        self.with_file.attachment.save('a.txt', ContentFile(b'content'))
+        self.without_file = EncryptedAttachmentModel.objects.create(text='without')
+
+    def test_previous_keys(self):
+        """Assert only the rows with files keep their previous key."""
+        old_key = keys.get_key(self.with_file.pk, use_cache=False)
+
+        call_command(
+            'pgcrypto_rotate_keys', 'tests.EncryptedAttachmentModel', stdout=StringIO())
+
+        self.assertEqual(
+            keys.fetch_staged_keys(self.previous_name),
+            {str(self.with_file.pk): old_key},
+        )
+
+    def test_reencrypt_files(self):
+        """Assert re-encrypting the files drops the previous key of every row."""
+        call_command(
+            'pgcrypto_rotate_keys', 'tests.EncryptedAttachmentModel', stdout=StringIO())
+        # A row whose file was removed after the rotation.
+        keys.stage_keys(self.previous_name, {self.without_file.pk: 'old key'})
+
+        call_command(
+            'pgcrypto_reencrypt_files', 'tests.EncryptedAttachmentModel',
+            rotation='tests.encryptedattachmentmodel', processes=1, stdout=StringIO())
+
+        self.assertEqual(keys.fetch_staged_keys(self.previous_name), {})
+        key = keys.get_key(self.with_file.pk, use_cache=False)
+        attachment = self.with_file.attachment
+        with attachment.storage.open(attachment.name, 'rb') as f:
+            content = Cryptographer.decrypted(key.encode('utf-8'), f.read())
+        self.assertEqual(content, b'content')
+
+
+class TestRotateKeysWorkers(TransactionTestCase):
+    """Test `pgcrypto_rotate_keys --workers`, whose threads need committed rows."""
+
+    def test_workers(self):
+        """Assert every chunk is rotated and the watermark reaches the last row."""
+        instances = EncryptedModelFactory.create_batch(6, fk_model=None)
+        old_keys = keys.fetch_keys([instance.pk for instance in instances])
+
+        call_command(
+            'pgcrypto_rotate_keys', 'tests.EncryptedModel', chunk_size=1, workers=2)
+
+        new_keys = keys.fetch_keys([instance.pk for instance in instances])
+        for instance in instances:
+            with self.subTest(instance=instance):
+                self.assertNotEqual(
+                    old_keys[str(instance.pk)], new_keys[str(instance.pk)])
+                rotated = EncryptedModel.objects.get(pk=instance.pk)
+                self.assertEqual(rotated.pgp_sym_field, instance.pgp_sym_field)
+
+        checkpoint = Checkpoint.objects.get(name='rotate:tests.encryptedmodel')
+        self.assertEqual(checkpoint.pending, [])
+        self.assertEqual(checkpoint.processed, 6)
+        self.assertEqual(
+            checkpoint.last_pk, str(max(instance.pk for instance in instances)))
+
+
+class TestReencryptFilesCommand(TestCase):
+    """Test the re-encryption done by `pgcrypto_reencrypt_files`."""
+
+    def test_reencrypt(self):
+        """Assert content moves from the old key to the new one."""
+        content = Cryptographer.encrypted(b'old', b'file content')
+
+        reencrypted = reencrypt(content, 'old', 'new', None, None)
+
+        self.assertEqual(Cryptographer.decrypted(b'new', reencrypted), b'file content')
+
+    def test_reencrypt_source_format(self):
+        """Assert files written with another salt are read with `--source-salt`."""
+        fernet = Cryptographer.fernet_generator(b'key', salt=b'old salt')
+        content = fernet.encrypt(b'data')
+
+        reencrypted = reencrypt(content, 'key', 'key', b'old salt', None)
+
+        self.assertEqual(Cryptographer.decrypted(b'key', reencrypted), b'data')
+
+    def test_reencrypt_already_done(self):
+        """Assert files re-encrypted by an interrupted run are skipped."""
+        content = Cryptographer.encrypted(b'new', b'file content')
+
+        self.assertIsNone(reencrypt(content, 'old', 'new', None, None))
+
+    def storage(self):
+        """Return a storage in a temporary directory holding `file.txt`."""
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        storage = FileSystemStorage(location=location)
+        storage.save('file.txt', ContentFile(b'old'))
+        return storage
+
+    def test_write(self):
+        """Assert the re-encrypted content is renamed over the file."""
+        storage = self.storage()
+
+        ReencryptFilesCommand.write(storage, 'file.txt', b'new')
+
+        self.assertEqual(storage.listdir('')[1], ['file.txt'])
+        with storage.open('file.txt') as f:
+            self.assertEqual(f.read(), b'new')
+
+    def test_write_remote(self):
+        """Assert storages without paths keep a copy until the file is written."""
+        storage = MemoryStorage({'file.txt': b'old'}, fail={'file.txt'})
+
+        with self.assertRaises(OSError):
+            ReencryptFilesCommand.write(storage, 'file.txt', b'new')
+
+        self.assertEqual(storage.files, {'file.reencrypted.txt': b'new'})
+
+    def test_write_remote_copy_deleted(self):
+        """Assert the copy is deleted once the file is written again."""
+        storage = MemoryStorage({'file.txt': b'old'})
+
+        ReencryptFilesCommand.write(storage, 'file.txt', b'new')
+
+        self.assertEqual(storage.files, {'file.txt': b'new'})
+
+
+class TestDumpDecryptedCommand(TestCase):
+    """Test `dumpdecrypted` exports the decrypted values."""
+
+    def test_jsonl(self):
+        """Assert one JSON document is written per row."""
+        instance = EncryptedModelFactory.create(fk_model=None)
+        out = StringIO()
+
+        call_command(
+            'dumpdecrypted', 'tests.EncryptedModel', stdout=out, stderr=StringIO())
+
+        row, = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(row['id'], str(instance.pk))
+        self.assertEqual(row['pgp_sym_field'], instance.pgp_sym_field)
+        self.assertEqual(row['integer_pgp_sym_field'], instance.integer_pgp_sym_field)
+
+    def test_csv(self):
+        """Assert the selected fields are written with a header."""
+        instance = EncryptedModelFactory.create(fk_model=None)
+        out = StringIO()
+
+        call_command(
+            'dumpdecrypted', 'tests.EncryptedModel', format='csv', in_database=True,
+            fields='id,pgp_sym_field,fk_model', stdout=out, stderr=StringIO(),
+        )
+
+        rows = list(csv.reader(StringIO(out.getvalue())))
+        self.assertEqual(rows, [
+            ['id', 'pgp_sym_field', 'fk_model_id'],
+            [str(instance.pk), instance.pgp_sym_field, ''],
+        ])
+
+
+class TestSyncLocalKeysCommand(TestCase):
+    """Test `pgcrypto_sync_local_keys` and `PGCRYPTO_LOCAL_KEYS`."""
+
+    def test_sync(self):
+        """Assert the keys are copied and used to decrypt."""
+        instances = EncryptedModelFactory.create_batch(3, fk_model=None)
+
+        call_command('pgcrypto_sync_local_keys', batch_size=2, stdout=StringIO())
+
+        stored = keys.fetch_keys([instance.pk for instance in instances])
+        local = dict(LocalKey.objects.filter(pk__in=stored).values_list('id', 'key'))
+        self.assertEqual(local, stored)
+
+        with self.settings(PGCRYPTO_LOCAL_KEYS=True):
+            with CaptureQueriesContext(connection) as queries:
+                loaded = EncryptedModel.objects.get(pk=instances[0].pk)
+        self.assertIn('pgcrypto_row_key(', queries.captured_queries[0]['sql'])
+        self.assertNotIn('key_store', queries.captured_queries[0]['sql'])
+        self.assertEqual(loaded.pgp_sym_field, instances[0].pgp_sym_field)
+
+    def test_write_through(self):
+        """Assert new keys are copied when `PGCRYPTO_LOCAL_KEYS` is set."""
+        with self.settings(PGCRYPTO_LOCAL_KEYS=True):
+            instance = EncryptedModelFactory.create(fk_model=None)
+
+        key_id = str(instance.pk)
+        self.assertEqual(
+            LocalKey.objects.get(pk=key_id).key, keys.fetch_keys([key_id])[key_id])
@@ -0,0 +1,20 @@
+from django.test import SimpleTestCase
+
+from pgcrypto import constants
+
+
+class TestConstants(SimpleTestCase):
+    """Test the `DEFF_*` settings of `pgcrypto.constants`."""
+
+    def test_former_constants(self):
+        """Assert the former module constants are resolved from the settings."""
+        with self.settings(DEFF_FETCH_URL_NAME='fetch'):
+            from pgcrypto.constants import FETCH_URL_NAME
+
+            self.assertEqual(FETCH_URL_NAME, 'fetch')
+            self.assertEqual(constants.FETCH_URL_NAME, 'fetch')
+
+    def test_unknown_constant(self):
+        """Assert other names are still missing."""
+        with self.assertRaises(AttributeError):
+            constants.UNKNOWN
@@ -0,0 +1,65 @@
+from django.db import connection
+from django.db.models import Count
+from django.test import TestCase
+
+from pgcrypto import explain
+from .factories import EncryptedModelFactory
+from .models import EncryptedModel
+
+
+def sql_of(queryset):
+    """Return the SQL of `queryset`."""
+    return queryset.query.get_compiler(queryset.db).as_sql()[0]
+
+
+class TestDecryptedClauses(TestCase):
+    """Test the detection of decrypted columns per clause."""
+
+    def test_select_only(self):
+        """Assert decrypting in the select list alone is fine."""
+        queryset = EncryptedModel.objects.filter(pk__isnull=False).order_by('pk')
+        self.assertEqual(explain.decrypted_clauses(sql_of(queryset)), [])
+
+    def test_where(self):
+        """Assert a filter on an encrypted field is detected."""
+        queryset = EncryptedModel.objects.filter(pgp_sym_field='value')
+        self.assertEqual(explain.decrypted_clauses(sql_of(queryset)), ['WHERE'])
+
+    def test_order_by(self):
+        """Assert ordering by an encrypted field is detected."""
+        queryset = EncryptedModel.objects.order_by('date_pgp_sym_field')
+        self.assertEqual(explain.decrypted_clauses(sql_of(queryset)), ['ORDER BY'])
+
+    def test_group_by(self):
+        """Assert grouping by an encrypted field is detected."""
+        queryset = EncryptedModel.objects.values('pgp_sym_field').annotate(n=Count('id'))
+        self.assertEqual(explain.decrypted_clauses(sql_of(queryset)), ['GROUP BY'])
+
+    def test_distinct_on(self):
+        """Assert `distinct()` on an encrypted field is detected."""
+        queryset = EncryptedModel.objects.order_by(
+            'pgp_sym_field').distinct('pgp_sym_field')
+        self.assertEqual(
+            explain.decrypted_clauses(sql_of(queryset)), ['DISTINCT ON', 'ORDER BY'])
+
+
+class TestDecryptedScanChecker(TestCase):
+    """Test the `EXPLAIN` based checks."""
+
+    def test_check_queryset(self):
+        """Assert the scan of a filtered encrypted field is reported."""
+        EncryptedModelFactory.create_batch(3)
+        queryset = EncryptedModel.objects.filter(pgp_sym_field='value')
+
+        scan = explain.check_queryset(queryset)
+
+        self.assertEqual(scan.clauses, ['WHERE'])
+        self.assertGreater(scan.rows, 0)
+        self.assertIsNone(explain.check_queryset(queryset, threshold=10 ** 9))
+
+    def test_raise(self):
+        """Assert the checker refuses to run a reported query."""
+        checker = explain.DecryptedScanChecker(connection, 'raise', 0)
+        with connection.execute_wrapper(checker):
+            with self.assertRaises(explain.DecryptedScanError):
+                list(EncryptedModel.objects.filter(pgp_sym_field='value'))
@@ -4,16 +4,25 @@ from unittest.mock import MagicMock
 
 from django import VERSION as DJANGO_VERSION
 from django.conf import settings
-from django.db import models, reset_queries
+from django.core.exceptions import ImproperlyConfigured
+from django.db import (
+    connection,
+    connections,
+    DataError,
+    InternalError,
+    models,
+    reset_queries,
+)
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from incuna_test_utils.utils import field_names
 
-from pgcrypto import fields
+from pgcrypto import fields, keys
 from .diff_keys.models import EncryptedDiff
 from .factories import EncryptedFKModelFactory, EncryptedModelFactory
 from .forms import EncryptedForm
-from .models import EncryptedDateTime, EncryptedFKModel, \
-    EncryptedModel, RelatedDateTime
+from .models import EncryptedAESModel, EncryptedDateTime, EncryptedFKModel, \
+    EncryptedModel, EncryptedOptionsModel, RelatedDateTime
 
 PGP_FIELDS = (
     fields.EmailPGPSymmetricKeyField,
@@ -730,3 +739,142 @@ class TestEncryptedTextFieldModel(TestCase):
         )
 
 
+class TestKeyDatabases(TestCase):
+    """Test keys are read from the database of the rows."""
+    multi_db = True
+
+    def setUp(self):
+        """Start with empty key caches."""
+        keys.clear_caches()
+
+    def key_store_queries(self, queries):
+        """Return the captured queries reading the `key_store`."""
+        return [
+            query for query in queries.captured_queries if 'key_store' in query['sql']]
+
+    def test_routed_model(self):
+        """Assert the key of a routed row is read and cached on its database."""
+        with CaptureQueriesContext(connections['default']) as default:
+            with CaptureQueriesContext(connections['diff_keys']) as diff_keys:
+                instance = EncryptedDiff.objects.create(sym_field='a')
+
+        self.assertEqual(self.key_store_queries(default), [])
+        self.assertTrue(self.key_store_queries(diff_keys))
+        self.assertIn(str(instance.pk), keys.get_cache('diff_keys'))
+        self.assertNotIn(str(instance.pk), keys.cache)
+        self.assertEqual(EncryptedDiff.objects.get().sym_field, 'a')
+
+    def test_read_database(self):
+        """Assert `PGCRYPTO_KEY_READ_DATABASE` sends the key reads to another database."""
+        instance = EncryptedModelFactory.create()
+        keys.clear_caches()
+
+        with self.settings(PGCRYPTO_KEY_READ_DATABASE='diff_keys'):
+            with CaptureQueriesContext(connections['diff_keys']) as diff_keys:
+                key = keys.get_key(instance.pk, create=False)
+
+        self.assertEqual(len(self.key_store_queries(diff_keys)), 1)
+        self.assertEqual(key, keys.fetch_keys([instance.pk])[str(instance.pk)])
+
+
+class TestPGPOptions(TestCase):
+    """Test pgcrypto options are passed to encryption and decryption."""
+
+    def test_encrypt_sql(self):
+        """Assert options are added to `pgp_sym_encrypt`."""
+        field = EncryptedOptionsModel._meta.get_field('integer')
+        self.assertEqual(
+            field.get_encrypt_sql('key', connection),
+            "pgp_sym_encrypt(nullif(%s, NULL)::text, 'key', 'cipher-algo=aes256')",
+        )
+
+    def test_decrypt_sql(self):
+        """Assert options are added to `pgp_sym_decrypt`."""
+        field = EncryptedOptionsModel._meta.get_field('text')
+        self.assertIn(
+            ", 's2k-mode=1, compress-algo=0')::%s", field.get_decrypt_sql(connection))
+
+    def test_default_options(self):
+        """Assert `PGCRYPTO_SYM_OPTIONS` is the default."""
+        field = fields.TextPGPSymmetricKeyField()
+        self.assertEqual(
+            field.get_encrypt_sql('key', connection), "pgp_sym_encrypt(%s, 'key')")
+        with self.settings(PGCRYPTO_SYM_OPTIONS='compress-algo=0'):
+            self.assertEqual(
+                field.get_encrypt_sql('key', connection),
+                "pgp_sym_encrypt(%s, 'key', 'compress-algo=0')",
+            )
+
+    def test_invalid_options(self):
+        """Assert options are validated before they reach the SQL."""
+        field = fields.TextPGPSymmetricKeyField(options="x'); drop table x; --")
+        with self.assertRaises(ImproperlyConfigured):
+            field.get_encrypt_sql('key', connection)
+
+    def test_deconstruct(self):
+        """Assert options are part of the migrations."""
+        field = EncryptedOptionsModel._meta.get_field('text')
+        self.assertEqual(field.deconstruct()[3]['options'], 's2k-mode=1, compress-algo=0')
+
+    def test_round_trip(self):
+        """Assert values encrypted with options are decrypted."""
+        instance = EncryptedOptionsModel.objects.create(text='bonjour', integer=42)
+        instance = EncryptedOptionsModel.objects.get(pk=instance.pk)
+
+        self.assertEqual(instance.text, 'bonjour')
+        self.assertEqual(instance.integer, 42)
+
+
+class TestAESFields(TestCase):
+    """Test the fields encrypted with `pgcrypto_aes_encrypt`."""
+
+    def test_round_trip(self):
+        """Assert values are decrypted to their python type."""
+        instance = EncryptedAESModel.objects.create(
+            text='bonjour', integer=42, date=date(2016, 9, 1), decimal=Decimal('12.34'))
+        instance = EncryptedAESModel.objects.get(pk=instance.pk)
+
+        self.assertEqual(instance.text, 'bonjour')
+        self.assertEqual(instance.integer, 42)
+        self.assertEqual(instance.date, date(2016, 9, 1))
+        self.assertEqual(instance.decimal, Decimal('12.34'))
+
+    def test_null(self):
+        """Assert `None` is stored as NULL."""
+        instance = EncryptedAESModel.objects.create()
+        instance = EncryptedAESModel.objects.get(pk=instance.pk)
+
+        self.assertIsNone(instance.text)
+        self.assertIsNone(instance.integer)
+
+    def test_filter(self):
+        """Assert lookups compare the decrypted values."""
+        expected = EncryptedAESModel.objects.create(integer=2)
+        EncryptedAESModel.objects.create(integer=1)
+
+        self.assertEqual(
+            list(EncryptedAESModel.objects.filter(integer__gt=1)), [expected])
+
+    def test_smaller_than_pgp(self):
+        """Assert the ciphertext has a fixed 48 byte overhead over the padded value."""
+        instance = EncryptedAESModel.objects.create(text='bonjour')
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT length(text) FROM tests_encryptedaesmodel WHERE id = %s',
+                [instance.pk],
+            )
+            self.assertEqual(cursor.fetchone()[0], 48)
+
+    def test_tampered(self):
+        """Assert a modified ciphertext fails to decrypt instead of returning garbage."""
+        instance = EncryptedAESModel.objects.create(text='bonjour')
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE tests_encryptedaesmodel "
+                "SET text = overlay(text placing '\\x00'::bytea from 20 for 1) "
+                "WHERE id = %s",
+                [instance.pk],
+            )
+
+        with self.assertRaises((DataError, InternalError)):
+            EncryptedAESModel.objects.get(pk=instance.pk).text
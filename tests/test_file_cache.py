@@ -0,0 +1,141 @@
+import os
+import shutil
+import tempfile
+import time
+
+from django.test import override_settings, SimpleTestCase
+
+from pgcrypto import file_cache, instrumentation, keys
+
+
+class TestMemoryTier(SimpleTestCase):
+    """Test `pgcrypto.file_cache.MemoryTier`."""
+
+    def test_lru(self):
+        """Assert the least recently used files are dropped over the size limit."""
+        tier = file_cache.MemoryTier(10)
+        tier.set('1', 'a', 'v1', b'aaaa')
+        tier.set('2', 'b', 'v1', b'bbbb')
+        tier.get('1', 'a', 'v1')
+
+        tier.set('3', 'c', 'v1', b'cccc')
+
+        self.assertEqual(tier.get('1', 'a', 'v1'), b'aaaa')
+        self.assertIsNone(tier.get('2', 'b', 'v1'))
+        self.assertEqual(tier.size, 8)
+
+    def test_version(self):
+        """Assert a new version of a file replaces the cached one."""
+        tier = file_cache.MemoryTier(100)
+        tier.set('1', 'a', 'v1', b'old')
+
+        tier.set('1', 'a', 'v2', b'new')
+
+        self.assertIsNone(tier.get('1', 'a', 'v1'))
+        self.assertEqual(tier.get('1', 'a', 'v2'), b'new')
+        self.assertEqual(tier.size, 3)
+
+    def test_evict(self):
+        """Assert the files of evicted keys are dropped."""
+        tier = file_cache.MemoryTier(100)
+        tier.set('1', 'a', 'v1', b'aaaa')
+        tier.set('2', 'b', 'v1', b'bbbb')
+
+        tier.evict({'1'})
+
+        self.assertIsNone(tier.get('1', 'a', 'v1'))
+        self.assertEqual(tier.get('2', 'b', 'v1'), b'bbbb')
+
+
+class TestDirectoryTier(SimpleTestCase):
+    """Test `pgcrypto.file_cache.DirectoryTier`."""
+
+    def setUp(self):
+        """Use a temporary directory."""
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_size_limit(self):
+        """Assert the least recently used files are removed over the size limit."""
+        tier = file_cache.DirectoryTier(self.directory, 10)
+        tier.set('1', 'a', 'v1', b'aaaa')
+        tier.set('2', 'b', 'v1', b'bbbb')
+        old = time.time() - 60
+        for name in os.listdir(self.directory):
+            os.utime(os.path.join(self.directory, name), (old, old))
+        tier.get('1', 'a', 'v1')
+
+        tier.set('3', 'c', 'v1', b'cccc')
+
+        self.assertEqual(tier.get('1', 'a', 'v1'), b'aaaa')
+        self.assertIsNone(tier.get('2', 'b', 'v1'))
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+    def test_shared(self):
+        """Assert processes sharing the directory evict each other's files."""
+        tier = file_cache.DirectoryTier(self.directory, 100)
+        tier.set('1', 'a', 'v1', b'aaaa')
+        tier.set('1', 'b', 'v1', b'bbbb')
+
+        other = file_cache.DirectoryTier(self.directory, 100)
+        other.set('1', 'a', 'v2', b'new')
+        self.assertIsNone(tier.get('1', 'a', 'v1'))
+        self.assertEqual(tier.get('1', 'a', 'v2'), b'new')
+
+        other.evict({'1'})
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_other_files(self):
+        """Assert only the cached files are removed from the directory."""
+        with open(os.path.join(self.directory, 'other'), 'wb') as f:
+            f.write(bytes(100))
+        tier = file_cache.DirectoryTier(self.directory, 10)
+        tier.set('1', 'a', 'v1', b'aaaa')
+
+        tier.clear()
+
+        self.assertEqual(os.listdir(self.directory), ['other'])
+
+
+class TestFileCache(SimpleTestCase):
+    """Test the tiers of `pgcrypto.file_cache.FileCache`."""
+
+    def test_disabled(self):
+        """Assert the cache is off by default."""
+        self.assertIsNone(file_cache.get_cache())
+
+    @override_settings(PGCRYPTO_FILE_CACHE_BYTES=100)
+    def test_max_file_bytes(self):
+        """Assert files bigger than the limit aren't cached."""
+        cache = file_cache.get_cache()
+
+        cache.set('1', 'a', 'v1', b'x' * 20)
+
+        self.assertIsNone(cache.get('1', 'a', 'v1'))
+
+    def test_directory_tier(self):
+        """Assert files found in the directory are brought back in memory."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with self.settings(
+                PGCRYPTO_FILE_CACHE_BYTES=100, PGCRYPTO_FILE_CACHE_DIR=directory):
+            cache = file_cache.get_cache()
+            cache.set('1', 'a', 'v1', b'content')
+            cache.tiers[0].clear()
+
+            with instrumentation.collect() as metrics:
+                self.assertEqual(cache.get('1', 'a', 'v1'), b'content')
+                self.assertEqual(cache.get('1', 'a', 'v1'), b'content')
+
+            self.assertEqual(metrics[instrumentation.FILE_CACHE_HITS], 2)
+            self.assertEqual(cache.tiers[0].size, len(b'content'))
+
+    @override_settings(PGCRYPTO_FILE_CACHE_BYTES=100)
+    def test_shredded_keys(self):
+        """Assert the files of the keys evicted from the key caches are dropped."""
+        cache = file_cache.get_cache()
+        cache.set('1', 'a', 'v1', b'content')
+
+        keys.evict(['1'])
+
+        self.assertIsNone(cache.get('1', 'a', 'v1'))
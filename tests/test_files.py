@@ -0,0 +1,236 @@
+import shutil
+import tempfile
+import zipfile
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.http import Http404
+from django.test import RequestFactory, TestCase
+from PIL import Image
+
+from pgcrypto import fields, instrumentation, keys
+from pgcrypto.crypt import Cryptographer
+from pgcrypto.managers import prefetch_object_keys
+from pgcrypto.views import archive_query, ArchiveView, FetchView
+from .models import EncryptedFileModel, EncryptedImageModel
+
+
+def png(width, height):
+    """Return a PNG image of `width` x `height` pixels."""
+    output = BytesIO()
+    Image.new('RGB', (width, height), 'red').save(output, format='PNG')
+    return output.getvalue()
+
+
+class TestEncryptedImages(TestCase):
+    """Test `EncryptedImageField` dimensions and variants."""
+
+    def setUp(self):
+        """Store the files in a temporary MEDIA_ROOT."""
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings = self.settings(MEDIA_ROOT=media_root + '/', MEDIA_URL='/media/')
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.instance = EncryptedImageModel()
+        self.instance.image.save('photo.png', ContentFile(png(200, 100)))
+
+    def decrypted(self, name):
+        """Return the plaintext of the stored file `name`."""
+        key = keys.get_key(self.instance.pk, use_cache=False)
+        with self.instance.image.storage.open(name, 'rb') as f:
+            return Cryptographer.decrypted(key.encode('utf-8'), f.read())
+
+    def test_dimensions(self):
+        """Assert the dimensions are read from the plaintext."""
+        instance = EncryptedImageModel.objects.get(pk=self.instance.pk)
+
+        self.assertEqual((instance.width, instance.height), (200, 100))
+        self.assertEqual((instance.image.width, instance.image.height), (200, 100))
+
+    def test_variants(self):
+        """Assert the variants are resized and encrypted with the row key."""
+        name = fields.variant_name(self.instance.image.name, 'thumb')
+
+        variant = Image.open(BytesIO(self.decrypted(name)))
+
+        self.assertEqual(variant.size, (32, 16))
+        self.assertEqual(variant.format, 'PNG')
+
+    def test_delete(self):
+        """Assert the variants are deleted with the image."""
+        name = fields.variant_name(self.instance.image.name, 'thumb')
+
+        self.instance.image.delete()
+
+        self.assertFalse(self.instance.image.storage.exists(name))
+
+    def test_fetch_variant(self):
+        """Assert `FetchView` serves the decrypted variant."""
+        request = RequestFactory().get(
+            '/', {'id': str(self.instance.pk), 'variant': 'thumb'})
+
+        response = FetchView.as_view()(request, path='/media/' + self.instance.image.name)
+
+        self.assertEqual(Image.open(BytesIO(response.content)).size, (32, 16))
+
+    def test_fetch_invalid_variant(self):
+        """Assert variant names can't escape the image's directory."""
+        request = RequestFactory().get(
+            '/', {'id': str(self.instance.pk), 'variant': '../secret'})
+
+        with self.assertRaises(Http404):
+            FetchView.as_view()(request, path='/media/' + self.instance.image.name)
+
+    def test_variant_name(self):
+        """Assert variants are stored next to the image."""
+        self.assertEqual(
+            fields.variant_name('images/a.png', 'thumb'), 'images/a~thumb.png')
+
+    def test_variant_other_upload(self):
+        """Assert a variant can't replace an upload named like it."""
+        other = EncryptedImageModel()
+        other.image.save('picture.thumb.png', ContentFile(png(10, 10)))
+        with other.image.storage.open(other.image.name, 'rb') as f:
+            content = f.read()
+
+        EncryptedImageModel().image.save('picture.png', ContentFile(png(200, 100)))
+
+        with other.image.storage.open(other.image.name, 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_invalid_variant_names(self):
+        """Assert variant names must be usable in file names and URLs."""
+        with self.assertRaises(ValueError):
+            fields.EncryptedImageField(variants={'a/b': (10, 10)})
+
+
+class TestFetchView(TestCase):
+    """Test the conditional requests and the file cache of `FetchView`."""
+
+    def setUp(self):
+        """Store a file in a temporary MEDIA_ROOT."""
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings = self.settings(MEDIA_ROOT=media_root + '/', MEDIA_URL='/media/')
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.instance = EncryptedFileModel()
+        self.instance.attachment.save('doc.txt', ContentFile(b'content'))
+
+    def fetch(self, **headers):
+        """Return the response of `FetchView` for the file."""
+        request = RequestFactory().get('/', {'id': str(self.instance.pk)}, **headers)
+        path = '/media/' + self.instance.attachment.name
+        return FetchView.as_view()(request, path=path)
+
+    def test_not_modified(self):
+        """Assert a request with the ETag of the file gets a 304."""
+        etag = self.fetch()['ETag']
+
+        response = self.fetch(HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_replaced_file(self):
+        """Assert a replaced file gets a new ETag."""
+        etag = self.fetch()['ETag']
+        name = self.instance.attachment.name
+        self.instance.attachment.storage.delete(name)
+        self.instance.attachment.save('doc.txt', ContentFile(b'new content'))
+        self.assertEqual(self.instance.attachment.name, name)
+
+        response = self.fetch(HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'new content')
+
+    def test_cache(self):
+        """Assert the decrypted file is served from the cache."""
+        with self.settings(PGCRYPTO_FILE_CACHE_BYTES=2 ** 20):
+            with instrumentation.collect() as metrics:
+                self.assertEqual(self.fetch().content, b'content')
+                self.assertEqual(self.fetch().content, b'content')
+
+        self.assertEqual(metrics[instrumentation.FILE_CACHE_MISSES], 1)
+        self.assertEqual(metrics[instrumentation.FILE_CACHE_HITS], 1)
+
+
+class TestArchiveView(TestCase):
+    """Test the ZIP archives streamed by `ArchiveView`."""
+
+    def setUp(self):
+        """Store files with different keys in a temporary MEDIA_ROOT."""
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings = self.settings(MEDIA_ROOT=media_root + '/', MEDIA_URL='/media/')
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.instances = []
+        for index in range(5):
+            instance = EncryptedFileModel()
+            instance.attachment.save('doc.txt', ContentFile(b'content %d' % index))
+            self.instances.append(instance)
+
+    def archive(self, query):
+        """Return the response of `ArchiveView` for `query`."""
+        return ArchiveView.as_view(workers=2)(RequestFactory().get('/?' + query))
+
+    def test_archive(self):
+        """Assert the files are decrypted in request order, their keys fetched at once."""
+        query = archive_query([instance.attachment for instance in self.instances])
+
+        with instrumentation.collect() as metrics:
+            response = self.archive(query)
+            archive = zipfile.ZipFile(BytesIO(b''.join(response.streaming_content)))
+
+        self.assertEqual(metrics[instrumentation.KEY_STORE_QUERIES], 0)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        self.assertEqual(
+            [archive.read(info) for info in archive.infolist()],
+            [b'content %d' % index for index in range(5)],
+        )
+        self.assertEqual(archive.namelist()[0], 'doc.txt')
+
+    def test_prefetched_keys(self):
+        """Assert the files are served and saved with the keys of `prefetch_keys()`."""
+        keys.clear_caches()
+        prefetch_object_keys(self.instances)
+        query = archive_query([instance.attachment for instance in self.instances])
+        path = '/media/' + self.instances[0].attachment.name
+
+        with instrumentation.collect() as metrics:
+            response = self.archive(query)
+            b''.join(response.streaming_content)
+            request = RequestFactory().get('/', {'id': str(self.instances[0].pk)})
+            fetched = FetchView.as_view()(request, path=path)
+            self.assertEqual(fetched.content, b'content 0')
+            self.instances[1].attachment.save('doc.txt', ContentFile(b'new content'))
+
+        self.assertEqual(metrics[instrumentation.REDIS_CALLS], 0)
+        self.assertEqual(metrics[instrumentation.KEY_STORE_QUERIES], 0)
+
+    def test_missing_key(self):
+        """Assert the archive is refused when a key is missing."""
+        keys.delete_keys([self.instances[0].pk])
+        query = archive_query([instance.attachment for instance in self.instances])
+
+        with self.assertRaises(Http404):
+            self.archive(query)
+
+    def test_archive_names(self):
+        """Assert files with the same name are numbered."""
+        names = ArchiveView.archive_names(
+            ['/media/a/doc.txt', '/media/b/doc.txt', 'https://cdn/doc.txt?x=1'])
+
+        self.assertEqual(names, ['doc.txt', 'doc (2).txt', 'doc (3).txt'])
+
+    def test_unpaired_parameters(self):
+        """Assert every `id` needs a `path`."""
+        with self.assertRaises(Http404):
+            self.archive('id={}'.format(self.instances[0].pk))
@@ -0,0 +1,63 @@
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase
+
+from pgcrypto import instrumentation
+from pgcrypto.crypt import Cryptographer
+from .factories import EncryptedModelFactory
+from .models import EncryptedModel
+
+
+class TestInstrumentation(TestCase):
+    """Test the metrics recorded by pgcrypto."""
+
+    def test_decrypted_columns(self):
+        """Assert decrypted columns and decrypting queries are counted."""
+        EncryptedModelFactory.create()
+
+        with instrumentation.collect() as metrics:
+            list(EncryptedModel.objects.all())
+
+        self.assertEqual(metrics[instrumentation.DECRYPTED_COLUMNS], 8)
+        self.assertEqual(metrics[instrumentation.DECRYPT_QUERIES], 1)
+        self.assertGreater(metrics[instrumentation.DECRYPT_QUERY_TIME], 0)
+
+    def test_key_cache(self):
+        """Assert key cache hits are counted on update."""
+        instance = EncryptedModelFactory.create()
+
+        with instrumentation.collect() as metrics:
+            instance.pgp_sym_field = 'updated'
+            instance.save()
+
+        self.assertGreater(metrics[instrumentation.KEY_CACHE_HITS], 0)
+        self.assertEqual(metrics[instrumentation.KEY_CACHE_MISSES], 0)
+
+    def test_decrypted_bytes(self):
+        """Assert python side decryption is measured."""
+        content = Cryptographer.encrypted(b'password', b'content')
+
+        with instrumentation.collect() as metrics:
+            Cryptographer.decrypted(b'password', content)
+
+        self.assertEqual(metrics[instrumentation.DECRYPTED_BYTES], len(b'content'))
+
+    def test_assert_max_metrics(self):
+        """Assert exceeding a limit fails."""
+        with self.assertRaises(AssertionError):
+            with instrumentation.assert_max_metrics(decrypted_columns=0):
+                instrumentation.record(instrumentation.DECRYPTED_COLUMNS)
+
+        with instrumentation.assert_max_metrics(decrypted_columns=1):
+            instrumentation.record(instrumentation.DECRYPTED_COLUMNS)
+
+    def test_server_timing_middleware(self):
+        """Assert the metrics of a request are added to `Server-Timing`."""
+        def view(request):
+            instrumentation.record(instrumentation.DECRYPTED_COLUMNS, 3)
+            return HttpResponse()
+
+        middleware = instrumentation.ServerTimingMiddleware(view)
+        response = middleware(RequestFactory().get('/'))
+
+        self.assertIn('pgcrypto-db;', response['Server-Timing'])
+        self.assertIn('3 columns', response['Server-Timing'])
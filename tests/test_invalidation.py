@@ -0,0 +1,100 @@
+import time
+import uuid
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import override_settings, SimpleTestCase
+
+from pgcrypto import invalidation, keys
+
+
+def wait_for(condition, timeout=2):
+    """Poll `condition` until it is true or `timeout` seconds passed."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class TestInvalidation(SimpleTestCase):
+    """Test keys are evicted from the cache when they change in redis."""
+
+    def setUp(self):
+        """Start with empty key caches."""
+        keys.clear_caches()
+
+    def tearDown(self):
+        """Stop listening."""
+        invalidation.stop()
+        keys.clear_caches()
+
+    def listen(self, mode):
+        """Start listening for `mode` invalidations."""
+        listener = invalidation.get_listener(mode)
+        self.assertTrue(listener.connected.wait(5))
+        return listener
+
+    def cache_new_key(self):
+        """Create a key and wait for it to be cached."""
+        key_id = str(uuid.uuid4())
+        keys.create_key(key_id)
+        # The creation itself is an invalidation in the tracking mode.
+        self.assertTrue(
+            wait_for(lambda: keys.get_keys([key_id]) and key_id in keys.cache))
+        return key_id
+
+    @override_settings(PGCRYPTO_KEY_CACHE_INVALIDATION='pubsub')
+    def test_pubsub(self):
+        """Assert the published ids are evicted."""
+        self.listen('pubsub')
+        key_id = self.cache_new_key()
+
+        # Another process rotates the key.
+        keys.get_redis().publish(invalidation.INVALIDATION_CHANNEL, key_id)
+
+        self.assertTrue(wait_for(lambda: key_id not in keys.cache))
+
+    @override_settings(PGCRYPTO_KEY_CACHE_INVALIDATION='tracking')
+    def test_tracking(self):
+        """Assert keys written by any client are evicted."""
+        self.listen('tracking')
+        key_id = self.cache_new_key()
+
+        keys.get_redis().set(key_id, keys.generate_key())
+
+        self.assertTrue(wait_for(lambda: key_id not in keys.cache))
+
+    @override_settings(PGCRYPTO_KEY_CACHE_INVALIDATION='pubsub')
+    def test_delete_keys(self):
+        """Assert shredded keys are gone from redis and the caches."""
+        self.listen('pubsub')
+        key_id = self.cache_new_key()
+
+        keys.delete_keys([key_id])
+
+        self.assertNotIn(key_id, keys.cache)
+        self.assertEqual(keys.get_keys([key_id]), {})
+
+    @override_settings(PGCRYPTO_KEY_CACHE_INVALIDATION='pubsub')
+    def test_disconnected(self):
+        """Assert nothing is cached while invalidations could be missed."""
+        listener = self.listen('pubsub')
+        listener.connected.clear()
+
+        self.assertIsNone(invalidation.start_read())
+
+    def test_stale_read(self):
+        """Assert a key read before an invalidation isn't cached."""
+        token = invalidation.start_read()
+        invalidation.invalidate(['stale'])
+
+        keys.cache_keys({'stale': 'key'}, token)
+
+        self.assertNotIn('stale', keys.cache)
+
+    @override_settings(PGCRYPTO_KEY_CACHE_INVALIDATION='always')
+    def test_unknown_mode(self):
+        """Assert the setting is checked."""
+        with self.assertRaises(ImproperlyConfigured):
+            invalidation.start_read()
@@ -0,0 +1,357 @@
+from datetime import date, time
+from decimal import Decimal
+
+from django.db import connection
+from django.db.models import Count, F, Prefetch
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from pgcrypto import instrumentation, keys
+from .factories import EncryptedModelFactory
+from .models import EncryptedAESModel, EncryptedFKModel, EncryptedModel
+
+
+class TestDecryptInPython(TestCase):
+    """Test `PGPQuerySet.decrypt_in_python`."""
+
+    def setUp(self):
+        """Start with an empty key cache."""
+        keys.cache.clear()
+
+    def test_values(self):
+        """Assert every field type matches the values decrypted in SQL."""
+        instance = EncryptedModelFactory.create(
+            time_pgp_sym_field=time(10, 30),
+            decimal_pgp_sym_field=Decimal('123.45'),
+            float_pgp_sym_field=1.5,
+        )
+        in_sql = EncryptedModel.objects.get(pk=instance.pk)
+
+        in_python = EncryptedModel.objects.decrypt_in_python().get(pk=instance.pk)
+
+        for field in EncryptedModel._meta.concrete_fields:
+            with self.subTest(field=field.name):
+                self.assertEqual(
+                    getattr(in_python, field.attname), getattr(in_sql, field.attname))
+
+    def test_aes(self):
+        """Assert AES fields are decrypted in python."""
+        instance = EncryptedAESModel.objects.create(
+            text='bonjour', integer=42, date=date(2016, 9, 1), decimal=Decimal('1.20'))
+
+        instance = EncryptedAESModel.objects.decrypt_in_python().get(pk=instance.pk)
+
+        self.assertEqual(instance.text, 'bonjour')
+        self.assertEqual(instance.integer, 42)
+        self.assertEqual(instance.date, date(2016, 9, 1))
+        self.assertEqual(instance.decimal, Decimal('1.20'))
+
+    def test_no_decryption_in_sql(self):
+        """Assert the queried model's columns are not decrypted by the database."""
+        EncryptedModelFactory.create_batch(3, fk_model=None)
+
+        with instrumentation.collect() as metrics:
+            instances = list(EncryptedModel.objects.decrypt_in_python())
+
+        self.assertEqual(len(instances), 3)
+        self.assertEqual(metrics[instrumentation.DECRYPT_QUERIES], 0)
+        self.assertGreater(metrics[instrumentation.PYTHON_DECRYPTED_VALUES], 0)
+
+    def test_filter_in_sql(self):
+        """Assert conditions still compare the values decrypted in SQL."""
+        expected = EncryptedModelFactory.create(pgp_sym_field='find me')
+        EncryptedModelFactory.create(pgp_sym_field='not me')
+
+        queryset = EncryptedModel.objects.decrypt_in_python().filter(
+            pgp_sym_field='find me')
+
+        self.assertEqual([instance.pgp_sym_field for instance in queryset], ['find me'])
+        self.assertEqual(queryset.get().pk, expected.pk)
+
+    def test_workers(self):
+        """Assert the thread pool returns the values in row order."""
+        EncryptedModelFactory.create_batch(5)
+        expected = list(EncryptedModel.objects.order_by('pk').values_list(
+            'pgp_sym_field', flat=True))
+
+        queryset = EncryptedModel.objects.decrypt_in_python(workers=2).order_by('pk')
+
+        self.assertEqual(
+            [instance.pgp_sym_field for instance in queryset.iterator()], expected)
+
+    def test_related_and_deferred(self):
+        """Assert `select_related` and deferred fields keep working."""
+        instance = EncryptedModelFactory.create()
+
+        loaded = EncryptedModel.objects.decrypt_in_python().select_related(
+            'fk_model').defer('email_pgp_sym_field').get(pk=instance.pk)
+
+        self.assertEqual(
+            loaded.fk_model.fk_pgp_sym_field, instance.fk_model.fk_pgp_sym_field)
+        self.assertEqual(loaded.email_pgp_sym_field, instance.email_pgp_sym_field)
+
+    def test_setting(self):
+        """Assert `PGCRYPTO_DECRYPT_IN_PYTHON` makes it the default."""
+        with self.settings(PGCRYPTO_DECRYPT_IN_PYTHON=True):
+            queryset = EncryptedModel.objects.all()
+
+        self.assertEqual(queryset._iterable_class.__name__, 'PythonDecryptingIterable')
+
+
+class TestDecryptOnce(TestCase):
+    """Test the lateral projection of columns decrypted several times."""
+
+    def test_filter_and_order(self):
+        """Assert a column filtered, sorted and selected is decrypted once."""
+        for name in ('Peter', 'Paul', 'Jessica'):
+            EncryptedModelFactory.create(pgp_sym_field=name, fk_model=None)
+        queryset = EncryptedModel.objects.filter(
+            pgp_sym_field__startswith='P').order_by('pgp_sym_field')
+
+        with CaptureQueriesContext(connection) as queries:
+            names = [instance.pgp_sym_field for instance in queryset]
+
+        self.assertEqual(names, ['Paul', 'Peter'])
+        sql = queries.captured_queries[0]['sql']
+        self.assertIn('LATERAL', sql)
+        self.assertEqual(sql.count('pgp_sym_decrypt('), 8)
+
+    def test_annotate_and_group(self):
+        """Assert grouping by primary key still allows the decrypted columns."""
+        instance = EncryptedModelFactory.create(pgp_sym_field='Paul')
+
+        loaded = EncryptedModel.objects.annotate(
+            n=Count('fk_model'), name=F('pgp_sym_field'),
+        ).get(pgp_sym_field='Paul')
+
+        self.assertEqual(loaded.pk, instance.pk)
+        self.assertEqual((loaded.name, loaded.n), ('Paul', 1))
+
+    def test_values_group_by(self):
+        """Assert grouping by a decrypted column counts the rows."""
+        EncryptedModelFactory.create_batch(2, pgp_sym_field='Paul', fk_model=None)
+        EncryptedModelFactory.create(pgp_sym_field='Peter', fk_model=None)
+
+        counts = EncryptedModel.objects.values('pgp_sym_field').annotate(
+            n=Count('id')).order_by('pgp_sym_field')
+
+        self.assertEqual(
+            [(row['pgp_sym_field'], row['n']) for row in counts],
+            [('Paul', 2), ('Peter', 1)],
+        )
+
+    def test_setting(self):
+        """Assert `PGCRYPTO_DECRYPT_ONCE = False` decrypts at every reference."""
+        queryset = EncryptedModel.objects.filter(pgp_sym_field='Paul')
+
+        with self.settings(PGCRYPTO_DECRYPT_ONCE=False):
+            sql, _ = queryset.query.get_compiler(queryset.db).as_sql()
+
+        self.assertNotIn('LATERAL', sql)
+        self.assertEqual(sql.count('pgp_sym_decrypt('), 9)
+
+
+class TestPrefetchKeys(TestCase):
+    """Test `PGPQuerySet.prefetch_keys`."""
+
+    def setUp(self):
+        """Start with an empty key cache."""
+        keys.cache.clear()
+
+    def test_select_related(self):
+        """Assert the keys of the rows and related rows are fetched at once."""
+        instances = EncryptedModelFactory.create_batch(2)
+        keys.cache.clear()
+
+        with instrumentation.collect() as metrics:
+            loaded = list(
+                EncryptedModel.objects.select_related('fk_model').prefetch_keys())
+
+        self.assertEqual(len(loaded), 2)
+        self.assertEqual(metrics[instrumentation.REDIS_CALLS], 1)
+        for instance in instances:
+            self.assertIn(str(instance.pk), keys.cache)
+            self.assertIn(str(instance.fk_model.pk), keys.cache)
+
+        with instrumentation.collect() as metrics:
+            loaded[0].pgp_sym_field = 'updated'
+            loaded[0].save()
+        self.assertEqual(metrics[instrumentation.KEY_STORE_QUERIES], 0)
+
+    def test_prefetch(self):
+        """Assert `prefetch_keys` works on the queryset of a `Prefetch`."""
+        instance = EncryptedModelFactory.create()
+        keys.cache.clear()
+
+        fk_model = EncryptedFKModel.objects.prefetch_related(Prefetch(
+            'encryptedmodel_set', queryset=EncryptedModel.objects.prefetch_keys(),
+        )).get(pk=instance.fk_model.pk)
+
+        self.assertEqual(list(fk_model.encryptedmodel_set.all()), [instance])
+        self.assertIn(str(instance.pk), keys.cache)
+
+
+class TestDecryptedIterator(TestCase):
+    """Test `PGPQuerySet.decrypted_iterator`."""
+
+    def setUp(self):
+        """Start with an empty key cache."""
+        keys.cache.clear()
+
+    def test_in_python(self):
+        """Assert rows are decrypted in python without filling the key cache."""
+        instances = EncryptedModelFactory.create_batch(5, fk_model=None)
+        keys.cache.clear()
+
+        with instrumentation.collect() as metrics:
+            loaded = list(
+                EncryptedModel.objects.order_by('pk').decrypted_iterator(chunk_size=2))
+
+        self.assertEqual(
+            [instance.pgp_sym_field for instance in loaded],
+            [instance.pgp_sym_field
+             for instance in sorted(instances, key=lambda i: i.pk)],
+        )
+        self.assertEqual(metrics[instrumentation.REDIS_CALLS], 3)
+        self.assertEqual(keys.cache, {})
+
+    def test_in_database(self):
+        """Assert chunks are decrypted by postgres with the prefetched keys."""
+        instance = EncryptedModelFactory.create(fk_model=None)
+
+        with instrumentation.collect() as metrics:
+            loaded, = EncryptedModel.objects.decrypted_iterator(in_database=True)
+
+        self.assertEqual(loaded.pgp_sym_field, instance.pgp_sym_field)
+        self.assertEqual(loaded.integer_pgp_sym_field, instance.integer_pgp_sym_field)
+        self.assertEqual(loaded.date_pgp_sym_field, instance.date_pgp_sym_field)
+        self.assertEqual(metrics[instrumentation.DECRYPT_QUERIES], 1)
+        self.assertEqual(metrics[instrumentation.PYTHON_DECRYPTED_VALUES], 0)
+
+
+class TestEncryptInPython(TestCase):
+    """Test `PGCRYPTO_ENCRYPT_IN_PYTHON`."""
+
+    def setUp(self):
+        """Start with an empty key cache."""
+        keys.cache.clear()
+
+    def test_create(self):
+        """Assert values encrypted in python are decrypted by `pgp_sym_decrypt`."""
+        with self.settings(PGCRYPTO_ENCRYPT_IN_PYTHON=True):
+            with CaptureQueriesContext(connection) as queries:
+                instance = EncryptedModelFactory.create(
+                    pgp_sym_field='secret', decimal_pgp_sym_field=Decimal('1.20'))
+
+        insert = queries.captured_queries[-1]['sql']
+        self.assertNotIn('pgp_sym_encrypt', insert)
+        self.assertNotIn('secret', insert)
+
+        loaded = EncryptedModel.objects.get(pk=instance.pk)
+        self.assertEqual(loaded.pgp_sym_field, 'secret')
+        self.assertEqual(loaded.integer_pgp_sym_field, instance.integer_pgp_sym_field)
+        self.assertEqual(loaded.date_pgp_sym_field, instance.date_pgp_sym_field)
+        self.assertEqual(loaded.datetime_pgp_sym_field, instance.datetime_pgp_sym_field)
+        self.assertEqual(loaded.decimal_pgp_sym_field, Decimal('1.20'))
+
+    def test_update(self):
+        """Assert `save()` of an existing row encrypts in python too."""
+        instance = EncryptedModelFactory.create()
+        instance.pgp_sym_field = 'updated'
+
+        with self.settings(PGCRYPTO_ENCRYPT_IN_PYTHON=True):
+            with instrumentation.collect() as metrics:
+                instance.save()
+
+        self.assertGreater(metrics[instrumentation.PYTHON_ENCRYPTED_VALUES], 0)
+        self.assertEqual(
+            EncryptedModel.objects.get(pk=instance.pk).pgp_sym_field, 'updated')
+
+    def test_bulk_create(self):
+        """Assert every row of `bulk_create` is encrypted with its own key."""
+        instances = EncryptedModelFactory.build_batch(4, fk_model=None)
+
+        with self.settings(PGCRYPTO_ENCRYPT_IN_PYTHON=True):
+            EncryptedModel.objects.bulk_create(instances, workers=2)
+
+        for instance in instances:
+            with self.subTest(instance=instance):
+                self.assertIsInstance(instance.pgp_sym_field, str)
+                loaded = EncryptedModel.objects.get(pk=instance.pk)
+                self.assertEqual(loaded.pgp_sym_field, instance.pgp_sym_field)
+
+    def test_aes(self):
+        """Assert AES fields are encrypted in python."""
+        with self.settings(PGCRYPTO_ENCRYPT_IN_PYTHON=True):
+            instance = EncryptedAESModel.objects.create(text='bonjour', integer=42)
+
+        loaded = EncryptedAESModel.objects.get(pk=instance.pk)
+        self.assertEqual(loaded.text, 'bonjour')
+        self.assertEqual(loaded.integer, 42)
+
+
+class TestBulkUpdate(TestCase):
+    """Test multi-row writes, `bulk_create` and `PGPQuerySet.bulk_update`."""
+
+    def setUp(self):
+        """Start with an empty key cache."""
+        keys.cache.clear()
+
+    def test_update(self):
+        """Assert `update()` of several rows encrypts each with its own key."""
+        instances = EncryptedModelFactory.create_batch(3, fk_model=None)
+
+        EncryptedModel.objects.filter(pk__in=[i.pk for i in instances]).update(
+            pgp_sym_field='updated', integer_pgp_sym_field=7)
+
+        loaded = EncryptedModel.objects.decrypt_in_python()
+        self.assertEqual([i.pgp_sym_field for i in loaded], ['updated'] * 3)
+        self.assertEqual([i.integer_pgp_sym_field for i in loaded], [7] * 3)
+
+    def test_bulk_create(self):
+        """Assert every row of a multi-row INSERT is encrypted with its own key."""
+        instances = EncryptedModelFactory.build_batch(3, fk_model=None)
+
+        EncryptedModel.objects.bulk_create(instances)
+
+        for instance in instances:
+            with self.subTest(instance=instance):
+                loaded = EncryptedModel.objects.get(pk=instance.pk)
+                self.assertEqual(loaded.pgp_sym_field, instance.pgp_sym_field)
+                self.assertEqual(
+                    loaded.integer_pgp_sym_field, instance.integer_pgp_sym_field)
+
+    def test_bulk_update(self):
+        """Assert every row gets its own value, encrypted with its own key."""
+        instances = EncryptedModelFactory.create_batch(3, fk_model=None)
+        for n, instance in enumerate(instances):
+            instance.pgp_sym_field = 'value {}'.format(n)
+            instance.integer_pgp_sym_field = None if n == 0 else n
+
+        with CaptureQueriesContext(connection) as queries:
+            updated = EncryptedModel.objects.bulk_update(
+                instances, ['pgp_sym_field', 'integer_pgp_sym_field'], batch_size=2)
+
+        self.assertEqual(updated, 3)
+        updates = [q for q in queries.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 2)
+        for instance in instances:
+            with self.subTest(instance=instance):
+                loaded = EncryptedModel.objects.decrypt_in_python().get(pk=instance.pk)
+                self.assertEqual(loaded.pgp_sym_field, instance.pgp_sym_field)
+                self.assertEqual(
+                    loaded.integer_pgp_sym_field, instance.integer_pgp_sym_field)
+
+    def test_bulk_update_encrypt_in_python(self):
+        """Assert `bulk_update` sends ciphertexts with `PGCRYPTO_ENCRYPT_IN_PYTHON`."""
+        instance = EncryptedModelFactory.create(fk_model=None)
+        instance.pgp_sym_field = 'secret'
+
+        with self.settings(PGCRYPTO_ENCRYPT_IN_PYTHON=True):
+            with CaptureQueriesContext(connection) as queries:
+                EncryptedModel.objects.bulk_update([instance], ['pgp_sym_field'])
+
+        self.assertNotIn('pgp_sym_encrypt', queries.captured_queries[-1]['sql'])
+        self.assertEqual(instance.pgp_sym_field, 'secret')
+        self.assertEqual(
+            EncryptedModel.objects.get(pk=instance.pk).pgp_sym_field, 'secret')
@@ -0,0 +1,83 @@
+from base64 import b64decode
+
+from django.test import SimpleTestCase
+
+from pgcrypto import openpgp
+
+# `printf 'bonjour' | gpg --symmetric --cipher-algo AES --compress-algo zip`
+# with the passphrase 'djangorocks'.
+GPG_MESSAGE = b64decode(
+    'jA0EBwMCztk1gZVuTYP/0jwBbSRX0+aLa/45UOpMU+XN5PHSo44wUr94FCyCrJvNHJoSIPJvnlvQ'
+    'toy2Ibf1sXvJwZKuBQSb47CicjA='
+)
+
+
+class TestDecrypt(SimpleTestCase):
+    """Test OpenPGP symmetric messages are decrypted in python."""
+
+    def test_decrypt(self):
+        """Assert a compressed, integrity protected message is decrypted."""
+        self.assertEqual(openpgp.decrypt(GPG_MESSAGE, 'djangorocks'), b'bonjour')
+
+    def test_wrong_key(self):
+        """Assert the wrong key is detected."""
+        with self.assertRaises(openpgp.PGPError):
+            openpgp.decrypt(GPG_MESSAGE, 'wrong key')
+
+    def test_tampered(self):
+        """Assert a modified message fails the integrity check."""
+        message = bytearray(GPG_MESSAGE)
+        message[-5] ^= 1
+
+        with self.assertRaises(openpgp.PGPError):
+            openpgp.decrypt(bytes(message), 'djangorocks')
+
+    def test_partial_lengths(self):
+        """Assert packets streamed with partial body lengths are joined."""
+        packets = list(openpgp.iter_packets(b'\xcb\xe1ab\x02cd'))
+
+        self.assertEqual(packets, [(openpgp.LITERAL, b'abcd')])
+
+    def test_s2k_count(self):
+        """Assert iterated S2K counts are decoded."""
+        self.assertEqual(openpgp.decode_count(96), 65536)
+        self.assertEqual(openpgp.decode_count(255), 65011712)
+
+
+class TestEncrypt(SimpleTestCase):
+    """Test messages encrypted in python like `pgp_sym_encrypt`."""
+
+    def test_round_trip(self):
+        """Assert the default message is decrypted."""
+        message = openpgp.encrypt(b'bonjour', 'key')
+
+        self.assertEqual(openpgp.decrypt(message, 'key'), b'bonjour')
+
+    def test_options(self):
+        """Assert pgcrypto options are applied."""
+        for options in (
+            'cipher-algo=aes256, compress-algo=1',
+            's2k-mode=1, compress-algo=2, compress-level=9',
+            's2k-mode=0, s2k-digest-algo=md5, disable-mdc=1',
+            'sess-key=1, s2k-cipher-algo=aes256',
+        ):
+            with self.subTest(options=options):
+                message = openpgp.encrypt(b'bonjour' * 100, 'key', options)
+                self.assertEqual(openpgp.decrypt(message, 'key'), b'bonjour' * 100)
+
+    def test_large(self):
+        """Assert long bodies get a five octets length."""
+        message = openpgp.encrypt(bytes(10000), 'key', 's2k-mode=1')
+
+        self.assertEqual(openpgp.decrypt(message, 'key'), bytes(10000))
+
+    def test_binary(self):
+        """Assert binary literals keep their line endings when decrypted."""
+        message = openpgp.encrypt(b'a\r\nb', 'key', binary=True)
+
+        self.assertEqual(openpgp.decrypt(message, 'key', 'convert-crlf=1'), b'a\r\nb')
+
+    def test_unsupported_option(self):
+        """Assert unknown options are rejected."""
+        with self.assertRaises(openpgp.PGPError):
+            openpgp.encrypt(b'bonjour', 'key', 'armor=1')
@@ -0,0 +1,118 @@
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+
+from pgcrypto import search
+from .models import EncryptedSearchModel
+
+KEY = b'search key'
+
+
+class TestTokens(SimpleTestCase):
+    """Test the tokens of `pgcrypto.search`."""
+
+    def test_value_tokens(self):
+        """Assert prefixes and n-grams are hashed, case insensitively."""
+        tokens = search.value_tokens('AbCd', KEY, 3, 20)
+
+        self.assertEqual(tokens, search.value_tokens('abcd', KEY, 3, 20))
+        # a, ab, abc, abcd and abc, bcd.
+        self.assertEqual(len(tokens), 6)
+        self.assertEqual(search.value_tokens(None, KEY, 3, 20), [])
+
+    def test_query_tokens(self):
+        """Assert every value matching a search has the search's tokens."""
+        tokens = set(search.value_tokens('jessica@example.com', KEY, 3, 20))
+
+        self.assertLessEqual(set(search.startswith_tokens('JESS', KEY, 3, 20)), tokens)
+        self.assertLessEqual(
+            set(search.startswith_tokens('jessica@example.co', KEY, 3, 5)),
+            set(search.value_tokens('jessica@example.com', KEY, 3, 5)),
+        )
+        self.assertLessEqual(set(search.contains_tokens('Example', KEY, 3)), tokens)
+
+    def test_too_short(self):
+        """Assert searches without tokens match any value."""
+        self.assertIsNone(search.startswith_tokens('', KEY, 3, 20))
+        self.assertIsNone(search.contains_tokens('ex', KEY, 3))
+
+
+class TestSearchLookups(TestCase):
+    """Test `__istartswith` and `__icontains` with a `SearchTokensField`."""
+
+    def setUp(self):
+        """Create a few rows."""
+        for email in ('paul@example.com', 'peter@example.org', 'jessica@example.com'):
+            EncryptedSearchModel.objects.create(email=email, name=email)
+
+    def test_istartswith(self):
+        """Assert the tokens narrow down the verified candidates."""
+        with CaptureQueriesContext(connection) as queries:
+            emails = list(EncryptedSearchModel.objects.filter(
+                email__istartswith='P').values_list('email', flat=True))
+
+        self.assertEqual(sorted(emails), ['paul@example.com', 'peter@example.org'])
+        self.assertIn('@>', queries.captured_queries[0]['sql'])
+
+    def test_icontains(self):
+        """Assert n-gram tokens find substrings."""
+        emails = EncryptedSearchModel.objects.filter(
+            email__icontains='EXAMPLE.COM').values_list('email', flat=True)
+
+        self.assertEqual(sorted(emails), ['jessica@example.com', 'paul@example.com'])
+
+    def test_short_and_unindexed(self):
+        """Assert searches without tokens, or fields without them, still work."""
+        self.assertEqual(
+            EncryptedSearchModel.objects.filter(email__icontains='.c').count(), 3)
+        self.assertEqual(
+            EncryptedSearchModel.objects.filter(name__istartswith='jess').count(), 1)
+
+    def test_update(self):
+        """Assert saving updates the tokens."""
+        instance = EncryptedSearchModel.objects.get(email='paul@example.com')
+        instance.email = 'saul@example.com'
+        instance.save()
+
+        self.assertFalse(
+            EncryptedSearchModel.objects.filter(email__istartswith='paul').exists())
+        self.assertTrue(
+            EncryptedSearchModel.objects.filter(email__istartswith='saul').exists())
+
+    def test_bulk_update(self):
+        """Assert `bulk_update` updates the tokens of the updated fields."""
+        instance = EncryptedSearchModel.objects.get(email='paul@example.com')
+        instance.email = 'saul@example.com'
+
+        EncryptedSearchModel.objects.bulk_update([instance], ['email'])
+
+        self.assertTrue(
+            EncryptedSearchModel.objects.filter(email__istartswith='saul').exists())
+
+    def test_queryset_update(self):
+        """Assert `update()` sets the tokens of the new value."""
+        EncryptedSearchModel.objects.filter(name='paul@example.com').update(
+            email='saul@example.com')
+
+        queryset = EncryptedSearchModel.objects.filter(email__istartswith='saul')
+        self.assertEqual(
+            list(queryset.values_list('name', flat=True)), ['paul@example.com'])
+
+    def test_queryset_update_expression(self):
+        """Assert `update()` refuses expressions it can't tokenize."""
+        with self.assertRaises(ValueError):
+            EncryptedSearchModel.objects.update(email=F('name'))
+
+    def test_index_command(self):
+        """Assert the command computes the tokens of rows saved without them."""
+        EncryptedSearchModel.objects.update(email_tokens=[])
+        self.assertFalse(
+            EncryptedSearchModel.objects.filter(email__istartswith='p').exists())
+
+        call_command('pgcrypto_index_search_tokens', 'tests.EncryptedSearchModel',
+                     chunk_size=2)
+
+        self.assertEqual(
+            EncryptedSearchModel.objects.filter(email__istartswith='p').count(), 2)
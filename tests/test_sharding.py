@@ -0,0 +1,95 @@
+from io import StringIO
+
+from django.core.management import call_command, CommandError
+from django.test import override_settings, SimpleTestCase
+
+from pgcrypto import keys, sharding
+
+NODES = ('redis-a:6379', 'redis-b:6379', 'redis-c:6379')
+KEY_IDS = [str(i) for i in range(3000)]
+
+
+class TestHashRing(SimpleTestCase):
+    """Test `pgcrypto.sharding.HashRing`."""
+
+    def test_distribution(self):
+        """Assert every node holds a share of the keys."""
+        groups = sharding.HashRing(NODES).group(KEY_IDS)
+
+        self.assertEqual(set(groups), set(NODES))
+        for node_ids in groups.values():
+            self.assertGreater(len(node_ids), len(KEY_IDS) / len(NODES) / 2)
+
+    def test_add_node(self):
+        """Assert adding a node only moves keys to the new node."""
+        ring = sharding.HashRing(NODES)
+        bigger = sharding.HashRing(NODES + ('redis-d:6379',))
+
+        moved = [
+            key_id for key_id in KEY_IDS
+            if ring.get_node(key_id) != bigger.get_node(key_id)
+        ]
+
+        self.assertLess(len(moved), len(KEY_IDS) / 2)
+        self.assertEqual({bigger.get_node(key_id) for key_id in moved}, {'redis-d:6379'})
+
+    def test_parse_node(self):
+        """Assert nodes are `host:port`, the port defaulting to redis'."""
+        self.assertEqual(sharding.parse_node('10.0.0.1:6380'), ('10.0.0.1', 6380))
+        self.assertEqual(sharding.parse_node('redis'), ('redis', 6379))
+
+    def test_key_store_sql(self):
+        """Assert `key_store` becomes a view over a foreign table per node."""
+        statements = sharding.key_store_sql(NODES)
+
+        self.assertEqual(sum('CREATE SERVER' in sql for sql in statements), 3)
+        self.assertIn(' UNION ALL ', statements[-1])
+        self.assertIn("address 'redis-a', port '6379'", statements[0])
+
+
+class TestShardedKeys(SimpleTestCase):
+    """Test the node of the keys in `pgcrypto.keys`."""
+
+    @override_settings(DEFF_REDIS_NODES='redis-a:6379, redis-b:6379')
+    def test_group_by_node(self):
+        """Assert ids are grouped by the node of the ring."""
+        groups = keys.group_by_node(KEY_IDS)
+
+        self.assertEqual(set(groups), {'redis-a:6379', 'redis-b:6379'})
+        self.assertEqual(keys.moved_key_ids(KEY_IDS), {})
+
+    def test_not_sharded(self):
+        """Assert all the ids are on the single key store."""
+        self.assertEqual(keys.group_by_node(KEY_IDS), {None: KEY_IDS})
+        self.assertEqual(keys.get_nodes(), [None])
+
+    @override_settings(DEFF_REDIS_NODES=NODES, DEFF_REDIS_PREVIOUS_NODES=NODES[:2])
+    def test_moved_key_ids(self):
+        """Assert keys moving to a new node are looked up on their previous one."""
+        moved = keys.moved_key_ids(KEY_IDS)
+        ring = keys.get_ring()
+
+        self.assertTrue(moved)
+        for node, node_ids in moved.items():
+            for key_id in node_ids:
+                self.assertEqual(ring.get_node(key_id), 'redis-c:6379')
+                self.assertEqual(keys.get_ring(previous=True).get_node(key_id), node)
+        self.assertEqual(keys.get_nodes(), list(NODES))
+
+
+class TestRebalanceKeysCommand(SimpleTestCase):
+    """Test the `pgcrypto_rebalance_keys` management command."""
+
+    def test_not_sharded(self):
+        """Assert the command needs a sharded key store."""
+        with self.assertRaises(CommandError):
+            call_command('pgcrypto_rebalance_keys')
+
+    @override_settings(DEFF_REDIS_NODES=NODES)
+    def test_key_store_sql(self):
+        """Assert the SQL of the `key_store` view is printed."""
+        out = StringIO()
+
+        call_command('pgcrypto_rebalance_keys', '--key-store-sql', stdout=out)
+
+        self.assertIn('CREATE OR REPLACE VIEW key_store', out.getvalue())